@@ -1,51 +1,124 @@
 # this is a DQBE application which will run with predefined joins
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session, make_response, send_file
-from sqlalchemy import create_engine, MetaData, select, and_, func, asc, desc, text
-from collections import deque
-import pandas as pd
-import io
+import functools
+import json
+
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, make_response, Response
+
+import chart_refresh
+import chart_series
+import columnar
+import dashboard_planner
+import db
+import export_stream
+import incremental
+import index_advisor
+import instrumentation
+import jobs
+import page_cache
+import pagination
+import partitions
+import query_builder
+import report_store
+import responses
+import rollups
+import sampling
+import schema_catalog
+from join_index import JoinIndex
 
 app = Flask(__name__)
 app.secret_key = 'dqbe_dashboard'
 
-# Database setup
-engine = create_engine("sqlite:///sales.db")
-metadata = MetaData()
-metadata.reflect(bind=engine)
-
-# Dynamically get all tables
-all_tables = {table.name: table for table in metadata.sorted_tables}
-
-# Build join graph dynamically
-join_graph = {
-    "sales": {
-        "customers": all_tables["sales"].c.customer_name == all_tables["customers"].c.customer_name,
-        "products": all_tables["sales"].c.product == all_tables["products"].c.product_name,
-    },
-    "customers": {
-        "sales": all_tables["customers"].c.customer_name == all_tables["sales"].c.customer_name,
-    },
-    "products": {
-        "sales": all_tables["products"].c.product_name == all_tables["sales"].c.product,
-    }
-}
-
-def bfs_join_path(graph, start, end):
-    queue = deque([[start]])
-    visited = set()
-    while queue:
-        path = queue.popleft()
-        node = path[-1]
-        if node == end:
-            return path
-        if node not in visited:
-            visited.add(node)
-            for neighbor in graph.get(node, {}):
-                new_path = list(path)
-                new_path.append(neighbor)
-                queue.append(new_path)
-    return None
+# Request, template and query timings, served at /metrics
+instrumentation.init_app(app)
+
+# gzip/brotli for HTML and JSON responses
+responses.init_app(app)
+
+# Database setup: a tuned writable pool, plus a read-only pool for report queries
+engine, read_engine = db.make_engines()
+
+# Change log and per-chart partial aggregates for incremental chart refresh
+incremental.install(engine)
+
+# Create the sales rollup and fold in any rows added since the last run
+rollups.install(engine)
+
+# Compiled builder queries, keyed by report shape
+plan_cache = query_builder.PlanCache()
+
+# Filter/join/sort columns seen by the builder, for index recommendations
+advisor = index_advisor.IndexAdvisor()
+
+# Long-running reports can run in the background and be polled by job id
+job_manager = jobs.JobManager()
+
+# Saved dashboard charts and reports live server-side; the cookie only holds the owner id
+report_store.install(engine)
+
+# Per-table data versions behind the dashboard/report ETags, and the rendered
+# chart fragments cached under them
+table_versions = page_cache.TableVersions()
+fragment_cache = page_cache.FragmentCache()
+
+# Tables come from a schema catalog (dqbe_* tables are the app's own
+# bookkeeping): names and columns are loaded from a snapshot keyed by the
+# schema version, and Table objects are reflected on first use. Set up after
+# the installs above so their tables do not invalidate the snapshot.
+catalog = schema_catalog.SchemaCatalog(read_engine)
+catalog.refresh()
+all_tables = catalog.tables
+
+# Index shortest join paths between all tables, rebuilt when the schema changes
+join_index = JoinIndex()
+join_index.build(catalog.version, *catalog.describe())
+
+# Stratified sample of sales behind the builder's fast preview mode
+sales_sample = sampling.SalesSample(engine, all_tables['sales']) if 'sales' in all_tables else None
+
+# Optional DuckDB mirror that answers aggregate builder queries (DQBE_COLUMNAR)
+columnar_backend = columnar.backend(engine, read_engine, all_tables)
+
+# Optional monthly partitions of sales that date-filtered aggregates scan in
+# parallel, pruned to the requested range (DQBE_PARTITIONS)
+partition_store = partitions.store(engine, read_engine, all_tables)
+
+
+@app.before_request
+def check_schema():
+    # Picks up schema changes made while running (checked every few seconds)
+    if catalog.refresh():
+        join_index.build(catalog.version, *catalog.describe())
+
+
+# Estimated groups listed next to a preview chart
+PREVIEW_TABLE_ROWS = 100
+
+# Result rows read to draw a builder chart beyond the first table page
+CHART_ROW_LIMIT = 20000
+
+JOB_LIMIT_ERROR = ("Too many background queries are running or kept for you; "
+                   "wait for one to finish or cancel it and try again.")
+
+
+def current_owner():
+    if 'owner_id' not in session:
+        session['owner_id'] = report_store.new_owner_id()
+    return session['owner_id']
+
+
+def job_chart(graph_type):
+    # Chart series for a background job, built on the worker once its rows are in
+    def finish(columns, rows):
+        try:
+            labels, values = chart_series.to_series(columns, rows, strict=True)
+        except (ValueError, TypeError):
+            return {'chart': None}
+        note = chart_series.dropped_note(graph_type, len(labels), columns[-1])
+        labels, values = chart_series.reduce_series(graph_type, labels, values, value_field=columns[-1])
+        return {'chart': {'labels': labels, 'values': values, 'note': note}}
+    return finish
+
 
 @app.route('/add_to_dashboard', methods=['POST'])
 def add_to_dashboard():
@@ -53,6 +126,8 @@ def add_to_dashboard():
     selected_type = request.form.get('chart_type')
     label_field = request.form.get('label_field')
     value_field = request.form.get('value_field')
+    sql_params = json.loads(request.form.get('sql_params') or '{}')
+    sql_shape = json.loads(request.form.get('sql_shape') or 'null')
 
     normalized_type = selected_type.strip().lower() if selected_type else ""
 
@@ -67,204 +142,330 @@ def add_to_dashboard():
 
     chart_type = chart_type_map.get(normalized_type, 'bar')
 
-    if 'dashboard_charts' not in session:
-        session['dashboard_charts'] = []
-
-    charts = session['dashboard_charts']
-    charts.append({
+    report_store.add_item(engine, current_owner(), 'chart', {
         "query": sql_query,
+        "params": sql_params,
+        "shape": sql_shape,
         "graph_type": chart_type,
         "label_field": label_field,
         "value_field": value_field
     })
 
-    session['dashboard_charts'] = charts
     return redirect(url_for('index'))
 
 @app.route('/view_dashboard')
 def view_dashboard():
-    charts = []
-    dashboard_charts = session.get('dashboard_charts', [])
-
-    with engine.connect() as conn:
-        for chart_def in dashboard_charts:
-            try:
-                result = conn.execute(text(chart_def['query']))
-                data = result.mappings().all()
-                if not data:
-                    continue
-
-                labels = [str(row.get(chart_def['label_field'], '')) for row in data]
-                values = []
-                for row in data:
-                    raw_value = row.get(chart_def['value_field'], 0)
-                    try:
-                        values.append(float(raw_value))
-                    except (ValueError, TypeError):
-                        values.append(0.0)
-
-                charts.append({
-                    'graph_type': chart_def['graph_type'],
-                    'labels': labels,
-                    'values': values,
-                    'label': chart_def['value_field'],
-                    'label_field': chart_def['label_field'],
-                    'value_field': chart_def['value_field'],
-                    'sql_query': chart_def['query']
-                })
-            except Exception as e:
-                print("Chart render error:", e)
-                continue
+    # Only the page shell: each chart fetches its data from /api/chart as it
+    # scrolls into view
+    dashboard_charts = report_store.list_items(engine, current_owner(), 'chart')
+    etag = page_cache.shell_etag('chart', dashboard_charts, table_versions.epoch)
+    if request.if_none_match.contains_weak(etag):
+        fragment_cache.record('not_modified')
+        return page_cache.not_modified(etag)
+    return page_cache.conditional(make_response(render_template('dashboard.html', dashboard=dashboard_charts)), etag)
+
+def page_source(shape, plan):
+    # (sql, key, tiebreak) for paging a builder result: by the sort column
+    # with the plan's row tiebreak, by the tiebreak alone when there is no
+    # sort, and in the query's own order (by offset) when the sort column is
+    # not selected, so its ORDER BY is kept
+    sort_field = shape['sort_field']
+    if sort_field and sort_field not in plan.columns:
+        return plan.sql, None, ()
+    return plan.page_sql, sort_field, plan.tiebreak
+
+def computed_result(shape, plan, params):
+    # (columns, rows) of an aggregate answered off the sales table: by the
+    # columnar mirror, or for a date range by the sales partitions in range.
+    # None runs it on SQLite as usual.
+    result = None
+    if columnar_backend is not None and columnar.eligible(shape, plan):
+        result = columnar_backend.execute(plan, params, ordered=bool(shape['sort_field']))
+    if result is None and partition_store is not None and partitions.eligible(shape, plan):
+        result = partition_store.execute(plan, shape, params, all_tables, join_index)
+    return result
+
+def items_series(kind, items):
+    # One (labels, values) or exception per saved chart or report. They are
+    # refreshed together: SUM/COUNT/AVG series are maintained incrementally
+    # (full recomputes of items sharing a base query in one merged scan);
+    # the others run through the cached refresh engine (charts via the
+    # dashboard planner, which merges them the same way)
+    rollups.refresh_if_used(engine, [item['query'] for item in items])
+    full_scan = None
+    if partition_store is not None:
+        full_scan = functools.partial(partition_store.partials, tables=all_tables, join_index=join_index)
+    results = incremental.refresh(engine, read_engine, items, all_tables, join_index, full_scan)
+
+    rest = [n for n, result in enumerate(results) if result is None]
+    if rest:
+        if kind == 'chart':
+            outcomes = dashboard_planner.refresh(read_engine, [items[n] for n in rest], all_tables, join_index,
+                                                 plan_cache)
+        else:
+            # Reports need only the two charted columns
+            outcomes = chart_refresh.refresh(read_engine, [
+                (chart_refresh.series_sql(items[n]['query'], items[n]['label_field'], items[n]['value_field']),
+                 items[n].get('params'))
+                for n in rest])
+        for n, outcome in zip(rest, outcomes):
+            results[n] = outcome
+
+    series = []
+    for item, result in zip(items, results):
+        if isinstance(result, Exception):
+            series.append(result)
+            continue
+        columns, rows = result
+        try:
+            labels, values = chart_series.to_series(columns, rows, item['label_field'], item['value_field'])
+            note = chart_series.dropped_note(item.get('graph_type'), len(labels), item['value_field'])
+            series.append(chart_series.reduce_series(item.get('graph_type'), labels, values,
+                                                     value_field=item['value_field']) + (note,))
+        except Exception as e:
+            series.append(e)
+    return series
+
+def series_payload(item, labels, values, note=None):
+    return responses.dumps({
+        'id': item['id'],
+        'graph_type': item.get('graph_type'),
+        'label_field': item['label_field'],
+        'value_field': item['value_field'],
+        'labels': labels,
+        'values': values,
+        'note': note,
+    })
 
-    return render_template('dashboard.html', dashboard=charts)
+def series_response(kind, item):
+    # Columnar chart payload with an ETag from the item and the data versions
+    # of its tables; unchanged payloads are served from the fragment cache.
+    # A miss refreshes every card of the page whose payload is not cached, so
+    # cards sharing a base query cost one scan and the sibling cards find
+    # their payloads ready when they ask.
+    versions = table_versions.snapshot(read_engine, all_tables)
+    etag = page_cache.fragment_key(kind, 0, item, versions, all_tables)
+    if request.if_none_match.contains_weak(etag):
+        fragment_cache.record('not_modified')
+        return page_cache.not_modified(etag)
+
+    body = fragment_cache.get(etag)
+    if body is None:
+        owner = current_owner()
+        # Cards loading at the same time wait for one refresh of the page
+        with fragment_cache.fill_lock((owner, kind)):
+            body = fragment_cache.get(etag)
+            if body is None:
+                pending = [(item, etag)]
+                for sibling in report_store.list_items(engine, owner, kind):
+                    key = page_cache.fragment_key(kind, 0, sibling, versions, all_tables)
+                    if sibling['id'] != item['id'] and key not in fragment_cache:
+                        pending.append((sibling, key))
+                try:
+                    outcomes = items_series(kind, [entry for entry, _ in pending])
+                except Exception as e:
+                    instrumentation.log.warning("%s %s failed: %s", kind.title(), item['id'], e)
+                    return responses.json_response({'id': item['id'], 'error': str(e)}, 500)
+                for (entry, key), outcome in zip(pending, outcomes):
+                    if isinstance(outcome, Exception):
+                        instrumentation.log.warning("%s %s failed: %s", kind.title(), entry['id'], outcome)
+                        continue
+                    fragment_cache.put(key, series_payload(entry, *outcome))
+                if isinstance(outcomes[0], Exception):
+                    return responses.json_response({'id': item['id'], 'error': str(outcomes[0])}, 500)
+                body = series_payload(item, *outcomes[0])
+    return page_cache.conditional(responses.json_response(body), etag)
+
+@app.route('/api/chart/<int:chart_id>')
+def chart_data(chart_id):
+    chart_def = report_store.get_item(engine, current_owner(), 'chart', chart_id)
+    if chart_def is None:
+        return responses.json_response({'error': "Chart not found"}, 404)
+    return series_response('chart', chart_def)
 
 @app.route('/update_chart_action', methods=['POST'])
 def update_chart_action():
     chart_id = int(request.form.get('chart_id'))
     action = request.form.get('action')
 
-    if 'dashboard_charts' in session:
-        charts = session['dashboard_charts']
-        if 0 <= chart_id < len(charts):
-            if action == 'remove':
-                charts.pop(chart_id)
-            elif action == 'save':
-                charts[chart_id]['saved'] = True
-
-        session['dashboard_charts'] = charts
+    if action == 'remove':
+        report_store.remove_item(engine, current_owner(), 'chart', chart_id)
+        incremental.forget(engine, chart_id)
+    elif action == 'save':
+        report_store.mark_saved(engine, current_owner(), 'chart', chart_id)
 
     return redirect(url_for('view_dashboard'))
 
+def date_bounds():
+    # Served from memory until sales changes
+    version = table_versions.snapshot(read_engine, ['sales'])['sales']
+    return catalog.date_bounds(read_engine, 'sales', 'order_date', version)
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    report_data = []
+    report_page = None
+    page_request = None
     chart_data = None
+    job = None
     graph_types = ['Bar Chart', 'Line Chart', 'Pie Chart', 'Scatter Plot']
-    attributes = {table: [col.name for col in all_tables[table].columns] for table in all_tables}
+    attributes = catalog.attributes()
     regions = ["North", "South", "East", "West"]
 
-    with engine.connect() as conn:
-        min_date = conn.execute(select(func.min(all_tables["sales"].c.order_date))).scalar()
-        max_date = conn.execute(select(func.max(all_tables["sales"].c.order_date))).scalar()
+    min_date, max_date = date_bounds()
 
     query_string = ""
     all_columns = []
     groupable_fields = []
+    preview_note = None
+    chart_note = None
 
     if request.method == 'POST':
-        table1 = request.form.get('table1')
-        table2 = request.form.get('table2')
-        selected_fields = request.form.getlist('fields')
-        region = request.form.get('region')
-        start_date = request.form.get('start_date')
-        end_date = request.form.get('end_date')
-        aggregate = request.form.get('aggregate')
-        aggregate_field = request.form.get('aggregate_field')  # <-- ✅ ADDED THIS LINE
-        sort_field = request.form.get('sort_field')
-        sort_order = request.form.get('sort_order')
-        distinct = request.form.get('distinct') == 'on'
+        shape, params = query_builder.shape_from_form(request.form, (min_date, max_date), all_tables)
+        table1 = shape['table1']
+        table2 = shape['table2']
         selected_graph = request.form.get('graph_type')
-        group_by_field = request.form.get('group_by')
-
-        selected_tables = []
-        if table1:
-            selected_tables.append(all_tables[table1])
-        if table2 and table2 != table1:
-            selected_tables.append(all_tables[table2])
 
         if table1 and table2:
             all_columns = list(set(attributes.get(table1, []) + attributes.get(table2, [])))
             groupable_fields = [col for col in all_columns if col.lower() not in ('id', 'amount')]
 
-        path = bfs_join_path(join_graph, table1, table2) if table2 else [table1]
-        if not path:
+        # Reports with the same shape reuse one compiled statement
+        plan = plan_cache.get(shape, all_tables, join_index)
+        if plan is None:
             return render_template("index.html", attributes=attributes, regions=regions,
                                    min_date=min_date, max_date=max_date, graph_types=graph_types,
                                    all_columns=all_columns, groupable_fields=groupable_fields,
                                    error="No join path found between selected tables.")
 
-        from_clause = all_tables[path[0]]
-        for i in range(1, len(path)):
-            left = path[i - 1]
-            right = path[i]
-            join_condition = join_graph[left][right]
-            from_clause = from_clause.join(all_tables[right], join_condition)
-
-        columns = []
-        group_columns = []
-        agg_column = None
-
-        # Handle group_by field
-        if group_by_field:
-            for table in selected_tables:
-                if group_by_field in table.c:
-                    group_col = table.c[group_by_field]
-                    group_columns.append(group_col)
-                    columns.append(group_col)
-                    break
-
-        # Handle aggregation
-        if aggregate and aggregate_field:
-            for table_name, table in all_tables.items():
-                if aggregate_field in table.c:
-                    target_col = table.c[aggregate_field]
-                    if aggregate == 'sum':
-                        agg_column = func.sum(target_col).label(f"sum_{aggregate_field}")
-                    elif aggregate == 'avg':
-                        agg_column = func.avg(target_col).label(f"avg_{aggregate_field}")
-                    elif aggregate == 'count':
-                        agg_column = func.count(target_col).label(f"count_{aggregate_field}")
-                    break
-            if agg_column is not None:
-                columns.append(agg_column)
-        else:
-            for field in selected_fields:
-                for table in selected_tables:
-                    if field in table.c:
-                        col = table.c[field]
-                        if col not in columns:
-                            columns.append(col)
-                        break
-
-        # Build query
-        query = select(*columns).select_from(from_clause)
-        if distinct:
-            query = query.distinct()
-
-        filters = []
-        if region:
-            filters.append(all_tables["sales"].c.region == region)
-        if start_date and end_date:
-            filters.append(all_tables["sales"].c.order_date.between(start_date, end_date))
-        if filters:
-            query = query.where(and_(*filters))
-
-        if group_columns:
-            query = query.group_by(*group_columns)
-
-        if sort_field:
-            for table in selected_tables:
-                if sort_field in table.c:
-                    sort_col = table.c[sort_field]
-                    query = query.order_by(asc(sort_col) if sort_order == 'asc' else desc(sort_col))
-                    break
-
-        query_string = str(query)
-        print("\n[Generated SQL Query by DQBE]:\n", query_string)
-
-        with engine.connect() as conn:
-            result = conn.execute(query)
-            report_data = result.mappings().all()
+        if plan.uses_rollup:
+            rollups.refresh(engine)
+
+        query_string = plan.sql
+        instrumentation.log.debug("Generated SQL: %s %s", query_string, params)
+
+        if request.form.get('preview') == 'on':
+            # Fast preview: the group-by is estimated from the sales sample;
+            # anything the sample cannot answer (or the rollup answers
+            # exactly) runs as usual
+            estimates = None
+            if sales_sample is not None and not plan.uses_rollup:
+                try:
+                    estimates = sales_sample.estimate(read_engine, shape, params, all_tables, join_index)
+                except Exception as e:
+                    instrumentation.log.info("Preview is running the exact query instead: %s", e)
+
+            if estimates is not None:
+                exact_request = request.form.to_dict(flat=False)
+                exact_request.pop('preview', None)
+                preview = {
+                    'columns': plan.columns,
+                    'rows': estimates[:PREVIEW_TABLE_ROWS],
+                    'groups': len(estimates),
+                    'percent': round(sales_sample.fraction * 100, 2),
+                    'confidence': sampling.CONFIDENCE,
+                    'exact_request': exact_request,
+                }
+                chart_data = None
+                if estimates:
+                    labels, values = chart_series.to_series(plan.columns, [row[:2] for row in estimates])
+                    intervals = {str(label): half for label, _, half, _ in estimates}
+                    chart_note = chart_series.dropped_note(selected_graph, len(labels), plan.columns[-1])
+                    labels, values = chart_series.reduce_series(selected_graph, labels, values,
+                                                                value_field=plan.columns[-1])
+                    chart_data = {
+                        'labels': labels,
+                        'values': values,
+                        'intervals': intervals,
+                        'label': f"{plan.columns[-1]} (estimate)",
+                        'graph_type': selected_graph,
+                        'label_field': plan.columns[0],
+                        'value_field': plan.columns[-1],
+                        'query': query_string,
+                        'params': params,
+                        'shape': shape
+                    }
+                return render_template("index.html", preview=preview, attributes=attributes, regions=regions,
+                                       min_date=min_date, max_date=max_date, graph_types=graph_types,
+                                       chart_data=chart_data, query_string=query_string, chart_note=chart_note,
+                                       all_columns=all_columns, groupable_fields=groupable_fields)
+            if plan.uses_rollup:
+                preview_note = "The daily rollup answers this report exactly, so it ran without sampling."
+            else:
+                preview_note = ("Fast preview covers SUM, AVG and COUNT grouped by one column over sales; "
+                                "this report ran exactly.")
+
+        if request.form.get('background') == 'on':
+            # Hand the query to the job pool; the page polls it for rows and the chart
+            job = job_manager.submit(read_engine, current_owner(), plan.sql, params,
+                                     finish=job_chart(selected_graph))
+            if job is None:
+                return render_template("index.html", attributes=attributes, regions=regions,
+                                       min_date=min_date, max_date=max_date, graph_types=graph_types,
+                                       all_columns=all_columns, groupable_fields=groupable_fields,
+                                       error=JOB_LIMIT_ERROR)
+            job = job.info()
+            if plan.columns:
+                chart_data = {
+                    'labels': [],
+                    'values': [],
+                    'label': str(plan.columns[-1]),
+                    'graph_type': selected_graph,
+                    'label_field': plan.columns[0],
+                    'value_field': plan.columns[-1],
+                    'query': query_string,
+                    'params': params,
+                    'shape': shape
+                }
+            return render_template("index.html", job=job, attributes=attributes, regions=regions,
+                                   min_date=min_date, max_date=max_date, graph_types=graph_types,
+                                   chart_data=chart_data, query_string=query_string,
+                                   all_columns=all_columns, groupable_fields=groupable_fields)
+
+        page_request = request.form.to_dict(flat=False)
+        page_sql, page_key, tiebreak = page_source(shape, plan)
+        page_order = shape['sort_order'] or 'asc'
+
+        # An aggregate the mirror or the partitions answer runs there once;
+        # the table and the chart are both cut from that result
+        mirrored = computed_result(shape, plan, params)
+
+        with read_engine.connect() as conn:
+            # Only the first page goes into the table; more pages are fetched on demand
+            if mirrored is not None:
+                report_page = pagination.page_rows(*mirrored, key=page_key, order=page_order, tiebreak=tiebreak)
+            else:
+                report_page = pagination.fetch_page(conn, page_sql, params, key=page_key, order=page_order,
+                                                    tiebreak=tiebreak)
+
+            advisor.observe(conn, shape, plan, params, all_tables, join_index)
+
+            if mirrored is None and report_page['next'] is None:
+                # The first page is the whole result; chart it as it is
+                mirrored = report_page['columns'], report_page['rows']
+
+            if mirrored is not None:
+                columns, rows = mirrored
+            else:
+                # Only the first CHART_ROW_LIMIT rows are read for the chart
+                result = plan.execute(conn, params)
+                columns = list(result.keys())
+                rows = result.fetchmany(CHART_ROW_LIMIT + 1)
+                result.close()
+                if len(rows) > CHART_ROW_LIMIT:
+                    rows = rows[:CHART_ROW_LIMIT]
+                    chart_note = f"The chart shows the first {CHART_ROW_LIMIT:,} rows of the result."
 
         # Prepare chart data
-        if report_data:
-            first_key = list(report_data[0].keys())[0]
-            last_key = list(report_data[0].keys())[-1]
-            labels = [str(row[first_key]) for row in report_data]
-            raw_values = [row[last_key] for row in report_data]
+        if rows:
+            first_key = columns[0]
+            last_key = columns[-1]
 
             try:
-                values = [float(v) if v is not None else 0.0 for v in raw_values]
+                labels, values = chart_series.to_series(columns, rows, strict=True)
+                dropped = chart_series.dropped_note(selected_graph, len(labels), last_key)
+                if dropped:
+                    chart_note = f"{chart_note} {dropped}" if chart_note else dropped
+                labels, values = chart_series.reduce_series(selected_graph, labels, values, value_field=last_key)
                 chart_data = {
                     'labels': labels,
                     'values': values,
@@ -272,7 +473,9 @@ def index():
                     'graph_type': selected_graph,
                     'label_field': first_key,
                     'value_field': last_key,
-                    'query': query_string
+                    'query': query_string,
+                    'params': params,
+                    'shape': shape
                 }
             except (ValueError, TypeError):
                 chart_data = None
@@ -281,7 +484,8 @@ def index():
 
     return render_template(
         "index.html",
-        report_data=report_data,
+        report_page=report_page,
+        page_request=page_request,
         attributes=attributes,
         regions=regions,
         min_date=min_date,
@@ -290,15 +494,141 @@ def index():
         chart_data=chart_data,
         query_string=query_string,
         all_columns=all_columns,
-        groupable_fields=groupable_fields
+        groupable_fields=groupable_fields,
+        preview_note=preview_note,
+        chart_note=chart_note
     )
 
+@app.route('/api/query/rows', methods=['POST'])
+def query_rows():
+    shape, params = query_builder.shape_from_form(request.form, date_bounds(), all_tables)
+    plan = plan_cache.get(shape, all_tables, join_index)
+    if plan is None:
+        return responses.json_response({'error': "No join path found between selected tables."}, 400)
+
+    if plan.uses_rollup:
+        rollups.refresh(engine)
+    page_sql, page_key, tiebreak = page_source(shape, plan)
+    page_args = dict(key=page_key, order=shape['sort_order'] or 'asc', cursor=request.form.get('cursor') or None,
+                     limit=pagination.page_limit(request.form.get('limit')), tiebreak=tiebreak)
+    try:
+        computed = computed_result(shape, plan, params)
+        if computed is not None:
+            # Pages of an aggregate answered off SQLite are cut from its result
+            page = pagination.page_rows(*computed, **page_args)
+            if request.form.get('count'):
+                total = len(computed[1])
+                page.update(total=min(total, pagination.COUNT_CAP), total_is_lower_bound=total > pagination.COUNT_CAP)
+        else:
+            with read_engine.connect() as conn:
+                page = pagination.fetch_page(conn, page_sql, params, **page_args)
+                if request.form.get('count'):
+                    page.update(pagination.approximate_count(conn, plan.sql, params))
+    except ValueError as e:
+        return responses.json_response({'error': str(e)}, 400)
+
+    return responses.json_response(page)
+
+@app.route('/jobs', methods=['GET', 'POST'])
+def query_jobs():
+    owner = current_owner()
+    if request.method == 'GET':
+        return jsonify(jobs=[job.info() for job in job_manager.list(owner)])
+
+    # Either a saved report (report_id) or a builder form is run in the background
+    report_id = request.form.get('report_id', type=int)
+    if report_id is not None:
+        rpt = report_store.get_item(engine, owner, 'report', report_id)
+        if rpt is None:
+            return jsonify(error="Report not found"), 404
+        rollups.refresh_if_used(engine, [rpt['query']])
+        sql, params, graph_type = rpt['query'], rpt.get('params'), rpt.get('graph_type')
+    else:
+        shape, params = query_builder.shape_from_form(request.form, date_bounds(), all_tables)
+        plan = plan_cache.get(shape, all_tables, join_index)
+        if plan is None:
+            return jsonify(error="No join path found between selected tables."), 400
+        if plan.uses_rollup:
+            rollups.refresh(engine)
+        sql, graph_type = plan.sql, request.form.get('graph_type')
+
+    job = job_manager.submit(read_engine, owner, sql, params,
+                             timeout=request.form.get('timeout', type=int),
+                             finish=job_chart(graph_type))
+    if job is None:
+        return jsonify(error=JOB_LIMIT_ERROR), 429
+    return jsonify(job.info()), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_manager.get(current_owner(), job_id)
+    if job is None:
+        return jsonify(error="Job not found"), 404
+    return jsonify(job.info())
+
+@app.route('/jobs/<job_id>/rows')
+def job_rows(job_id):
+    job = job_manager.get(current_owner(), job_id)
+    if job is None:
+        return jsonify(error="Job not found"), 404
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    return jsonify(job_manager.page(job, offset, pagination.page_limit(request.args.get('limit'))))
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_manager.cancel(current_owner(), job_id)
+    if job is None:
+        return jsonify(error="Job not found"), 404
+    return jsonify(job.info())
+
+@app.route('/query_cache_stats')
+def query_cache_stats():
+    return jsonify(plan_cache.stats())
+
+@app.route('/metrics')
+def metrics():
+    snapshot = instrumentation.metrics.snapshot()
+    snapshot['plan_cache'] = plan_cache.stats()
+    snapshot['incremental'] = incremental.stats()
+    snapshot['fragment_cache'] = fragment_cache.stats()
+    snapshot['schema_catalog'] = catalog.stats()
+    if sales_sample is not None:
+        snapshot['sample'] = sales_sample.stats()
+    if columnar_backend is not None:
+        snapshot['columnar'] = columnar_backend.stats()
+    if partition_store is not None:
+        snapshot['partitions'] = partition_store.stats()
+    return jsonify(snapshot)
+
+@app.route('/index_advisor')
+def index_recommendations():
+    with read_engine.connect() as conn:
+        recommendations = advisor.recommendations(conn)
+    return jsonify(recommendations=recommendations, plans=advisor.observed_plans())
+
+@app.route('/index_advisor/create', methods=['POST'])
+def create_indexes():
+    # Creates the recommended indexes named in the form, or all with name=all
+    names = request.form.getlist('name')
+    created = advisor.create(engine, 'all' if 'all' in names else names)
+    return jsonify(created=created)
+
+@app.route('/partitions/compact', methods=['POST'])
+def compact_partitions():
+    # Syncs the sales partitions and moves the cold months into read-only files
+    if partition_store is None:
+        return jsonify(error="Partitioning is not enabled (DQBE_PARTITIONS)."), 400
+    partition_store.sync()
+    return jsonify(compacted=partition_store.compact())
+
 @app.route('/add_to_report', methods=['POST'])
 def add_to_report():
     sql_query = request.form.get('sql_query')
     label_field = request.form.get('label_field')
     value_field = request.form.get('value_field')
     graph_type_raw = request.form.get('graph_type')
+    sql_params = json.loads(request.form.get('sql_params') or '{}')
+    sql_shape = json.loads(request.form.get('sql_shape') or 'null')
 
     # ✅ Map user-friendly chart names to Chart.js-compatible types
     type_mapping = {
@@ -311,141 +641,128 @@ def add_to_report():
     }
     graph_type = type_mapping.get(graph_type_raw.strip(), "bar")  # Default to 'bar' if invalid
 
-    print("Received graph type:", graph_type_raw, "→ Mapped to:", graph_type)
-
     if not all([sql_query, label_field, value_field]):
         return "Missing data", 400
 
-    if 'reports' not in session:
-        session['reports'] = []
-
-    reports = session['reports']
-    reports.append({
+    report_store.add_item(engine, current_owner(), 'report', {
         'query': sql_query,
+        'params': sql_params,
+        'shape': sql_shape,
         'label_field': label_field,
         'value_field': value_field,
         'graph_type': graph_type
     })
-    session['reports'] = reports
-    session.modified = True
 
     return redirect(url_for('view_reports'))
 
 @app.route('/view_reports')
 def view_reports():
-    reports = session.get('reports', [])
-    rendered_reports = []
-
-    with engine.connect() as conn:
-        for idx, rpt in enumerate(reports):
-            try:
-                result = conn.execute(text(rpt['query']))
-                rows = result.mappings().all()
-
-                if not rows:
-                    continue
-
-                columns = list(rows[0].keys())
-                data = [dict(row) for row in rows]
-
-                labels = [str(row[rpt['label_field']]) for row in rows]
-                values = [float(row[rpt['value_field']]) if isinstance(row[rpt['value_field']], (int, float)) else 0 for row in rows]
-
-                # print(rpt.get('graph_type'))
-                rendered_reports.append({
-                    'index': idx + 1,
-                    'query': rpt['query'],
-                    'label_field': rpt['label_field'],
-                    'value_field': rpt['value_field'],
-                    'graph_type': rpt.get('graph_type'),
-                    'labels': labels,
-                    'values': values,
-                    'columns': columns,
-                    'data': data
-                })
-            except Exception as e:
-                print(f"[Report {idx+1}] Failed: {e}")
-                continue
-
-    return render_template('report_preview.html', reports=rendered_reports)
+    # Page shell; each report fetches its chart series and first page of rows
+    # as it scrolls into view
+    reports = report_store.list_items(engine, current_owner(), 'report')
+    etag = page_cache.shell_etag('report', reports, table_versions.epoch)
+    if request.if_none_match.contains_weak(etag):
+        fragment_cache.record('not_modified')
+        return page_cache.not_modified(etag)
+    return page_cache.conditional(make_response(render_template('report_preview.html', reports=reports)), etag)
+
+@app.route('/api/report/<int:report_id>/chart')
+def report_chart(report_id):
+    rpt = report_store.get_item(engine, current_owner(), 'report', report_id)
+    if rpt is None:
+        return responses.json_response({'error': "Report not found"}, 404)
+    return series_response('report', rpt)
+
+@app.route('/api/report/<int:report_id>/rows')
+def report_rows(report_id):
+    rpt = report_store.get_item(engine, current_owner(), 'report', report_id)
+    if rpt is None:
+        return responses.json_response({'error': "Report not found"}, 404)
+
+    # A page is fixed by the report, its query arguments and the data versions
+    versions = table_versions.snapshot(read_engine, all_tables)
+    etag = page_cache.fragment_key('report-rows', sorted(request.args.items()), rpt, versions, all_tables)
+    if request.if_none_match.contains_weak(etag):
+        fragment_cache.record('not_modified')
+        return page_cache.not_modified(etag)
+
+    body = fragment_cache.get(etag)
+    if body is None:
+        rollups.refresh_if_used(engine, [rpt['query']])
+        try:
+            with read_engine.connect() as conn:
+                page = pagination.fetch_page(
+                    conn, rpt['query'], rpt.get('params'),
+                    key=request.args.get('key') or None,
+                    order=request.args.get('order', 'asc'),
+                    cursor=request.args.get('cursor') or None,
+                    limit=pagination.page_limit(request.args.get('limit')))
+                if request.args.get('count'):
+                    page.update(pagination.approximate_count(conn, rpt['query'], rpt.get('params')))
+        except ValueError as e:
+            return responses.json_response({'error': str(e)}, 400)
+        body = responses.dumps(page)
+        fragment_cache.put(etag, body)
+
+    return page_cache.conditional(responses.json_response(body), etag)
 
 @app.route('/remove_report', methods=['POST'])
 def remove_report():
-    idx = int(request.form.get('report_index'))
-    if 'reports' in session and 0 <= idx < len(session['reports']):
-        session['reports'].pop(idx)
-        session.modified = True
+    report_id = int(request.form.get('report_id'))
+    report_store.remove_item(engine, current_owner(), 'report', report_id)
+    incremental.forget(engine, report_id)
     return redirect(url_for('view_reports'))
 
 
 @app.route('/save_report', methods=['POST'])
 def save_report():
-    idx = int(request.form.get('report_index'))
-    # TODO: Implement saving logic (to DB or export)
-    print(f"Save triggered for report index {idx}")
+    report_id = int(request.form.get('report_id'))
+    report_store.mark_saved(engine, current_owner(), 'report', report_id)
     return redirect(url_for('view_reports'))
 
 
 @app.route('/export_excel')
 def export_excel():
-    reports = session.get('reports', [])
+    reports = report_store.list_items(engine, current_owner(), 'report')
+
+    if not reports:
+        return "No reports to export", 400
+
+    rollups.refresh_if_used(engine, [rpt['query'] for rpt in reports])
+    return Response(
+        export_stream.iter_xlsx(read_engine, reports),
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers={'Content-Disposition': 'attachment; filename=Reports.xlsx'}
+    )
+
+
+@app.route('/export_csv')
+def export_csv():
+    reports = report_store.list_items(engine, current_owner(), 'report')
+
+    if not reports:
+        return "No reports to export", 400
+
+    rollups.refresh_if_used(engine, [rpt['query'] for rpt in reports])
+    return Response(
+        export_stream.iter_csv(read_engine, reports),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=Reports.csv'}
+    )
+
+
+@app.route('/export_ndjson')
+def export_ndjson():
+    reports = report_store.list_items(engine, current_owner(), 'report')
 
     if not reports:
         return "No reports to export", 400
 
-    output = io.BytesIO()
-
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        for idx, rpt in enumerate(reports):
-            sheet_name = f"Report{idx+1}"[:31]
-
-            # Safely get the data
-            report_data = rpt.get('data')
-            if not report_data:
-                # Skip this report if there's no data
-                continue
-
-            df = pd.DataFrame(report_data)
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
-
-            # Write metadata
-            meta_start_row = len(df) + 2
-            metadata = {
-                'Query': rpt.get('query', 'N/A'),
-                'Label Field': rpt.get('label_field', 'N/A'),
-                'Value Field': rpt.get('value_field', 'N/A'),
-                'Chart Type': rpt.get('graph_type', 'N/A')
-            }
-            meta_df = pd.DataFrame([metadata])
-            meta_df.to_excel(writer, sheet_name=sheet_name, startrow=meta_start_row, index=False)
-
-            # Add chart if at least 2 columns
-            if df.shape[1] >= 2 and len(df) > 0:
-                chart_type = rpt.get('graph_type', 'bar').lower()
-                chart_map = {'bar': 'column', 'line': 'line', 'pie': 'pie'}
-                excel_chart_type = chart_map.get(chart_type, 'column')
-
-                workbook = writer.book
-                worksheet = writer.sheets[sheet_name]
-
-                chart = workbook.add_chart({'type': excel_chart_type})
-
-                chart.add_series({
-                    'categories': [sheet_name, 1, 0, len(df), 0],
-                    'values':     [sheet_name, 1, 1, len(df), 1],
-                    'name':       rpt.get('value_field', 'Values')
-                })
-
-                chart.set_title({'name': f"{rpt.get('label_field')} vs {rpt.get('value_field')}"})
-                worksheet.insert_chart('E2', chart)
-
-    output.seek(0)
-
-    return send_file(
-        output,
-        download_name="Reports.xlsx",
-        as_attachment=True,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    rollups.refresh_if_used(engine, [rpt['query'] for rpt in reports])
+    return Response(
+        export_stream.iter_ndjson(read_engine, reports),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': 'attachment; filename=Reports.ndjson'}
     )
 
 
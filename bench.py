@@ -0,0 +1,258 @@
+# Benchmark harness for the DQBE request paths.
+#
+# Seeds a database per scale with generate_data (reused on later runs unless
+# --fresh), then drives the Flask test client through representative builder
+# POSTs, the dashboard, the reports page and the Excel export. Each scale runs
+# in its own process so the app is configured for that database and memory
+# figures are not shared between scales. Results (latency percentiles,
+# throughput, peak traced memory and queries per request) are written as JSON
+# so runs can be compared.
+#
+#   python bench.py --scales 10000,1000000,10000000 --repeat 20 --output bench.json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import generate_data
+
+DEFAULT_SCALES = "10000,1000000"
+PERCENTILES = (50, 90, 95, 99)
+
+# name -> builder form; dates are filled in from the data
+INDEX_SCENARIOS = {
+    'join': {'table1': 'sales', 'table2': 'customers', 'fields': ['customer_name', 'product', 'amount', 'email']},
+    'group_aggregate': {'table1': 'sales', 'aggregate': 'sum', 'aggregate_field': 'amount', 'group_by': 'region'},
+    'join_group_aggregate': {'table1': 'sales', 'table2': 'products', 'aggregate': 'avg',
+                             'aggregate_field': 'amount', 'group_by': 'category'},
+    'distinct': {'table1': 'sales', 'fields': ['region', 'product'], 'distinct': 'on'},
+    'sort': {'table1': 'sales', 'fields': ['customer_name', 'amount'], 'sort_field': 'amount', 'sort_order': 'desc'},
+    'date_filter': {'table1': 'sales', 'aggregate': 'count', 'aggregate_field': 'amount', 'group_by': 'order_date',
+                    'dates': 90},
+}
+
+CHART_GROUPS = ('region', 'product', 'order_date', 'customer_name')
+CHART_AGGREGATES = ('sum', 'count', 'avg')
+
+
+def seed(path, rows, seed_value, workers, fresh):
+    # Reuses a database that already holds the requested number of rows
+    if os.path.exists(path) and not fresh:
+        conn = sqlite3.connect(path)
+        try:
+            existing = conn.execute("SELECT count(*) FROM sales").fetchone()[0]
+        except sqlite3.Error:
+            existing = None
+        conn.close()
+        if existing == rows:
+            return 0.0
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    started = time.perf_counter()
+    generate_data.load(path, rows=rows, seed=seed_value, workers=workers, verbose=False)
+    return time.perf_counter() - started
+
+
+def summarize(latencies, elapsed):
+    ms = np.array(latencies) * 1000
+    summary = {
+        'requests': len(latencies),
+        'mean_ms': round(float(ms.mean()), 3),
+        'max_ms': round(float(ms.max()), 3),
+        'throughput_rps': round(len(latencies) / elapsed, 3) if elapsed else None,
+    }
+    summary.update({f"p{p}_ms": round(float(v), 3) for p, v in zip(PERCENTILES, np.percentile(ms, PERCENTILES))})
+    return summary
+
+
+def run_scenario(client, metrics, request, repeat):
+    # The first request is reported separately as the cold run; the timed
+    # runs follow, then one traced run for peak memory
+    def query_count():
+        histograms = metrics.snapshot()['histograms'].get('query_ms', {})
+        return sum(histogram['count'] for histogram in histograms.values())
+
+    errors = 0
+    started = time.perf_counter()
+    response = request(client)
+    cold = time.perf_counter() - started
+    errors += response.status_code >= 400
+
+    queries_before = query_count()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        response = request(client)
+        response.get_data()
+        latencies.append(time.perf_counter() - t0)
+        errors += response.status_code >= 400
+    elapsed = time.perf_counter() - started
+    queries = query_count() - queries_before
+
+    tracemalloc.start()
+    request(client).get_data()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = summarize(latencies, elapsed)
+    result.update({
+        'cold_ms': round(cold * 1000, 3),
+        'queries_per_request': round(queries / repeat, 2),
+        'peak_traced_mb': round(peak / 2 ** 20, 3),
+        'errors': errors,
+    })
+    return result
+
+
+def fetch_all(client, urls):
+    # The slowest card decides when a page is complete; returns the worst response
+    return max((client.get(url) for url in urls), key=lambda response: response.status_code)
+
+
+def run_scale(database, repeat, charts):
+    # Runs in a child process: the app reads its database from the environment at import
+    os.environ['DQBE_DATABASE'] = database
+    os.environ.pop('DQBE_COLUMNAR', None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as dqbe
+        import instrumentation
+
+    client = dqbe.app.test_client()
+    client.get('/view_dashboard')
+    with client.session_transaction() as session:
+        owner = session['owner_id']
+
+    min_date, max_date = dqbe.date_bounds()
+
+    def builder_form(spec):
+        form = {key: value for key, value in spec.items() if key != 'dates'}
+        if 'dates' in spec and max_date:
+            start = np.datetime64(str(max_date)[:10]) - np.timedelta64(spec['dates'], 'D')
+            form.update(start_date=str(start), end_date=str(max_date)[:10])
+        form.setdefault('graph_type', 'Bar Chart')
+        return form
+
+    def save_item(kind, spec, graph_type):
+        from werkzeug.datastructures import MultiDict
+        shape, params = dqbe.query_builder.shape_from_form(MultiDict(builder_form(spec)), (min_date, max_date),
+                                                            dqbe.all_tables)
+        plan = dqbe.plan_cache.get(shape, dqbe.all_tables, dqbe.join_index)
+        dqbe.report_store.add_item(dqbe.engine, owner, kind, {
+            'query': plan.sql, 'params': params, 'shape': shape, 'graph_type': graph_type,
+            'label_field': plan.columns[0], 'value_field': plan.columns[-1],
+        })
+
+    for n in range(charts):
+        save_item('chart', {'table1': 'sales', 'table2': 'customers' if n % 2 else None,
+                            'aggregate': CHART_AGGREGATES[n % len(CHART_AGGREGATES)], 'aggregate_field': 'amount',
+                            'group_by': CHART_GROUPS[n % len(CHART_GROUPS)]}, 'bar')
+    for spec in list(INDEX_SCENARIOS.values())[:3]:
+        save_item('report', spec, 'bar')
+
+    chart_urls = [f"/api/chart/{chart['id']}" for chart in dqbe.report_store.list_items(dqbe.engine, owner, 'chart')]
+    report_urls = [url for rpt in dqbe.report_store.list_items(dqbe.engine, owner, 'report')
+                   for url in (f"/api/report/{rpt['id']}/chart", f"/api/report/{rpt['id']}/rows?count=1")]
+
+    scenarios = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, spec in INDEX_SCENARIOS.items():
+            form = builder_form(spec)
+            scenarios[f"index_{name}"] = run_scenario(
+                client, instrumentation.metrics, lambda c, form=form: c.post('/', data=form), repeat)
+        scenarios['view_dashboard'] = run_scenario(
+            client, instrumentation.metrics, lambda c: c.get('/view_dashboard'), repeat)
+        scenarios['view_reports'] = run_scenario(
+            client, instrumentation.metrics, lambda c: c.get('/view_reports'), repeat)
+        # What the dashboard and reports shells fetch once every card is in view
+        scenarios['dashboard_data'] = run_scenario(
+            client, instrumentation.metrics, lambda c: fetch_all(c, chart_urls), repeat)
+        scenarios['report_data'] = run_scenario(
+            client, instrumentation.metrics, lambda c: fetch_all(c, report_urls), repeat)
+        scenarios['export_excel'] = run_scenario(
+            client, instrumentation.metrics, lambda c: c.get('/export_excel'), max(1, repeat // 5))
+
+    return scenarios
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the DQBE request paths at several data scales.")
+    parser.add_argument('--scales', default=DEFAULT_SCALES, help="comma-separated sales row counts")
+    parser.add_argument('--repeat', type=int, default=20, help="timed requests per scenario")
+    parser.add_argument('--charts', type=int, default=8, help="charts on the benchmarked dashboard")
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'dqbe-bench'),
+                        help="where the seeded databases are kept between runs")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="processes seeding data")
+    parser.add_argument('--seed', type=int, default=42, help="random seed for the data")
+    parser.add_argument('--fresh', action='store_true', help="regenerate the databases")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_scale(args.child, args.repeat, args.charts)))
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': args.repeat,
+            'charts': args.charts,
+            'seed': args.seed,
+        },
+        'scales': {},
+    }
+
+    for rows in [int(scale) for scale in args.scales.split(',') if scale.strip()]:
+        database = os.path.join(args.workdir, f"bench_{rows}.db")
+        print(f"Seeding {rows:,} rows...", file=sys.stderr, flush=True)
+        seed_seconds = seed(database, rows, args.seed, args.workers, args.fresh)
+
+        print(f"Benchmarking {rows:,} rows...", file=sys.stderr, flush=True)
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', database,
+                                '--repeat', str(args.repeat), '--charts', str(args.charts)],
+                               capture_output=True, text=True)
+        if child.returncode != 0:
+            report['scales'][str(rows)] = {'error': child.stderr.strip().splitlines()[-1:]}
+            continue
+        report['scales'][str(rows)] = {
+            'seed_seconds': round(seed_seconds, 3),
+            'db_bytes': os.path.getsize(database),
+            'scenarios': json.loads(child.stdout.strip().splitlines()[-1]),
+        }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# Dashboard refresh engine: runs saved chart queries concurrently on a bounded
+# worker pool and keeps their results in a TTL/LRU cache keyed by the
+# normalized SQL text, its bound parameters and a data-version stamp of the
+# database.
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+import db
+
+MAX_WORKERS = 4
+CACHE_TTL = 300  # seconds
+CACHE_MAX_ENTRIES = 256
+
+_quoted = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_sql(sql):
+    # Collapse whitespace outside of quoted literals so cosmetic differences
+    # in the saved SQL text still share one cache entry
+    parts = _quoted.split(sql.strip().rstrip(';'))
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i])
+    return "".join(parts).strip()
+
+
+def data_version(engine):
+    # SQLite bumps the mtime/size of the database (or its WAL) on every
+    # commit, which is enough to tell whether cached results can be reused
+    path = db.database_path(engine)
+    if not path or path == ':memory:':
+        return None
+    stamp = []
+    for suffix in ('', '-wal'):
+        try:
+            st = os.stat(path + suffix)
+        except OSError:
+            continue
+        stamp.append((st.st_mtime_ns, st.st_size))
+    return tuple(stamp)
+
+
+class ResultCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+result_cache = ResultCache()
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='dqbe-refresh')
+
+
+def series_sql(sql, label_field, value_field):
+    # Narrows a saved query to the two charted columns so only those are
+    # fetched and cached
+    def quote(name):
+        return '"' + name.replace('"', '""') + '"'
+    return f"SELECT {quote(label_field)}, {quote(value_field)} FROM ({sql.strip().rstrip(';')}) AS dqbe_series"
+
+
+def _run_query(engine, sql, params):
+    with engine.connect() as conn:
+        result = conn.execute(text(sql), params)
+        columns = list(result.keys())
+        rows = [tuple(row) for row in result]
+    return columns, rows
+
+
+def refresh(engine, queries):
+    # Takes (sql, params) pairs and returns one (columns, rows) tuple per
+    # query, or the exception raised by that query. Cached results are
+    # returned as-is; the remaining queries run in parallel so the caller
+    # only waits for the slowest of them.
+    version = data_version(engine)
+    results = [None] * len(queries)
+    pending = OrderedDict()
+
+    for i, (sql, params) in enumerate(queries):
+        params = params or {}
+        key = (normalize_sql(sql), tuple(sorted(params.items())), version)
+        cached = result_cache.get(key)
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.setdefault(key, []).append(i)
+
+    futures = {key: _executor.submit(_run_query, engine, key[0], dict(key[1])) for key in pending}
+    for key, future in futures.items():
+        try:
+            value = future.result()
+            result_cache.put(key, value)
+        except Exception as e:
+            value = e
+        for i in pending[key]:
+            results[i] = value
+
+    return results
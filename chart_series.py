@@ -0,0 +1,171 @@
+# Chart series: columnar conversion of result rows into labels/values, and
+# reduction before serialization so a chart payload stays bounded whatever
+# the row count: LTTB downsampling for line/scatter charts, top-N plus an
+# "Other" bucket for categorical charts, and SQL date bucketing
+# (day/week/month) picked from the size of the range.
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, literal_column, Date, DateTime
+
+MAX_POINTS = 2000
+PIE_TOP_N = 10
+BAR_TOP_N = 50
+DATE_BUCKET_POINTS = 400
+
+DATE_BUCKET_FORMATS = {
+    'week': '%Y-W%W',
+    'month': '%Y-%m',
+}
+
+_line_types = ('line', 'scatter')
+_pie_types = ('pie', 'doughnut', 'polararea', 'polar')
+
+
+def to_series(columns, rows, label_field=None, value_field=None, strict=False):
+    # Converts result rows into (labels, values) arrays in one vectorized pass:
+    # labels are stringified like str(), values coerced to float with
+    # NULL/NaN as 0. Label/value default to the first/last column. With
+    # strict=True a non-numeric value raises ValueError instead of becoming 0.
+    n = len(rows)
+    if not n or not columns:
+        return np.empty(0, dtype=str), np.empty(0, dtype=float)
+
+    data = np.array(rows, dtype=object).reshape(n, len(columns))
+    label_idx = columns.index(label_field) if label_field in columns else (0 if label_field is None else None)
+    value_idx = columns.index(value_field) if value_field in columns else (len(columns) - 1 if value_field is None else None)
+
+    if label_idx is None:
+        labels = np.full(n, '')
+    else:
+        labels = data[:, label_idx].astype(str)
+
+    if value_idx is None:
+        return labels, np.zeros(n)
+
+    raw = pd.Series(data[:, value_idx])
+    values = pd.to_numeric(raw, errors='coerce')
+    if strict and (values.isna() & raw.notna()).any():
+        raise ValueError(f"Non-numeric values in column {columns[value_idx]}")
+    return labels, values.fillna(0).to_numpy(dtype=float)
+
+
+def chart_kind(graph_type):
+    # Maps both builder names ("Line Chart") and Chart.js names ("polarArea")
+    name = (graph_type or '').strip().lower()
+    if any(name.startswith(t) for t in _line_types):
+        return 'line'
+    if any(name.startswith(t) for t in _pie_types):
+        return 'pie'
+    return 'bar'
+
+
+def lttb(values, threshold):
+    # Largest-Triangle-Three-Buckets over (index, value); returns the indices
+    # of the points to keep, first and last always included
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    y = np.asarray(values, dtype=float)
+    x = np.arange(n, dtype=float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    keep = np.empty(threshold, dtype=int)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+
+    return keep
+
+
+def folds_into_other(value_field):
+    # The builder's "<aggregate>_<field>" columns past the top N are summed
+    # into "Other", except averages, which cannot be combined without their
+    # counts and are left out instead
+    return not str(value_field or '').lower().startswith('avg_')
+
+
+def top_n_other(labels, values, n, other=True):
+    # Keeps the n largest values in their original order and folds the rest
+    # into a trailing "Other" entry (or drops them without other)
+    labels = np.asarray(labels)
+    y = np.asarray(values, dtype=float)
+    if len(y) <= n:
+        return labels.tolist(), y.tolist()
+    top = np.sort(np.argpartition(-y, n - 1)[:n])
+    if not other:
+        return labels[top].tolist(), y[top].tolist()
+    mask = np.ones(len(y), dtype=bool)
+    mask[top] = False
+    return labels[top].tolist() + ['Other'], y[top].tolist() + [float(y[mask].sum())]
+
+
+def reduce_series(graph_type, labels, values, max_points=MAX_POINTS, value_field=None):
+    # Returns plain lists ready for the JSON encoder; value_field decides
+    # whether the tail becomes an "Other" entry (see folds_into_other)
+    kind = chart_kind(graph_type)
+    if kind == 'line':
+        labels = np.asarray(labels)
+        y = np.asarray(values, dtype=float)
+        if len(y) <= max_points:
+            return labels.tolist(), y.tolist()
+        keep = lttb(y, max_points)
+        return labels[keep].tolist(), y[keep].tolist()
+    return top_n_other(labels, values, _top_n(kind, max_points), folds_into_other(value_field))
+
+
+def _top_n(kind, max_points):
+    return min(PIE_TOP_N if kind == 'pie' else BAR_TOP_N, max_points)
+
+
+def dropped_note(graph_type, count, value_field, max_points=MAX_POINTS):
+    # The note shown with a chart of count values whose tail reduce_series
+    # left out, or None when nothing was dropped
+    kind = chart_kind(graph_type)
+    top_n = _top_n(kind, max_points)
+    if kind == 'line' or folds_into_other(value_field) or count <= top_n:
+        return None
+    return (f"The chart shows the {top_n} largest of {count:,} averages; averages cannot be combined "
+            f"into an \"Other\" entry, so the rest are left out.")
+
+
+def date_bucket(start_date, end_date):
+    # Day buckets while the range fits the point budget, then weeks, then months
+    try:
+        start = date.fromisoformat(str(start_date)[:10])
+        end = date.fromisoformat(str(end_date)[:10])
+    except (TypeError, ValueError):
+        return 'day'
+    days = abs((end - start).days) + 1
+    if days <= DATE_BUCKET_POINTS:
+        return 'day'
+    if days / 7 <= DATE_BUCKET_POINTS:
+        return 'week'
+    return 'month'
+
+
+def is_date_column(column):
+    return isinstance(column.type, (Date, DateTime)) or column.name.endswith('_date')
+
+
+def bucket_expression(column, bucket):
+    # The format is inlined rather than bound so saved SQL stays self-contained
+    fmt = DATE_BUCKET_FORMATS.get(bucket)
+    if fmt is None:
+        return column
+    return func.strftime(literal_column(f"'{fmt}'"), column)
@@ -0,0 +1,220 @@
+# Optional columnar execution backend. The tables reflected into all_tables
+# are mirrored into an embedded DuckDB database and the builder's aggregate
+# queries run there on vectorized scans, while SQLite stays the system of
+# record. The mirror follows SQLite through the change log (incremental.py):
+# a sync applies the inserts, updates and deletes since its last position and
+# recopies everything after a bulk load or a gap in the log. A background
+# thread syncs periodically, and a query syncs first when the mirror is
+# behind; while a long sync holds the mirror, queries run on SQLite.
+#
+# Enabled with DQBE_COLUMNAR=path/to/mirror.duckdb when the duckdb package is
+# installed; DQBE_COLUMNAR_SYNC sets the sync interval in seconds (default 60).
+
+import os
+import threading
+import time
+
+import pandas as pd
+from sqlalchemy import Integer, Float, Numeric, DateTime
+
+import chart_series
+import incremental
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+READER_NAME = "columnar"
+COPY_CHUNK = 100000
+SYNC_INTERVAL = 60
+
+
+def _duck_type(column):
+    if chart_series.is_date_column(column):
+        return 'TIMESTAMP' if isinstance(column.type, DateTime) else 'DATE'
+    if isinstance(column.type, Integer):
+        return 'BIGINT'
+    if isinstance(column.type, (Float, Numeric)):
+        return 'DOUBLE'
+    return 'VARCHAR'
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _json_list(values):
+    return "[" + ",".join(str(int(value)) for value in values) + "]"
+
+
+def _key(table):
+    # Rows are matched between SQLite and the mirror by a single integer key
+    keys = list(table.primary_key.columns)
+    if len(keys) == 1 and isinstance(keys[0].type, Integer):
+        return keys[0].name
+    return None
+
+
+class ColumnarBackend:
+    def __init__(self, path, engine, read_engine, tables):
+        self.engine = engine
+        self.read_engine = read_engine
+        self.tables = tables
+        self.con = duckdb.connect(path)
+        # SQLite's NULL ordering
+        self.con.execute("SET default_null_order = 'nulls_first_on_asc_last_on_desc'")
+        self.con.execute("CREATE TABLE IF NOT EXISTS dqbe_mirror_state (position BIGINT)")
+        self.position = self.con.execute("SELECT max(position) FROM dqbe_mirror_state").fetchone()[0]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.syncs = {'full': 0, 'incremental': 0}
+
+    def _cursor(self):
+        # DuckDB connections are not shared across threads; each gets its own cursor
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self._local.cursor = self.con.cursor()
+        return cursor
+
+    def _copy(self, sqlite_conn, table, where="", params=()):
+        # Appends SQLite rows to the mirror in chunks, casting each column to
+        # its mirror type (unparseable dates become NULL)
+        names = [column.name for column in table.columns]
+        casts = ", ".join(f"TRY_CAST({_quote(column.name)} AS {_duck_type(column)})" for column in table.columns)
+        result = sqlite_conn.exec_driver_sql(
+            f"SELECT {', '.join(_quote(name) for name in names)} FROM {_quote(table.name)} {where}", params)
+        while True:
+            rows = result.fetchmany(COPY_CHUNK)
+            if not rows:
+                break
+            chunk = pd.DataFrame.from_records(rows, columns=names).astype(object)
+            self.con.register('dqbe_chunk', chunk)
+            try:
+                self.con.execute(f"INSERT INTO {_quote(table.name)} SELECT {casts} FROM dqbe_chunk")
+            finally:
+                self.con.unregister('dqbe_chunk')
+
+    def _recreate(self, sqlite_conn, table):
+        columns = ", ".join(f"{_quote(column.name)} {_duck_type(column)}" for column in table.columns)
+        self.con.execute(f"CREATE OR REPLACE TABLE {_quote(table.name)} ({columns})")
+        self._copy(sqlite_conn, table)
+
+    def _apply(self, sqlite_conn, table, changes):
+        key = _key(table)
+        inserted = changes.get((table.name, 'I'), [])
+        updated = changes.get((table.name, 'U'), [])
+        deleted = changes.get((table.name, 'D'), [])
+        stale = list(set(updated) | set(deleted))
+        if stale:
+            self.con.execute(f"DELETE FROM {_quote(table.name)} WHERE {_quote(key)} IN (SELECT unnest(?))", [stale])
+        fresh = list((set(inserted) | set(updated)) - set(deleted))
+        for start in range(0, len(fresh), COPY_CHUNK):
+            batch = fresh[start:start + COPY_CHUNK]
+            # Already mirrored copies of re-inserted keys are replaced
+            self.con.execute(f"DELETE FROM {_quote(table.name)} WHERE {_quote(key)} IN (SELECT unnest(?))", [batch])
+            self._copy(sqlite_conn, table,
+                       f"WHERE {_quote(key)} IN (SELECT value FROM json_each(?))", (_json_list(batch),))
+
+    def sync(self, blocking=True):
+        # Returns True when the mirror is current; False when another sync is
+        # running and blocking is off
+        if not self._lock.acquire(blocking=blocking):
+            return False
+        try:
+            with self.read_engine.connect() as sqlite_conn:
+                # One read transaction, so the position matches the rows copied
+                sqlite_conn.exec_driver_sql("BEGIN")
+                until = incremental.current_position(sqlite_conn)
+                if self.position == until:
+                    return True
+
+                # Anything the change log cannot account for means a full copy
+                changes = None
+                if self.position is not None:
+                    changes = incremental.changes_since(sqlite_conn, self.position, until)
+                    mirrored = {row[0] for row in self.con.execute(
+                        "SELECT table_name FROM information_schema.tables").fetchall()}
+                    if any(_key(table) is None or table.name not in mirrored for table in self.tables.values()):
+                        changes = None
+
+                self.con.execute("BEGIN TRANSACTION")
+                try:
+                    if changes is None:
+                        for table in self.tables.values():
+                            self._recreate(sqlite_conn, table)
+                        self.syncs['full'] += 1
+                    else:
+                        for table in self.tables.values():
+                            if table.name in incremental.LOGGED_TABLES:
+                                self._apply(sqlite_conn, table, changes)
+                            else:
+                                # Tables without a change log are recopied
+                                self._recreate(sqlite_conn, table)
+                        self.syncs['incremental'] += 1
+                    self.con.execute("DELETE FROM dqbe_mirror_state")
+                    self.con.execute("INSERT INTO dqbe_mirror_state VALUES (?)", [until])
+                    self.con.execute("COMMIT")
+                except Exception:
+                    self.con.execute("ROLLBACK")
+                    raise
+                sqlite_conn.rollback()
+
+            self.position = until
+            incremental.set_reader_position(self.engine, READER_NAME, until)
+            return True
+        finally:
+            self._lock.release()
+
+    def is_current(self):
+        with self.read_engine.connect() as conn:
+            return self.position == incremental.current_position(conn)
+
+    def execute(self, plan, params, ordered=True):
+        # (columns, rows) from the mirror, or None when the query should run
+        # on SQLite instead (mirror busy syncing, or SQL DuckDB rejects).
+        # Without ordered, rows come back in group order as SQLite returns
+        # them; DuckDB's GROUP BY output is unordered.
+        try:
+            if not self.is_current() and not self.sync(blocking=False):
+                return None
+            sql = plan.driver_sql if ordered else f"SELECT * FROM ({plan.driver_sql}) AS q ORDER BY 1"
+            cursor = self._cursor()
+            cursor.execute(sql, list(plan.bind(params)))
+            return [column[0] for column in cursor.description], cursor.fetchall()
+        except Exception as e:
+            print(f"[Columnar] falling back to SQLite: {e}")
+            return None
+
+    def start(self, interval=SYNC_INTERVAL):
+        def loop():
+            while True:
+                try:
+                    self.sync()
+                except Exception as e:
+                    print(f"[Columnar] sync failed: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=loop, name='dqbe-columnar-sync', daemon=True).start()
+
+    def stats(self):
+        return {'position': self.position, 'syncs': dict(self.syncs)}
+
+
+def backend(engine, read_engine, tables):
+    # The configured backend, already syncing in the background, or None
+    path = os.environ.get('DQBE_COLUMNAR')
+    if not path:
+        return None
+    if duckdb is None:
+        print("[Columnar] DQBE_COLUMNAR is set but duckdb is not installed; using SQLite")
+        return None
+    columnar = ColumnarBackend(path, engine, read_engine, tables)
+    interval = os.environ.get('DQBE_COLUMNAR_SYNC')
+    columnar.start(int(interval) if interval else SYNC_INTERVAL)
+    return columnar
+
+
+def eligible(shape, plan):
+    # Aggregates over the base tables; rollup plans are already pre-aggregated
+    return bool(shape['aggregate']) and not plan.uses_rollup
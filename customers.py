@@ -1,14 +1,12 @@
 import sqlite3
-from faker import Faker
-import random
+import numpy as np
+
+from generate_data import REGIONS, faker_pools
 
 # Connect to DB
-conn = sqlite3.connect('sales.db')
+conn = sqlite3.connect('sales.db', timeout=30)
 cursor = conn.cursor()
-
-# Initialize Faker
-fake = Faker()
-regions = ['North', 'South', 'East', 'West']
+cursor.execute("PRAGMA journal_mode = WAL")
 
 # ✅ Step 1: Create Customers Table (if not exists)
 cursor.execute('''
@@ -21,20 +19,24 @@ CREATE TABLE IF NOT EXISTS customers (
 );
 ''')
 
-# ✅ Step 2: Fetch DISTINCT customer names from sales table
-cursor.execute("SELECT DISTINCT customer_name FROM sales")
+# ✅ Step 2: Fetch DISTINCT sales customer names that have no customer row yet
+cursor.execute('''
+SELECT DISTINCT customer_name FROM sales s
+WHERE NOT EXISTS (SELECT 1 FROM customers c WHERE c.customer_name = s.customer_name)
+''')
 customer_names = [row[0] for row in cursor.fetchall()]
 
-# ✅ Step 3: Insert customer names into customers table with fake data
-for name in customer_names:
-    email = fake.email()
-    phone = fake.phone_number()
-    region = random.choice(regions)
-    
-    cursor.execute('''
-    INSERT INTO customers (customer_name, email, phone, region)
-    VALUES (?, ?, ?, ?)
-    ''', (name, email, phone, region))
+# ✅ Step 3: Insert them in one batch, with fake contact data drawn from cached Faker pools
+rng = np.random.default_rng()
+phones = faker_pools(int(rng.integers(1 << 31)))['phones']
+rows = [
+    (name, f"{'.'.join(str(name).lower().split())}{i}@example.com", phones[i % len(phones)], REGIONS[region])
+    for i, (name, region) in enumerate(zip(customer_names, rng.integers(0, len(REGIONS), len(customer_names))))
+]
+cursor.executemany('''
+INSERT INTO customers (customer_name, email, phone, region)
+VALUES (?, ?, ?, ?)
+''', rows)
 
 # ✅ Commit and close
 conn.commit()
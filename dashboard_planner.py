@@ -0,0 +1,152 @@
+# Dashboard query planner. Charts built on the same tables and filters (same
+# join, same WHERE predicates and values) but grouping or aggregating
+# differently are answered by one statement: the shared filtered rows are
+# materialized once in a CTE and every chart is a GROUP BY branch of a
+# UNION ALL over it, so N such charts cost about one scan of the base tables.
+# Charts that cannot be merged run on their own as before.
+
+import json
+
+from sqlalchemy import select, union_all, literal_column, and_, func
+
+import chart_refresh
+import chart_series
+import query_builder
+
+BATCH_CTE = "dqbe_dashboard_base"
+
+
+def chart_shape(chart_def):
+    # Shapes are stored as JSON with the builder form; fields comes back as a list
+    shape = chart_def.get('shape')
+    if not isinstance(shape, dict) or any(field not in shape for field in query_builder.SHAPE_FIELDS):
+        return None
+    return dict(shape, fields=tuple(shape['fields'] or ()))
+
+
+def base_key(shape, params):
+    table2 = shape['table2'] if shape['table2'] != shape['table1'] else None
+    return (shape['table1'], table2, shape['region'], shape['dates'],
+            json.dumps(params or {}, sort_keys=True, default=str))
+
+
+class ChartBatch:
+    def __init__(self, members, sql, params, fields):
+        self.members = members  # chart positions on the dashboard
+        self.sql = sql
+        self.params = params
+        self.fields = fields  # (label_field, value_field, sort_order) per member
+
+    def split(self, rows):
+        # Rows are (branch, label, value); returns {chart position: (columns, rows)}
+        grouped = {n: [] for n in range(len(self.members))}
+        for branch, label, value in rows:
+            grouped[branch].append((label, value))
+
+        results = {}
+        for n, position in enumerate(self.members):
+            label_field, value_field, sort_order = self.fields[n]
+            chart_rows = grouped[n]
+            if sort_order:
+                # NULL labels sort first, as in SQLite
+                chart_rows.sort(key=lambda row: (row[0] is not None, row[0]), reverse=sort_order == 'desc')
+            results[position] = ([label_field, value_field], chart_rows)
+        return results
+
+
+def build_batch(members, shapes, chart_defs, tables, join_index, partials=False):
+    # With partials, each branch returns (branch, label, SUM, COUNT) of the
+    # aggregate column instead of the chart's value, for incremental refresh
+    shape = shapes[0]
+    path = join_index.path(shape['table1'], shape['table2']) if shape['table2'] else [shape['table1']]
+    if not path:
+        return None
+
+    resolved = [query_builder.grouped_aggregate(member_shape, tables) for member_shape in shapes]
+
+    # One CTE column per distinct source column, shared by all branches
+    base_columns = {}
+    for group_col, agg_col in resolved:
+        for col in (group_col, agg_col):
+            base_columns.setdefault(col, f"c{len(base_columns)}")
+
+    base = select(*[col.label(name) for col, name in base_columns.items()]) \
+        .select_from(join_index.from_clause(tables, path))
+    filters = query_builder.filter_clauses(shape, tables)
+    if filters:
+        base = base.where(and_(*filters))
+    base = base.cte(BATCH_CTE).prefix_with("MATERIALIZED")
+
+    branches = []
+    fields = []
+    for n, (member_shape, (group_col, agg_col)) in enumerate(zip(shapes, resolved)):
+        group_expr = base.c[base_columns[group_col]]
+        if chart_series.is_date_column(group_col) and member_shape['date_bucket'] not in (None, 'day'):
+            group_expr = chart_series.bucket_expression(group_expr, member_shape['date_bucket'])
+        agg_expr = base.c[base_columns[agg_col]]
+        if partials:
+            values = [func.sum(agg_expr).label('total'), func.count(agg_expr).label('count')]
+        else:
+            values = [query_builder.aggregate_expression(member_shape['aggregate'], agg_expr).label('value')]
+        branches.append(select(literal_column(str(n)).label('branch'), group_expr.label('label'), *values)
+                        .select_from(base).group_by(group_expr))
+
+        chart_def = chart_defs[members[n]]
+        fields.append((chart_def['label_field'], chart_def['value_field'], member_shape['sort_order']))
+
+    sql = f"/* DQBE path: dashboard batch of {len(members)} charts */\n{union_all(*branches)}"
+    return ChartBatch(members, sql, chart_defs[members[0]].get('params'), fields)
+
+
+def plan_dashboard(chart_defs, tables, join_index, plan_cache):
+    # Returns (batches, singles): merged statements for groups of charts that
+    # share a base query, and the positions of charts that run on their own
+    groups = {}
+    singles = []
+    for position, chart_def in enumerate(chart_defs):
+        shape = chart_shape(chart_def)
+        try:
+            mergeable = shape is not None and query_builder.grouped_aggregate(shape, tables) is not None
+            # Charts the rollup answers are already cheap; leave them to it
+            plan = plan_cache.get(shape, tables, join_index) if mergeable else None
+        except KeyError:
+            mergeable, plan = False, None
+        if not mergeable or plan is None or plan.uses_rollup:
+            singles.append(position)
+            continue
+        groups.setdefault(base_key(shape, chart_def.get('params')), []).append((position, shape))
+
+    batches = []
+    for members in groups.values():
+        if len(members) < 2:
+            singles.extend(position for position, _ in members)
+            continue
+        positions = [position for position, _ in members]
+        batch = build_batch(positions, [shape for _, shape in members], chart_defs, tables, join_index)
+        if batch is None:
+            singles.extend(positions)
+        else:
+            batches.append(batch)
+
+    return batches, sorted(singles)
+
+
+def refresh(engine, chart_defs, tables, join_index, plan_cache):
+    # Same contract as chart_refresh.refresh over the charts' own queries:
+    # one (columns, rows) or exception per chart, in order
+    batches, singles = plan_dashboard(chart_defs, tables, join_index, plan_cache)
+    queries = [(batch.sql, batch.params) for batch in batches]
+    queries += [(chart_defs[position]['query'], chart_defs[position].get('params')) for position in singles]
+    outcomes = chart_refresh.refresh(engine, queries)
+
+    results = [None] * len(chart_defs)
+    for batch, outcome in zip(batches, outcomes):
+        if isinstance(outcome, Exception):
+            for position in batch.members:
+                results[position] = outcome
+        else:
+            for position, result in batch.split(outcome[1]).items():
+                results[position] = result
+    for position, outcome in zip(singles, outcomes[len(batches):]):
+        results[position] = outcome
+    return results
@@ -0,0 +1,106 @@
+# Engine setup for the DQBE database. Every pooled connection is tuned by a
+# connect-event hook (WAL journal, mmap, page cache, busy timeout), and report
+# queries can run on a separate read-only pool so dashboard readers never
+# queue behind an ingest for a write lock.
+#
+# The profile is read from DQBE_* environment variables, e.g.
+#   DQBE_DATABASE=/data/sales.db DQBE_POOL_SIZE=10 DQBE_MMAP_SIZE=0
+
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+import instrumentation
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def load_profile():
+    return {
+        'database': os.environ.get('DQBE_DATABASE', 'sales.db'),
+        'journal_mode': os.environ.get('DQBE_JOURNAL_MODE', 'wal'),
+        'synchronous': os.environ.get('DQBE_SYNCHRONOUS', 'normal'),
+        'mmap_size': _env_int('DQBE_MMAP_SIZE', 256 * 1024 * 1024),
+        'cache_size': _env_int('DQBE_CACHE_SIZE', -64000),  # negative means KiB
+        'busy_timeout': _env_int('DQBE_BUSY_TIMEOUT', 5000),  # milliseconds
+        'pool_size': _env_int('DQBE_POOL_SIZE', 5),
+        'max_overflow': _env_int('DQBE_MAX_OVERFLOW', 10),
+        'pool_timeout': _env_int('DQBE_POOL_TIMEOUT', 30),
+        'read_pool': os.environ.get('DQBE_READ_POOL', '1') not in ('0', 'false', 'no'),
+    }
+
+
+def _pragmas(profile, read_only):
+    pragmas = [
+        f"PRAGMA busy_timeout = {int(profile['busy_timeout'])}",
+        f"PRAGMA cache_size = {int(profile['cache_size'])}",
+        f"PRAGMA mmap_size = {int(profile['mmap_size'])}",
+        "PRAGMA temp_store = MEMORY",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only = ON")
+    else:
+        # The journal mode is stored in the database file, so only the
+        # writable pool sets it
+        pragmas.append(f"PRAGMA journal_mode = {profile['journal_mode']}")
+        pragmas.append(f"PRAGMA synchronous = {profile['synchronous']}")
+    return pragmas
+
+
+def make_engine(profile=None, read_only=False):
+    profile = profile or load_profile()
+    path = profile['database']
+
+    if read_only:
+        url = f"sqlite:///file:{path}?mode=ro&uri=true"
+    else:
+        url = f"sqlite:///{path}"
+
+    engine = create_engine(
+        url,
+        poolclass=QueuePool,
+        pool_size=profile['pool_size'],
+        max_overflow=profile['max_overflow'],
+        pool_timeout=profile['pool_timeout'],
+        pool_pre_ping=True,
+        connect_args={
+            'check_same_thread': False,
+            'timeout': profile['busy_timeout'] / 1000.0,
+        },
+    )
+
+    pragmas = _pragmas(profile, read_only)
+
+    @event.listens_for(engine, "connect")
+    def _tune_connection(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    instrumentation.instrument_engine(engine, 'read' if read_only else 'write')
+    return engine
+
+
+def make_engines(profile=None):
+    # Returns (engine, read_engine); without a read pool both are the same
+    profile = profile or load_profile()
+    engine = make_engine(profile)
+    if not profile['read_pool']:
+        return engine, engine
+    # Open the writable pool once first so the file and its WAL mode exist
+    # before read-only connections attach to it
+    with engine.connect():
+        pass
+    return engine, make_engine(profile, read_only=True)
+
+
+def database_path(engine):
+    path = engine.url.database or ''
+    if path.startswith('file:'):
+        path = path[len('file:'):]
+    return path
@@ -0,0 +1,127 @@
+# Streaming report export. Rows are read from the database in fixed-size
+# chunks and written straight to the output, so memory use stays flat no
+# matter how large the reports are.
+
+import csv
+import io
+import json
+import tempfile
+
+import xlsxwriter
+from sqlalchemy import text
+
+CHUNK_SIZE = 5000
+FILE_CHUNK_SIZE = 64 * 1024
+EXCEL_MAX_ROWS = 1048576
+
+
+def stream_rows(engine, sql, params=None, chunk_size=CHUNK_SIZE):
+    # Yields (columns, rows) for each chunk of the result
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(text(sql), params or {})
+        columns = list(result.keys())
+        for rows in result.partitions(chunk_size):
+            yield columns, rows
+
+
+def write_xlsx(engine, reports, fileobj):
+    # constant_memory makes xlsxwriter flush each row to disk as soon as the
+    # next one starts, so only the current row is held in memory
+    workbook = xlsxwriter.Workbook(fileobj, {'constant_memory': True})
+    header_format = workbook.add_format({'bold': True})
+
+    for idx, rpt in enumerate(reports):
+        sheet_name = f"Report{idx+1}"[:31]
+        worksheet = None
+        columns = []
+        row_num = 0
+        data_rows = 0
+        part = 1
+
+        for columns, rows in stream_rows(engine, rpt['query'], rpt.get('params')):
+            for row in rows:
+                if worksheet is None or row_num >= EXCEL_MAX_ROWS:
+                    # Spill past Excel's row limit onto continuation sheets
+                    name = sheet_name if worksheet is None else f"{sheet_name} ({part})"[:31]
+                    part += 1
+                    worksheet = workbook.add_worksheet(name)
+                    worksheet.write_row(0, 0, columns, header_format)
+                    row_num = 1
+                worksheet.write_row(row_num, 0, [_excel_value(v) for v in row])
+                row_num += 1
+                data_rows += 1
+
+        if worksheet is None:
+            # Skip this report if there's no data
+            continue
+
+        # Write metadata below the data of the last sheet
+        meta_start_row = row_num + 1
+        metadata = {
+            'Query': rpt.get('query', 'N/A'),
+            'Label Field': rpt.get('label_field', 'N/A'),
+            'Value Field': rpt.get('value_field', 'N/A'),
+            'Chart Type': rpt.get('graph_type', 'N/A')
+        }
+        worksheet.write_row(meta_start_row, 0, list(metadata.keys()), header_format)
+        worksheet.write_row(meta_start_row + 1, 0, list(metadata.values()))
+
+        # Add chart if at least 2 columns
+        if len(columns) >= 2:
+            chart_type = (rpt.get('graph_type') or 'bar').lower()
+            chart_map = {'bar': 'column', 'line': 'line', 'pie': 'pie'}
+            chart = workbook.add_chart({'type': chart_map.get(chart_type, 'column')})
+            last_row = min(data_rows, EXCEL_MAX_ROWS - 1)
+            chart.add_series({
+                'categories': [sheet_name, 1, 0, last_row, 0],
+                'values':     [sheet_name, 1, 1, last_row, 1],
+                'name':       rpt.get('value_field', 'Values')
+            })
+            chart.set_title({'name': f"{rpt.get('label_field')} vs {rpt.get('value_field')}"})
+            workbook.get_worksheet_by_name(sheet_name).insert_chart('E2', chart)
+
+    workbook.close()
+
+
+def iter_xlsx(engine, reports):
+    # The xlsx container can only be assembled once every sheet is written,
+    # so build it in a temporary file and stream that file back in chunks
+    with tempfile.TemporaryFile() as tmp:
+        write_xlsx(engine, reports, tmp)
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(FILE_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def iter_csv(engine, reports):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    for idx, rpt in enumerate(reports):
+        header_written = False
+        for columns, rows in stream_rows(engine, rpt['query'], rpt.get('params')):
+            if not header_written:
+                if idx:
+                    writer.writerow([])
+                writer.writerow(columns)
+                header_written = True
+            writer.writerows(rows)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+
+def iter_ndjson(engine, reports):
+    for idx, rpt in enumerate(reports):
+        for columns, rows in stream_rows(engine, rpt['query'], rpt.get('params')):
+            lines = [json.dumps({'report': idx + 1, 'row': dict(zip(columns, row))}, default=str) for row in rows]
+            yield ("\n".join(lines) + "\n").encode('utf-8')
+
+
+def _excel_value(value):
+    if value is None or isinstance(value, (int, float, str, bool)):
+        return value
+    return str(value)
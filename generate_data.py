@@ -0,0 +1,262 @@
+# Bulk synthetic data generator for the DQBE database.
+#
+# Generates referentially consistent customers, products and sales at any
+# scale: every sales.customer_name exists in customers and every
+# sales.product in products. Rows are generated in vectorized NumPy batches
+# from Faker pools built once, and loaded with executemany inside large
+# transactions with bulk-load PRAGMAs. With --workers the batches are
+# generated on a process pool while the parent process writes.
+#
+#   python generate_data.py --rows 10000000 --customers 200000 --products 500 --workers 4
+
+import argparse
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from string import ascii_uppercase
+
+import numpy as np
+from faker import Faker
+
+import incremental
+
+REGIONS = ['North', 'South', 'East', 'West']
+PRODUCT_CATEGORIES = ['Electronics', 'Appliances', 'Toys', 'Furniture']
+NAME_POOL_SIZE = 1000
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS sales (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_name TEXT,
+        product TEXT,
+        amount INTEGER,
+        order_date DATE,
+        region TEXT
+    )''',
+    '''
+    CREATE TABLE IF NOT EXISTS customers (
+        customer_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_name TEXT,
+        email TEXT,
+        phone TEXT,
+        region TEXT
+    )''',
+    '''
+    CREATE TABLE IF NOT EXISTS products (
+        product_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_name TEXT,
+        category TEXT,
+        price INTEGER
+    )''',
+]
+
+BULK_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -200000",
+    "PRAGMA temp_store = MEMORY",
+]
+
+
+def faker_pools(seed, size=NAME_POOL_SIZE):
+    # Faker is slow per call, so draw each pool once and sample from it
+    fake = Faker()
+    Faker.seed(seed)
+    return {
+        'first_names': np.array(sorted({fake.first_name() for _ in range(size)}), dtype=object),
+        'last_names': np.array(sorted({fake.last_name() for _ in range(size)}), dtype=object),
+        'phones': np.array([fake.phone_number() for _ in range(size)], dtype=object),
+    }
+
+
+def product_names(count):
+    # Widget A, Widget B, ... Widget Z, Widget AA, ...
+    names = []
+    for i in range(count):
+        code = ''
+        i += 1
+        while i:
+            i, rem = divmod(i - 1, 26)
+            code = ascii_uppercase[rem] + code
+        names.append(f"Widget {code}")
+    return np.array(names, dtype=object)
+
+
+def customer_rows(count, pools, rng):
+    # Unique "First Last" names: walk the first x last name grid in a
+    # shuffled order and append an ordinal once the grid is exhausted
+    firsts, lasts = pools['first_names'], pools['last_names']
+    grid = len(firsts) * len(lasts)
+    idx = np.arange(count)
+    if count <= grid:
+        cell = rng.permutation(grid)[:count]
+    else:
+        cell = np.concatenate([rng.permutation(grid), idx[grid:] % grid])
+    first = firsts[cell % len(firsts)]
+    last = lasts[cell // len(firsts)]
+    names = first + ' ' + last
+    overflow = idx >= grid
+    if overflow.any():
+        names[overflow] = names[overflow] + ' ' + (idx[overflow] // grid).astype(str).astype(object)
+
+    emails = np.char.lower((first + '.' + last + idx.astype(str).astype(object) + '@example.com').astype(str))
+    phones = pools['phones'][rng.integers(0, len(pools['phones']), count)]
+    regions = np.array(REGIONS, dtype=object)[rng.integers(0, len(REGIONS), count)]
+    return names, list(zip(names.tolist(), emails.tolist(), phones.tolist(), regions.tolist()))
+
+
+def product_rows(names, rng):
+    categories = np.array(PRODUCT_CATEGORIES, dtype=object)[rng.integers(0, len(PRODUCT_CATEGORIES), len(names))]
+    prices = rng.integers(100, 2001, len(names))
+    return list(zip(names.tolist(), categories.tolist(), prices.tolist()))
+
+
+_worker_state = {}
+
+
+def _init_worker(customer_names, product_names_, dates):
+    _worker_state.update(customers=customer_names, products=product_names_, dates=dates)
+
+
+def sales_batch(args):
+    seed, size = args
+    rng = np.random.default_rng(seed)
+    customers = _worker_state['customers']
+    products = _worker_state['products']
+    dates = _worker_state['dates']
+    return list(zip(
+        customers[rng.integers(0, len(customers), size)].tolist(),
+        products[rng.integers(0, len(products), size)].tolist(),
+        rng.integers(50, 501, size).tolist(),
+        dates[rng.integers(0, len(dates), size)].tolist(),
+        np.array(REGIONS, dtype=object)[rng.integers(0, len(REGIONS), size)].tolist(),
+    ))
+
+
+def _bounded_map(executor, fn, items, window):
+    # Like executor.map, but keeps at most `window` batches in flight so
+    # generation never runs far ahead of the single SQLite writer
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def load(database='sales.db', rows=100, customers=None, products=4, days=365,
+         batch_size=100000, workers=1, seed=None, reset=False, verbose=True):
+    started = time.perf_counter()
+    seed = int(time.time()) if seed is None else seed
+    rng = np.random.default_rng(seed)
+    customers = customers or max(1, min(rows, 100000) // 2)
+
+    conn = sqlite3.connect(database, timeout=30)
+    for pragma in BULK_PRAGMAS:
+        conn.execute(pragma)
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+    # Row-level change-log triggers would double the cost of a bulk load; drop
+    # them and leave one bulk marker instead, which makes the app recompute
+    # saved charts in full. Everything after the drop is covered by the
+    # finally below, so a failed load still restores them.
+    logged = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'dqbe_changelog'").fetchone() is not None
+    executor = None
+    loaded = 0
+    try:
+        if logged:
+            for statement in incremental.drop_trigger_sql():
+                conn.execute(statement)
+        if reset:
+            conn.execute("DELETE FROM sales")
+            conn.execute("DELETE FROM customers")
+            conn.execute("DELETE FROM products")
+            # The sales rollup starts over too
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'dqbe_rollup_state'").fetchone() is not None:
+                conn.execute("DELETE FROM dqbe_sales_daily")
+                conn.execute("UPDATE dqbe_rollup_state SET last_id = 0")
+            if logged:
+                conn.execute("DELETE FROM dqbe_changelog_readers WHERE name = 'rollup'")
+        conn.commit()
+
+        today = date.today()
+        dates = np.array([(today - timedelta(days=d)).isoformat() for d in range(days + 1)], dtype=object)
+
+        # Appending to an existing database draws sales from the customers and
+        # products already there, so repeated loads stay consistent
+        customer_names = np.array([r[0] for r in conn.execute("SELECT customer_name FROM customers")], dtype=object)
+        product_list = np.array([r[0] for r in conn.execute("SELECT product_name FROM products")], dtype=object)
+
+        with conn:
+            if not len(customer_names):
+                customer_names, customer_data = customer_rows(customers, faker_pools(seed), rng)
+                conn.executemany("INSERT INTO customers (customer_name, email, phone, region) VALUES (?, ?, ?, ?)",
+                                 customer_data)
+            if not len(product_list):
+                product_list = product_names(products)
+                conn.executemany("INSERT INTO products (product_name, category, price) VALUES (?, ?, ?)",
+                                 product_rows(product_list, rng))
+
+        batches = [(seed + i + 1, min(batch_size, rows - start)) for i, start in enumerate(range(0, rows, batch_size))]
+        insert_sql = "INSERT INTO sales (customer_name, product, amount, order_date, region) VALUES (?, ?, ?, ?, ?)"
+
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                           initargs=(customer_names, product_list, dates))
+            generated = _bounded_map(executor, sales_batch, batches, workers * 2)
+        else:
+            _init_worker(customer_names, product_list, dates)
+            generated = map(sales_batch, batches)
+
+        for batch in generated:
+            with conn:
+                conn.executemany(insert_sql, batch)
+            loaded += len(batch)
+            if verbose:
+                print(f"  {loaded:,} / {rows:,} sales rows", flush=True)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if logged:
+            # Anything left uncommitted by a failure is discarded first
+            conn.rollback()
+            with conn:
+                conn.execute(incremental.BULK_MARKER_SQL)
+                for statement in incremental.trigger_sql():
+                    conn.execute(statement)
+
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("ANALYZE")
+    conn.close()
+
+    elapsed = time.perf_counter() - started
+    if verbose:
+        print(f"Loaded {loaded:,} sales rows for {len(customer_names):,} customers and {len(product_list):,} products "
+              f"into '{database}' in {elapsed:.1f}s")
+    return loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic sales data for the DQBE.")
+    parser.add_argument('--db', default='sales.db', help="SQLite database file (default: sales.db)")
+    parser.add_argument('--rows', type=int, default=100, help="number of sales rows")
+    parser.add_argument('--customers', type=int, default=None, help="number of customers (default: rows / 2, capped)")
+    parser.add_argument('--products', type=int, default=4, help="number of products")
+    parser.add_argument('--days', type=int, default=365, help="spread order dates over this many past days")
+    parser.add_argument('--batch-size', type=int, default=100000, help="rows per generated batch and transaction")
+    parser.add_argument('--workers', type=int, default=1, help="processes generating batches")
+    parser.add_argument('--seed', type=int, default=None, help="random seed for reproducible data")
+    parser.add_argument('--reset', action='store_true', help="delete existing rows first")
+    args = parser.parse_args(argv)
+
+    load(args.db, rows=args.rows, customers=args.customers, products=args.products, days=args.days,
+         batch_size=args.batch_size, workers=args.workers, seed=args.seed, reset=args.reset)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+# Incremental maintenance of saved chart aggregates. Triggers on sales,
+# customers and products append every change to a change log, and each saved
+# SUM/COUNT/AVG chart keeps its per-group partial sums and counts together
+# with the change-log position they reflect. A refresh folds in only the
+# sales rows inserted since then; any other change to a table the chart
+# reads (an update, a delete, a new customer or product row, or a bulk load)
+# falls back to a full recompute. Charts whose SQL reads the daily rollup
+# are left to it: the rollup already answers them without touching sales.
+
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import (MetaData, Table, Column, Integer, Float, Text, select, func, and_, bindparam, text, type_coerce)
+
+import chart_series
+import dashboard_planner
+import query_builder
+import rollups
+
+LOGGED_TABLES = {"sales": "id", "customers": "customer_id", "products": "product_id"}
+FACT_TABLE = "sales"
+
+ivm_metadata = MetaData()
+
+changelog = Table(
+    "dqbe_changelog", ivm_metadata,
+    Column("seq", Integer, primary_key=True, autoincrement=True),
+    Column("table_name", Text, nullable=False),
+    Column("op", Text, nullable=False),  # I, U, D, or B for a bulk load
+    Column("row_id", Integer),
+    sqlite_autoincrement=True,
+)
+
+chart_state = Table(
+    "dqbe_chart_state", ivm_metadata,
+    Column("item_id", Integer, primary_key=True),
+    Column("definition", Text, nullable=False),
+    Column("watermark", Integer, nullable=False),
+    Column("partials", Text, nullable=False),
+)
+
+# Other consumers of the change log (e.g. the columnar mirror) record their
+# position here so pruning keeps what they have not applied yet. Readers idle
+# for longer than READER_TTL stop holding the log back.
+changelog_readers = Table(
+    "dqbe_changelog_readers", ivm_metadata,
+    Column("name", Text, primary_key=True),
+    Column("watermark", Integer, nullable=False),
+    Column("updated_at", Float, nullable=False),
+)
+
+READER_TTL = 86400  # seconds
+
+# The log is pruned inside transactions that already write a watermark, at
+# most this often, so reads never pay for a write of their own
+PRUNE_INTERVAL = 60  # seconds
+
+BULK_MARKER_SQL = "INSERT INTO dqbe_changelog (table_name, op) VALUES ('*', 'B')"
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+_pruned_at = 0.0
+
+# refresh_item's answer when a full recompute is left to a merged scan
+DEFERRED = object()
+
+
+def trigger_sql(tables=LOGGED_TABLES):
+    statements = []
+    for table in tables:
+        key = LOGGED_TABLES[table]
+        for event, op, row in (("INSERT", "I", "NEW"), ("UPDATE", "U", "NEW"), ("DELETE", "D", "OLD")):
+            statements.append(
+                f"CREATE TRIGGER IF NOT EXISTS dqbe_log_{table}_{event.lower()} AFTER {event} ON {table} "
+                f"BEGIN INSERT INTO dqbe_changelog (table_name, op, row_id) "
+                f"VALUES ('{table}', '{op}', {row}.{key}); END")
+    return statements
+
+
+def drop_trigger_sql():
+    return [f"DROP TRIGGER IF EXISTS dqbe_log_{table}_{event}"
+            for table in LOGGED_TABLES for event in ("insert", "update", "delete")]
+
+
+def install(engine):
+    ivm_metadata.create_all(engine)
+    with engine.begin() as conn:
+        existing = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+        for statement in trigger_sql([table for table in LOGGED_TABLES if table in existing]):
+            conn.execute(text(statement))
+
+
+def current_position(conn):
+    # The last assigned seq, which survives pruning unlike max(seq)
+    return conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'dqbe_changelog'")).scalar() or 0
+
+
+def changes_since(conn, since, until):
+    # {(table_name, op): [row ids]} for the (since, until] window, or None when
+    # part of the window has been pruned or it contains a bulk load
+    if since < until:
+        oldest = conn.execute(select(func.min(changelog.c.seq))).scalar()
+        if oldest is None or oldest > since + 1:
+            return None
+    changes = {}
+    rows = conn.execute(select(changelog.c.table_name, changelog.c.op, changelog.c.row_id)
+                        .where(changelog.c.seq > since, changelog.c.seq <= until))
+    for table_name, op, row_id in rows:
+        if op == 'B':
+            return None
+        changes.setdefault((table_name, op), []).append(row_id)
+    return changes
+
+
+def changed_tables(conn, since, until):
+    # Names of the tables changed in the (since, until] window, or None when
+    # part of the window has been pruned or it contains a bulk load
+    if since < until:
+        oldest = conn.execute(select(func.min(changelog.c.seq))).scalar()
+        if oldest is None or oldest > since + 1:
+            return None
+    names = set()
+    rows = conn.execute(select(changelog.c.table_name, changelog.c.op).distinct()
+                        .where(changelog.c.seq > since, changelog.c.seq <= until))
+    for table_name, op in rows:
+        if op == 'B':
+            return None
+        names.add(table_name)
+    return names
+
+
+def appends_only(conn, table_name, since, until):
+    # Whether the (since, until] window holds nothing for table_name but
+    # inserts; False when part of it has been pruned or it has a bulk load
+    if since == until:
+        return True
+    changed = changed_tables(conn, since, until) if since < until else None
+    if changed is None:
+        return False
+    if table_name not in changed:
+        return True
+    ops = {row[0] for row in conn.execute(
+        select(changelog.c.op).distinct().where(
+            changelog.c.seq > since, changelog.c.seq <= until, changelog.c.table_name == table_name))}
+    return ops <= {'I'}
+
+
+def reader_position(conn, name):
+    return conn.execute(select(changelog_readers.c.watermark).where(changelog_readers.c.name == name)).scalar()
+
+
+def set_reader_position(engine, name, watermark):
+    with engine.begin() as conn:
+        record_reader_position(conn, name, watermark)
+
+
+def record_reader_position(conn, name, watermark):
+    # The same, inside the caller's transaction
+    conn.execute(text(
+        "INSERT INTO dqbe_changelog_readers (name, watermark, updated_at) VALUES (:name, :watermark, :now) "
+        "ON CONFLICT (name) DO UPDATE SET watermark = excluded.watermark, updated_at = excluded.updated_at"),
+        {"name": name, "watermark": watermark, "now": time.time()})
+    if _prune_due():
+        _prune(conn)
+
+
+def _record(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _definition(item):
+    payload = json.dumps([item.get('shape'), item.get('params')], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def _partial_query(shape, tables, join_index, resolved, delta):
+    # Per-group SUM and COUNT of the aggregate column, over every row or only
+    # over the sales rows inserted in the (since, until] change-log window
+    path = join_index.path(shape['table1'], shape['table2']) if shape['table2'] else [shape['table1']]
+    if not path:
+        return None, None
+
+    group_col, agg_col = resolved
+    group_expr = group_col
+    if chart_series.is_date_column(group_col) and shape['date_bucket'] not in (None, 'day'):
+        group_expr = chart_series.bucket_expression(group_col, shape['date_bucket'])
+
+    # Labels come back as stored, like the chart's own SQL returns them
+    query = select(type_coerce(group_expr, Text()).label('label'), func.sum(agg_col), func.count(agg_col)) \
+        .select_from(join_index.from_clause(tables, path))
+    filters = query_builder.filter_clauses(shape, tables)
+    if delta:
+        inserted = select(changelog.c.row_id).where(
+            changelog.c.seq > bindparam('since'), changelog.c.seq <= bindparam('until'),
+            changelog.c.table_name == FACT_TABLE, changelog.c.op == 'I')
+        filters.append(tables[FACT_TABLE].c[LOGGED_TABLES[FACT_TABLE]].in_(inserted))
+    if filters:
+        query = query.where(and_(*filters))
+    return query.group_by(group_expr), path
+
+
+def _label_order(label):
+    # SQLite orders NULL before numbers before text
+    if label is None:
+        return (0, 0)
+    if isinstance(label, (int, float)):
+        return (1, label)
+    return (2, str(label))
+
+
+def partial_rows(shape, partials):
+    # (label, value) rows from [label, sum, count] partials, in the order the
+    # chart's own SQL returns them
+    rows = []
+    for label, total, count in sorted(partials, key=lambda entry: _label_order(entry[0])):
+        if shape['aggregate'] == 'count':
+            value = count
+        elif shape['aggregate'] == 'sum':
+            value = total
+        else:
+            value = total / count if count else None
+        rows.append((label, value))
+    if shape['sort_field'] and shape['sort_order'] == 'desc':
+        rows.reverse()
+    return rows
+
+
+def _delta_allowed(conn, path, since, until):
+    # Only inserts into sales can be folded in; anything else touching the
+    # chart's tables (or a bulk load) needs the full recompute
+    changes = conn.execute(
+        select(changelog.c.table_name, changelog.c.op).distinct()
+        .where(changelog.c.seq > since, changelog.c.seq <= until)).fetchall()
+    for table_name, op in changes:
+        if op == 'B':
+            return False
+        if table_name in path and (table_name != FACT_TABLE or op != 'I'):
+            return False
+    return True
+
+
+def refresh_item(engine, read_engine, item, tables, join_index, full_scan=None, shared=None, defer_full=False):
+    # Returns (columns, rows) for a saved chart/report, or None when it is not
+    # an incrementally maintainable aggregate. A full recompute may be
+    # answered with (position, partials) from shared[item id] (a merged scan)
+    # or from full_scan(shape, params) (e.g. the sales partitions); with
+    # defer_full, DEFERRED is returned instead of scanning on its own.
+    shape = item.get('shape')
+    if not isinstance(shape, dict) or any(field not in shape for field in query_builder.SHAPE_FIELDS):
+        return None
+    if rollups.ROLLUP_TABLE in (item.get('query') or ''):
+        return None
+    shape = dict(shape, fields=tuple(shape['fields'] or ()))
+    try:
+        resolved = query_builder.grouped_aggregate(shape, tables)
+    except KeyError:
+        return None
+    if resolved is None:
+        return None
+
+    params = dict(item.get('params') or {})
+    definition = _definition(item)
+    columns = [item['label_field'], item['value_field']]
+
+    with engine.connect() as conn:
+        state = conn.execute(select(chart_state).where(chart_state.c.item_id == item['id'])).first()
+    if state is not None and state.definition != definition:
+        state = None
+
+    with read_engine.connect() as conn:
+        # One read transaction, so the watermark matches the rows aggregated
+        conn.exec_driver_sql("BEGIN")
+        until = current_position(conn)
+
+        if state is not None and state.watermark == until:
+            _record('unchanged')
+            return columns, partial_rows(shape, json.loads(state.partials))
+
+        query, path = _partial_query(shape, tables, join_index, resolved, delta=False)
+        if query is None:
+            return None
+
+        if state is not None and _delta_allowed(conn, path, state.watermark, until):
+            delta_query, _ = _partial_query(shape, tables, join_index, resolved, delta=True)
+            merged = {json.dumps(label): [label, total, count] for label, total, count in json.loads(state.partials)}
+            for label, total, count in conn.execute(delta_query, dict(params, since=state.watermark, until=until)):
+                entry = merged.setdefault(json.dumps(label), [label, None, 0])
+                if total is not None:
+                    entry[1] = total if entry[1] is None else entry[1] + total
+                entry[2] += count
+            partials = list(merged.values())
+            _record('delta')
+        else:
+            scanned = (shared or {}).get(item['id'])
+            if scanned is not None:
+                _record('merged')
+            elif full_scan is not None:
+                scanned = full_scan(shape, params)
+                if scanned is not None:
+                    _record('scanned')
+            if scanned is None and defer_full:
+                conn.rollback()
+                return DEFERRED
+            if scanned is not None:
+                until, partials = scanned
+            else:
+                partials = [list(row) for row in conn.execute(query, params)]
+                _record('full')
+        conn.rollback()
+
+    with engine.begin() as conn:
+        if state is None:
+            conn.execute(chart_state.delete().where(chart_state.c.item_id == item['id']))
+            conn.execute(chart_state.insert().values(item_id=item['id'], definition=definition,
+                                                     watermark=until, partials=json.dumps(partials)))
+        else:
+            # Compare-and-set, so a concurrent refresh never rolls the state back
+            conn.execute(chart_state.update()
+                         .where(and_(chart_state.c.item_id == item['id'], chart_state.c.watermark == state.watermark))
+                         .values(watermark=until, partials=json.dumps(partials)))
+        if _prune_due():
+            _prune(conn)
+
+    return columns, partial_rows(shape, partials)
+
+
+def _merged_partials(read_engine, items, tables, join_index):
+    # {item id: (position, partials)} for items that need a full recompute
+    # and share a base query (dashboard_planner.base_key): each group is one
+    # scan, a GROUP BY branch per item over the shared filtered rows
+    groups = {}
+    for position, item in enumerate(items):
+        shape = dashboard_planner.chart_shape(item)
+        groups.setdefault(dashboard_planner.base_key(shape, item.get('params')), []).append((position, shape))
+
+    shared = {}
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        positions = [position for position, _ in members]
+        batch = dashboard_planner.build_batch(positions, [shape for _, shape in members], items, tables, join_index,
+                                              partials=True)
+        if batch is None:
+            continue
+        with read_engine.connect() as conn:
+            # One read transaction, so the watermark matches the rows aggregated
+            conn.exec_driver_sql("BEGIN")
+            until = current_position(conn)
+            rows = conn.execute(text(batch.sql), dict(batch.params or {})).fetchall()
+            conn.rollback()
+        partials = {n: [] for n in range(len(positions))}
+        for branch, label, total, count in rows:
+            partials[branch].append([label, total, count])
+        for n, position in enumerate(positions):
+            shared[items[position]['id']] = (until, partials[n])
+    return shared
+
+
+def refresh(engine, read_engine, items, tables, join_index, full_scan=None):
+    # One (columns, rows) per item, or None for items that must be refreshed
+    # the ordinary way. Items that need a full recompute and share a base
+    # query are recomputed from one merged scan.
+    def attempt(item, **kwargs):
+        try:
+            return refresh_item(engine, read_engine, item, tables, join_index, full_scan, **kwargs)
+        except Exception as e:
+            print(f"[Incremental refresh] item {item.get('id')} falls back: {e}")
+            return None
+
+    results = [attempt(item, defer_full=len(items) > 1) for item in items]
+    deferred = [position for position, result in enumerate(results) if result is DEFERRED]
+    if deferred:
+        shared = {}
+        try:
+            shared = _merged_partials(read_engine, [items[position] for position in deferred], tables, join_index)
+        except Exception as e:
+            print(f"[Incremental refresh] merged scan failed, recomputing one by one: {e}")
+        for position in deferred:
+            results[position] = attempt(items[position], shared=shared)
+    return results
+
+
+def forget(engine, item_id):
+    with engine.begin() as conn:
+        conn.execute(chart_state.delete().where(chart_state.c.item_id == item_id))
+
+
+def prune(engine):
+    # Entries every chart state and active reader has already absorbed are
+    # no longer needed
+    with engine.begin() as conn:
+        _prune(conn)
+
+
+def _prune_due():
+    global _pruned_at
+    with _stats_lock:
+        now = time.time()
+        if now - _pruned_at < PRUNE_INTERVAL:
+            return False
+        _pruned_at = now
+        return True
+
+
+def _prune(conn):
+    conn.execute(text(
+        "DELETE FROM dqbe_changelog WHERE seq <= coalesce("
+        "(SELECT min(watermark) FROM (SELECT watermark FROM dqbe_chart_state UNION ALL "
+        "SELECT watermark FROM dqbe_changelog_readers WHERE updated_at >= :active)), "
+        "(SELECT max(seq) FROM dqbe_changelog))"), {"active": time.time() - READER_TTL})
@@ -0,0 +1,191 @@
+# Index advisor for the DQBE. Every query the builder runs is recorded as the
+# predicates, join keys and sort/group keys it uses, and its EXPLAIN QUERY
+# PLAN is read once per shape. Candidate composite/covering indexes are scored
+# by how often they would help and whether the plan currently scans the
+# table, and can be created on request.
+
+import re
+import threading
+from collections import Counter, defaultdict
+
+from sqlalchemy import text
+
+INDEX_PREFIX = "dqbe_idx_"
+MAX_INDEX_COLUMNS = 4
+
+_identifier = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def explain(conn, sql, params=()):
+    # Returns the EXPLAIN QUERY PLAN detail lines for a positional statement
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}", tuple(params)).fetchall()
+    return [row[-1] for row in rows]
+
+
+def scanned_tables(plan_lines):
+    # Tables read by a full scan rather than through an index
+    tables = set()
+    for line in plan_lines:
+        match = re.match(r"SCAN (?:TABLE )?(\w+)", line)
+        if match and "USING" not in line:
+            tables.add(match.group(1))
+    return tables
+
+
+def existing_indexes(conn, table):
+    indexes = []
+    for row in conn.exec_driver_sql(f'PRAGMA index_list("{table}")').fetchall():
+        name = row[1]
+        columns = [info[2] for info in conn.exec_driver_sql(f'PRAGMA index_info("{name}")').fetchall()]
+        indexes.append((name, tuple(columns)))
+    return indexes
+
+
+def index_name(table, columns):
+    return f"{INDEX_PREFIX}{table}_{'_'.join(columns)}"
+
+
+def _owner(tables, selected, column):
+    for name in selected:
+        if column in tables[name].c:
+            return name
+    return None
+
+
+def candidates_for(shape, tables, join_index):
+    # Candidate (table, columns) -> reasons for one builder shape, following
+    # the same column resolution the builder uses
+    selected = [name for name in (shape['table1'], shape['table2']) if name]
+    found = defaultdict(set)
+
+    # Filters always apply to sales: equality column first, then the range
+    filter_cols = []
+    if shape['region']:
+        filter_cols.append('region')
+    if shape['dates']:
+        filter_cols.append('order_date')
+    if filter_cols:
+        found[('sales', tuple(filter_cols))].add('filter')
+
+        # Covering variant that also carries the grouped and aggregated columns
+        extra = [col for col in (shape['group_by'], shape['aggregate_field'])
+                 if col and col in tables['sales'].c and col not in filter_cols]
+        covering = tuple(filter_cols + extra)[:MAX_INDEX_COLUMNS]
+        if covering != tuple(filter_cols) and 'sales' in selected:
+            found[('sales', covering)].add('covering')
+
+    # Join keys on both sides of every hop of the join path
+    if shape['table2'] and shape['table2'] != shape['table1']:
+        path = join_index.path(shape['table1'], shape['table2']) or ()
+        for left, right in zip(path, path[1:]):
+            left_col, right_col = join_index.graph[left][right]
+            found[(left, (left_col,))].add('join')
+            found[(right, (right_col,))].add('join')
+
+    if shape['group_by'] and shape['aggregate'] and not filter_cols:
+        owner = _owner(tables, selected, shape['group_by'])
+        if owner:
+            found[(owner, (shape['group_by'],))].add('group by')
+
+    if shape['sort_field'] and not shape['aggregate']:
+        owner = _owner(tables, selected, shape['sort_field'])
+        if owner:
+            found[(owner, (shape['sort_field'],))].add('sort')
+
+    return found
+
+
+class IndexAdvisor:
+    def __init__(self):
+        self._counts = Counter()
+        self._reasons = defaultdict(set)
+        self._scanned = Counter()
+        self._plans = {}
+        self._lock = threading.Lock()
+
+        # index() reads min/max(order_date) on every page load
+        self._counts[('sales', ('order_date',))] += 1
+        self._reasons[('sales', ('order_date',))].add('date bounds')
+
+    def observe(self, conn, shape, plan, params, tables, join_index):
+        if plan.uses_rollup:
+            return
+        with self._lock:
+            plan_lines = self._plans.get(plan.driver_sql)
+        if plan_lines is None:
+            try:
+                plan_lines = explain(conn, plan.driver_sql, plan.bind(params))
+            except Exception:
+                plan_lines = []
+            with self._lock:
+                self._plans[plan.driver_sql] = plan_lines
+
+        scanned = scanned_tables(plan_lines)
+        with self._lock:
+            for candidate, reasons in candidates_for(shape, tables, join_index).items():
+                self._counts[candidate] += 1
+                self._reasons[candidate].update(reasons)
+                if candidate[0] in scanned:
+                    self._scanned[candidate] += 1
+
+    def recommendations(self, conn):
+        with self._lock:
+            counts = dict(self._counts)
+            reasons = {key: set(value) for key, value in self._reasons.items()}
+            scanned = dict(self._scanned)
+
+        existing = {}
+        for table in {table for table, _ in counts}:
+            existing[table] = [columns for _, columns in existing_indexes(conn, table)]
+
+        def covered(table, columns, others):
+            # An index whose leading columns already match makes this one redundant
+            return any(other[:len(columns)] == columns for other in others)
+
+        recommendations = []
+        for (table, columns), count in counts.items():
+            if covered(table, columns, existing.get(table, [])):
+                continue
+            longer = [cols for (t, cols) in counts if t == table and len(cols) > len(columns)]
+            if covered(table, columns, longer):
+                continue
+            full_scans = scanned.get((table, columns), 0)
+            cols = ", ".join(columns)
+            recommendations.append({
+                'name': index_name(table, columns),
+                'table': table,
+                'columns': list(columns),
+                'reasons': sorted(reasons[(table, columns)]),
+                'queries': count,
+                'full_scans': full_scans,
+                'score': count + 2 * full_scans,
+                'sql': f"CREATE INDEX IF NOT EXISTS {index_name(table, columns)} ON {table} ({cols})",
+            })
+
+        recommendations.sort(key=lambda rec: (-rec['score'], rec['name']))
+        return recommendations
+
+    def observed_plans(self):
+        with self._lock:
+            return [{'sql': sql, 'plan': lines} for sql, lines in self._plans.items()]
+
+    def create(self, engine, names):
+        # Creates the named recommended indexes (or all of them for "all")
+        with engine.connect() as conn:
+            recommended = self.recommendations(conn)
+        created = []
+        with engine.begin() as conn:
+            for rec in recommended:
+                if names != 'all' and rec['name'] not in names:
+                    continue
+                if not all(_identifier.match(part) for part in [rec['table']] + rec['columns']):
+                    continue
+                conn.execute(text(rec['sql']))
+                created.append(rec['name'])
+            if created:
+                conn.execute(text("ANALYZE"))
+        if created:
+            # Plans change once the new indexes exist
+            with self._lock:
+                self._plans.clear()
+        return created
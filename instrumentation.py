@@ -0,0 +1,251 @@
+# Request-level performance instrumentation. SQLAlchemy cursor events time
+# every statement, a cursor subclass counts the rows actually fetched, and
+# Flask request hooks and template signals time each request, its response
+# size and its template renders. Everything lands in histograms served by
+# /metrics, and statements over the slow-query threshold are kept with their
+# EXPLAIN QUERY PLAN. Statements that raise are timed too and counted under
+# query_errors by exception type.
+#
+# The threshold is read from DQBE_SLOW_QUERY_MS (default 500). Slow queries
+# and the app's own diagnostics are logged on the "dqbe" logger.
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+import numpy as np
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+SLOW_QUERY_MS = float(os.environ.get('DQBE_SLOW_QUERY_MS', 500))
+SLOW_LOG_SIZE = 100
+RESERVOIR_SIZE = 1024
+MAX_LABELS = 200
+PERCENTILES = (50, 90, 95, 99)
+
+# Upper bounds of the histogram buckets; values above the last go to "+Inf"
+MS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+
+
+class Histogram:
+    # Bucket counts over the whole lifetime, plus a reservoir of the most
+    # recent samples for percentiles
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def summary(self):
+        summary = {
+            'count': self.count,
+            'sum': round(self.total, 3),
+            'mean': round(self.total / self.count, 3) if self.count else None,
+            'max': round(self.max, 3),
+            'buckets': {str(bound): n for bound, n in zip(self.buckets + ('+Inf',), self.counts)},
+        }
+        if self.recent:
+            values = np.percentile(np.fromiter(self.recent, dtype=float), PERCENTILES)
+            summary.update({f"p{p}": round(float(v), 3) for p, v in zip(PERCENTILES, values)})
+        return summary
+
+
+class Metrics:
+    def __init__(self):
+        self._histograms = {}
+        self._slow = deque(maxlen=SLOW_LOG_SIZE)
+        self._lock = threading.Lock()
+
+    def observe(self, name, label, value, buckets=MS_BUCKETS):
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if label not in series and len(series) >= MAX_LABELS:
+                label = 'other'
+            histogram = series.get(label)
+            if histogram is None:
+                histogram = series[label] = Histogram(buckets)
+            histogram.observe(value)
+
+    def log_slow(self, entry):
+        with self._lock:
+            self._slow.append(entry)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'histograms': {name: {label: histogram.summary() for label, histogram in series.items()}
+                               for name, series in self._histograms.items()},
+                'slow_queries': list(self._slow)[::-1],
+                'slow_query_ms': SLOW_QUERY_MS,
+            }
+
+
+metrics = Metrics()
+log = logging.getLogger('dqbe')
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or request.path
+    return 'background'
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Counts fetched rows for the statement recorded on it by
+    # after_cursor_execute, and files the count when the cursor closes
+    query = None
+    rows = 0
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        self.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self.rows += len(rows)
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self.rows += 1
+        return row
+
+    def close(self):
+        if self.query is not None:
+            self.query['rows'] = self.rows
+            metrics.observe('query_rows', self.query['pool'], self.rows, COUNT_BUCKETS)
+            self.query = None
+        super().close()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+
+def explain(dbapi_conn, statement, parameters):
+    cursor = dbapi_conn.cursor(sqlite3.Cursor)
+    try:
+        return [row[-1] for row in cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+    except sqlite3.Error as e:
+        return [f"EXPLAIN failed: {e}"]
+    finally:
+        cursor.close()
+
+
+def instrument_engine(engine, pool):
+    # pool names the engine in the metrics, e.g. "write" or "read"
+
+    @event.listens_for(engine, "do_connect")
+    def _connection_factory(dialect, conn_rec, cargs, cparams):
+        cparams.setdefault('factory', InstrumentedConnection)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('dqbe_query_start', []).append((context, time.perf_counter()))
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _finish(conn, cursor, statement, parameters, context, executemany):
+        elapsed = (time.perf_counter() - conn.info['dqbe_query_start'].pop()[1]) * 1000
+        query = _record(pool, elapsed, statement, parameters)
+        if isinstance(cursor, InstrumentedCursor):
+            cursor.query = query
+            cursor.rows = 0
+        if elapsed >= SLOW_QUERY_MS:
+            if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH', '/*')):
+                query['plan'] = explain(cursor.connection, statement, parameters)
+            _log_slow(query, statement)
+
+    @event.listens_for(engine, "handle_error")
+    def _failed(context):
+        # A statement that raises never reaches after_cursor_execute, so its
+        # start is popped here. Errors raised while fetching come through too;
+        # their start was already popped, which the context check tells apart.
+        starts = context.connection.info.get('dqbe_query_start') if context.connection is not None else None
+        if not starts or starts[-1][0] is not context.execution_context:
+            return
+        elapsed = (time.perf_counter() - starts.pop()[1]) * 1000
+        error = type(context.original_exception).__name__
+        query = _record(pool, elapsed, context.statement, context.parameters, error)
+        metrics.observe('query_errors', error, elapsed)
+        if elapsed >= SLOW_QUERY_MS:
+            _log_slow(query, context.statement)
+
+
+def _record(pool, elapsed, statement, parameters, error=None):
+    # Files a finished (or failed) statement and returns its slow-log entry
+    endpoint = _endpoint()
+    metrics.observe('query_ms', pool, elapsed)
+    query = {'pool': pool, 'endpoint': endpoint, 'ms': round(elapsed, 3), 'rows': None}
+    if error is not None:
+        query['error'] = error
+
+    if has_request_context() and hasattr(g, 'dqbe_queries'):
+        g.dqbe_queries += 1
+        g.dqbe_db_ms += elapsed
+
+    if elapsed >= SLOW_QUERY_MS:
+        query.update(sql=statement, params=repr(parameters)[:500], at=time.time())
+    return query
+
+
+def _log_slow(query, statement):
+    metrics.log_slow(query)
+    log.warning("Slow query: %.0f ms on %s: %s", query['ms'], query['endpoint'], ' '.join(statement.split())[:200])
+
+
+def init_app(app):
+
+    @app.before_request
+    def _start_request():
+        g.dqbe_request_start = time.perf_counter()
+        g.dqbe_queries = 0
+        g.dqbe_db_ms = 0.0
+
+    @app.after_request
+    def _finish_request(response):
+        start = g.pop('dqbe_request_start', None)
+        if start is None:
+            return response
+        endpoint = _endpoint()
+        metrics.observe('request_ms', endpoint, (time.perf_counter() - start) * 1000)
+        metrics.observe('request_queries', endpoint, g.dqbe_queries, COUNT_BUCKETS)
+        metrics.observe('request_db_ms', endpoint, g.dqbe_db_ms)
+        # Streamed responses have no length up front
+        if response.content_length is not None:
+            metrics.observe('response_bytes', endpoint, response.content_length, BYTE_BUCKETS)
+        return response
+
+    def _start_render(sender, template, context, **extra):
+        g.setdefault('dqbe_render_start', []).append(time.perf_counter())
+
+    def _finish_render(sender, template, context, **extra):
+        starts = g.get('dqbe_render_start')
+        if starts:
+            metrics.observe('template_ms', template.name, (time.perf_counter() - starts.pop()) * 1000)
+
+    # Connected strongly: the handlers are local functions
+    before_render_template.connect(_start_render, app, weak=False)
+    template_rendered.connect(_finish_render, app, weak=False)
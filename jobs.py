@@ -0,0 +1,198 @@
+# Background query execution for long-running reports. Submitting a query
+# returns a job id at once; a small thread pool runs it on the read pool with
+# a per-job timeout, and the browser polls the job for progress and pages of
+# results. A running statement is interrupted through SQLite's progress
+# handler when the job is cancelled or runs past its deadline.
+#
+# Each owner may have MAX_ACTIVE_JOBS queued or running and keeps at most
+# MAX_KEPT_JOBS in all; a submission past either cap is turned away unless
+# one of the owner's finished jobs can make room. Finished results are
+# dropped after JOB_TTL, or oldest first once the kept results pass
+# MAX_KEPT_ROWS rows.
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+JOB_WORKERS = 4
+JOB_TIMEOUT = 300  # seconds
+JOB_TTL = 600  # finished jobs are kept this long for paging
+MAX_JOB_ROWS = 200000
+MAX_ACTIVE_JOBS = 2  # queued or running, per owner
+MAX_KEPT_JOBS = 5  # all states, per owner
+MAX_KEPT_ROWS = 1000000  # finished rows held across all owners
+FETCH_SIZE = 5000
+PROGRESS_OPS = 10000  # SQLite VM instructions between cancellation checks
+
+FINISHED = ('done', 'failed', 'cancelled', 'timeout')
+
+
+class Job:
+    def __init__(self, owner, sql, params, timeout, finish=None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.sql = sql
+        self.params = params or {}
+        self.timeout = timeout
+        self.finish = finish
+        self.status = 'queued'
+        self.error = None
+        self.columns = []
+        self.rows = []
+        self.truncated = False
+        self.extra = {}
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.cancel_event = threading.Event()
+
+    def expired(self):
+        return self.started is not None and time.time() > self.started + self.timeout
+
+    def info(self):
+        end = self.finished or time.time()
+        info = {
+            'id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'columns': self.columns,
+            'rows_fetched': len(self.rows),
+            'truncated': self.truncated,
+            'elapsed': round(end - self.started, 3) if self.started else 0,
+        }
+        info.update(self.extra)
+        return info
+
+
+def run_job(engine, job):
+    if job.cancel_event.is_set():
+        job.status = 'cancelled'
+        return
+
+    job.status = 'running'
+    job.started = time.time()
+
+    def interrupt():
+        # A non-zero return aborts the statement with "interrupted"
+        return 1 if job.cancel_event.is_set() or job.expired() else 0
+
+    try:
+        with engine.connect() as conn:
+            raw = conn.connection.driver_connection
+            raw.set_progress_handler(interrupt, PROGRESS_OPS)
+            try:
+                result = conn.execute(text(job.sql), job.params)
+                job.columns = list(result.keys())
+                while True:
+                    chunk = result.fetchmany(FETCH_SIZE)
+                    if not chunk:
+                        break
+                    room = MAX_JOB_ROWS - len(job.rows)
+                    job.rows.extend(tuple(row) for row in chunk[:room])
+                    if len(chunk) > room:
+                        job.truncated = True
+                        break
+                    if interrupt():
+                        raise RuntimeError("interrupted")
+                result.close()
+            finally:
+                raw.set_progress_handler(None, 0)
+
+        if job.finish is not None:
+            job.extra = job.finish(job.columns, job.rows) or {}
+        job.status = 'done'
+    except Exception as e:
+        if job.cancel_event.is_set():
+            job.status = 'cancelled'
+        elif job.expired():
+            job.status = 'timeout'
+            job.error = f"Query exceeded the {job.timeout}s limit"
+        else:
+            job.status = 'failed'
+            job.error = str(e)
+    finally:
+        job.finished = time.time()
+
+
+class JobManager:
+    def __init__(self, workers=JOB_WORKERS, timeout=JOB_TIMEOUT):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dqbe-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, engine, owner, sql, params=None, timeout=None, finish=None):
+        # finish(columns, rows) runs on the worker once the rows are in and
+        # returns extra fields for the job's status. Returns None when the
+        # owner is at their job cap.
+        self._purge()
+        timeout = min(timeout or self.timeout, self.timeout)
+        job = Job(owner, sql, params, timeout, finish)
+        with self._lock:
+            owned = sorted((other for other in self._jobs.values() if other.owner == owner),
+                           key=lambda other: other.created)
+            if sum(1 for other in owned if other.status not in FINISHED) >= MAX_ACTIVE_JOBS:
+                return None
+            # Make room by dropping the owner's oldest finished jobs
+            finished = [other for other in owned if other.status in FINISHED]
+            while len(owned) >= MAX_KEPT_JOBS and finished:
+                oldest = finished.pop(0)
+                owned.remove(oldest)
+                del self._jobs[oldest.id]
+            if len(owned) >= MAX_KEPT_JOBS:
+                return None
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(run_job, engine, job)
+        return job
+
+    def get(self, owner, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job.owner != owner:
+            return None
+        return job
+
+    def list(self, owner):
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.owner == owner]
+        return sorted(jobs, key=lambda job: job.created, reverse=True)
+
+    def cancel(self, owner, job_id):
+        job = self.get(owner, job_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        if job.future.cancel():
+            # Never started, so the worker will not record it
+            job.status = 'cancelled'
+            job.finished = time.time()
+        return job
+
+    def page(self, job, offset=0, limit=100):
+        # Rows are readable while the job is still fetching
+        rows = job.rows[offset:offset + limit]
+        end = offset + len(rows)
+        more = end < len(job.rows) or job.status not in FINISHED
+        return {
+            'status': job.status,
+            'columns': job.columns,
+            'rows': rows,
+            'offset': offset,
+            'next': end if more else None,
+        }
+
+    def _purge(self):
+        cutoff = time.time() - JOB_TTL
+        with self._lock:
+            finished = sorted((job for job in self._jobs.values() if job.status in FINISHED),
+                              key=lambda job: job.finished or 0)
+            kept = sum(len(job.rows) for job in finished)
+            for job in finished:
+                if (job.finished or 0) >= cutoff and kept <= MAX_KEPT_ROWS:
+                    break
+                kept -= len(job.rows)
+                del self._jobs[job.id]
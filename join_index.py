@@ -0,0 +1,120 @@
+# Join-path index. The join graph is derived from reflected foreign keys and
+# column naming conventions, shortest join paths between every pair of tables
+# are computed once per schema version, and the from-clause for each path is
+# built once and reused.
+
+import threading
+from collections import deque
+
+
+def _singular(name):
+    if name.endswith('ies'):
+        return name[:-3] + 'y'
+    if name.endswith('s') and not name.endswith('ss'):
+        return name[:-1]
+    return name
+
+
+def describe_tables(tables):
+    # Column names and foreign keys of reflected Table objects, the only
+    # schema information the index needs
+    columns = {name: [col.name for col in table.columns] for name, table in tables.items()}
+    foreign_keys = {
+        name: [(fk.parent.name, fk.column.table.name, fk.column.name) for fk in table.foreign_keys]
+        for name, table in tables.items()
+    }
+    return columns, foreign_keys
+
+
+def discover_edges(columns, foreign_keys):
+    # Returns {left: {right: (left_column, right_column)}}, symmetric.
+    # Declared foreign keys win; otherwise a table "customers" is joined on
+    # its customer_id / customer_name key from any table that has a column
+    # of the same name, or a bare "customer" column.
+    graph = {name: {} for name in columns}
+
+    def add(left, left_col, right, right_col):
+        if left == right or right in graph[left]:
+            return
+        graph[left][right] = (left_col, right_col)
+        graph[right][left] = (right_col, left_col)
+
+    for name in sorted(foreign_keys):
+        for col, ref_table, ref_col in foreign_keys[name]:
+            if ref_table in columns:
+                add(name, col, ref_table, ref_col)
+
+    for right in sorted(columns):
+        stem = _singular(right)
+        keys = [key for key in (f"{stem}_id", f"{stem}_name") if key in columns[right]]
+        for left in sorted(columns):
+            if left == right:
+                continue
+            for key in keys:
+                if key in columns[left]:
+                    add(left, key, right, key)
+                    break
+                if key == f"{stem}_name" and stem in columns[left]:
+                    add(left, stem, right, key)
+                    break
+
+    return graph
+
+
+def shortest_paths(graph):
+    # One BFS per source table with parent pointers; each path is then read
+    # back once instead of copying partial paths for every neighbour
+    paths = {}
+    for source in graph:
+        parents = {source: None}
+        queue = deque([source])
+        while queue:
+            node = queue.popleft()
+            for neighbor in sorted(graph[node]):
+                if neighbor not in parents:
+                    parents[neighbor] = node
+                    queue.append(neighbor)
+        for target in parents:
+            path = []
+            node = target
+            while node is not None:
+                path.append(node)
+                node = parents[node]
+            paths[(source, target)] = tuple(reversed(path))
+    return paths
+
+
+class JoinIndex:
+    def __init__(self):
+        self.version = None
+        self.graph = {}
+        self.paths = {}
+        self._from_clauses = {}
+        self._lock = threading.Lock()
+
+    def build(self, version, columns, foreign_keys):
+        # Rebuilds only when the schema version differs from the indexed one
+        with self._lock:
+            if version is not None and version == self.version:
+                return False
+            graph = discover_edges(columns, foreign_keys)
+            self.paths = shortest_paths(graph)
+            self.graph = graph
+            self._from_clauses = {}
+            self.version = version
+            return True
+
+    def path(self, start, end):
+        return self.paths.get((start, end))
+
+    def from_clause(self, tables, path):
+        path = tuple(path)
+        key = (path, tuple(tables[name] for name in path))
+        from_clause = self._from_clauses.get(key)
+        if from_clause is None:
+            from_clause = tables[path[0]]
+            for left, right in zip(path, path[1:]):
+                left_col, right_col = self.graph[left][right]
+                from_clause = from_clause.join(tables[right], tables[left].c[left_col] == tables[right].c[right_col])
+            self._from_clauses[key] = from_clause
+        return from_clause
@@ -0,0 +1,162 @@
+# Conditional responses and fragment caching for the dashboard and reports.
+# Every table has a data version that advances as the change log
+# (incremental.py) records writes to it. A chart's ETag hashes its saved
+# definition together with the versions of the tables it reads, so an
+# unchanged chart is answered with 304 Not Modified before its query runs.
+# Each chart's serialized payload is cached under the same inputs in an LRU
+# bounded by bytes. The page shells only depend on the saved definitions.
+#
+# DQBE_FRAGMENT_CACHE_MB sets the fragment cache size (default 16).
+
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+from collections import Counter, OrderedDict
+
+from flask import make_response
+
+import chart_refresh
+import incremental
+import rollups
+
+FRAGMENT_CACHE_BYTES = int(float(os.environ.get('DQBE_FRAGMENT_CACHE_MB', 16)) * 2 ** 20)
+FILL_LOCKS = 16
+
+_identifier = re.compile(r"\w+")
+
+
+class TableVersions:
+    # Per-table counters, bumped for each change-log window that touched the
+    # table. They live in memory, so each process tags them with a random
+    # epoch: after a restart clients get one full response, never a stale 304.
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.position = None
+        self.generation = 0  # bumped when the log cannot say what changed
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def _advance(self, conn):
+        until = incremental.current_position(conn)
+        if self.position is None:
+            self.position = until
+        elif until != self.position:
+            changed = None
+            if until > self.position:
+                changed = incremental.changed_tables(conn, self.position, until)
+            if changed is None:
+                self.generation += 1
+            else:
+                self.counters.update(changed)
+            self.position = until
+
+    def snapshot(self, engine, tables):
+        # {table name: version}; tables without a change log fall back to the
+        # database file stamp, which moves on every commit
+        with engine.connect() as conn, self._lock:
+            self._advance(conn)
+            logged = {name: f"{self.epoch}.{self.generation}.{self.counters[name]}"
+                      for name in tables if name in incremental.LOGGED_TABLES}
+        stamp = None
+        versions = {}
+        for name in tables:
+            if name in logged:
+                versions[name] = logged[name]
+            else:
+                if stamp is None:
+                    stamp = repr(chart_refresh.data_version(engine))
+                versions[name] = stamp
+        return versions
+
+
+def item_tables(item, tables):
+    # Tables a saved chart or report reads, going by the names in its SQL
+    # (the rollup stands for sales); all of them when none can be found
+    sql = item.get('query') or ''
+    tokens = set(_identifier.findall(sql))
+    if rollups.ROLLUP_TABLE in tokens:
+        tokens.add('sales')
+    names = {name for name in tables if name in tokens or (not _identifier.fullmatch(name) and name in sql)}
+    return sorted(names or tables)
+
+
+def _digest(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def fragment_key(kind, position, item, versions, tables):
+    return _digest(kind, position, item, [(name, versions[name]) for name in item_tables(item, tables)])
+
+
+def shell_etag(kind, items, epoch):
+    # The epoch changes with every restart, so a redeployed template is
+    # never answered with 304
+    return _digest(kind, items, epoch)
+
+
+def conditional(response, tag):
+    response.set_etag(tag)
+    # The pages are per owner: browsers keep them but revalidate every view
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(tag):
+    return conditional(make_response('', 304), tag)
+
+
+class FragmentCache:
+    def __init__(self, max_bytes=FRAGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._fill_locks = [threading.Lock() for _ in range(FILL_LOCKS)]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def fill_lock(self, name):
+        # Serializes filling the cache for one name (e.g. an owner's page);
+        # names share a fixed set of locks
+        return self._fill_locks[hash(name) % FILL_LOCKS]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, fragment):
+        # fragment is rendered text or serialized bytes
+        size = len(fragment if isinstance(fragment, bytes) else fragment.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._entries[key] = (fragment, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+                self._stats['evictions'] += 1
+
+    def record(self, outcome):
+        with self._lock:
+            self._stats[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self.size, max_bytes=self.max_bytes)
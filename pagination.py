@@ -0,0 +1,267 @@
+# Keyset pagination over report queries. A page is the next `limit` rows of
+# the query ordered by a key column, continuing from an opaque cursor that
+# records the last key value seen and how many rows with that value were
+# already returned, so no page ever re-reads or holds the rows before it.
+# When the caller names tiebreak columns that identify a row (a grouped
+# result's group column, or a row-level query's hidden dqbe_key_* row keys),
+# the cursor records the last row's key and tiebreak values instead, so a
+# page starts right after the last row even inside a run of equal keys, and
+# without a key the tiebreak alone orders the pages. With neither (e.g. the
+# query sorts by a column it does not select), pages follow the query's own
+# order by offset.
+
+import base64
+import json
+from bisect import bisect_left, bisect_right
+
+from sqlalchemy import text
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+COUNT_CAP = 10000
+
+# Columns with this prefix only carry row keys for paging and are left out
+# of the page
+HIDDEN_PREFIX = 'dqbe_key_'
+
+
+def encode_cursor(value, dups):
+    raw = json.dumps([value, dups], default=str).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    # The second value is a row count, or the tiebreak values of the last row
+    value, after = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return value, after
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _strip(sql):
+    return sql.strip().rstrip(';')
+
+
+def page_limit(raw, default=PAGE_SIZE):
+    try:
+        limit = int(raw)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def fetch_page(conn, sql, params=None, key=None, order='asc', cursor=None, limit=PAGE_SIZE, tiebreak=()):
+    # Returns {'columns', 'rows', 'next'}; 'next' is None on the last page.
+    # With no key and no tiebreak the query's own order is kept. SQLite sorts
+    # NULLs first ascending and last descending, which the cursor conditions
+    # mirror.
+    params = dict(params or {})
+    source = f"({_strip(sql)}) AS dqbe_page"
+
+    tiebreak = tuple(name for name in tiebreak if name != key)
+    if tiebreak:
+        return _fetch_tiebreak_page(conn, source, params, key, order, cursor, limit, tiebreak)
+    if key is None:
+        return _fetch_offset_page(conn, source, params, cursor, limit)
+    key_col = _quote(key)
+    direction = 'DESC' if order == 'desc' else 'ASC'
+
+    where = ""
+    offset = 0
+    if cursor:
+        last, offset = decode_cursor(cursor)
+        offset = int(offset)
+        if last is None:
+            where = "" if direction == 'ASC' else f"WHERE {key_col} IS NULL"
+        elif direction == 'ASC':
+            where = f"WHERE {key_col} >= :dqbe_last"
+        else:
+            where = f"WHERE ({key_col} <= :dqbe_last OR {key_col} IS NULL)"
+        params['dqbe_last'] = last
+
+    page_sql = (f"SELECT * FROM {source} {where} ORDER BY {key_col} {direction} "
+                f"LIMIT :dqbe_limit OFFSET :dqbe_offset")
+    params['dqbe_limit'] = limit + 1
+    params['dqbe_offset'] = offset
+
+    result = conn.execute(text(page_sql), params)
+    columns = list(result.keys())
+    if key not in columns:
+        raise ValueError(f"Unknown key column: {key}")
+    rows = [tuple(row) for row in result]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        key_idx = columns.index(key)
+        last = rows[-1][key_idx]
+        dups = 0
+        for row in reversed(rows):
+            if row[key_idx] != last:
+                break
+            dups += 1
+        if dups == len(rows) and cursor:
+            # The whole page shared the previous page's last key
+            prev_last, prev_dups = decode_cursor(cursor)
+            if prev_last == last:
+                dups += int(prev_dups)
+        next_cursor = encode_cursor(last, dups)
+
+    return _page(columns, rows, next_cursor)
+
+
+def _fetch_tiebreak_page(conn, source, params, key, order, cursor, limit, tiebreak):
+    # Ordered by the key, then the tiebreak ascending; (key, tiebreak) is
+    # unique, so the cursor condition is a plain "after this row"
+    tie_cols = ", ".join(_quote(name) for name in tiebreak)
+    order_by = tie_cols
+    if key is not None:
+        key_col = _quote(key)
+        descending = order == 'desc'
+        order_by = f"{key_col} {'DESC' if descending else 'ASC'}, {tie_cols}"
+
+    where = ""
+    if cursor:
+        last, ties = decode_cursor(cursor)
+        if not isinstance(ties, list) or len(ties) != len(tiebreak):
+            raise ValueError("Invalid cursor")
+        if len(ties) == 1 and ties[0] is None:
+            # A NULL group sorts first
+            after_tie = f"{tie_cols} IS NOT NULL"
+        else:
+            after_tie = f"({tie_cols}) > ({', '.join(f':dqbe_tie_{n}' for n in range(len(ties)))})"
+            params.update((f'dqbe_tie_{n}', value) for n, value in enumerate(ties))
+
+        if key is None:
+            where = f"WHERE {after_tie}"
+        elif last is None:
+            same = f"{key_col} IS NULL AND {after_tie}"
+            where = f"WHERE {same}" if descending else f"WHERE ({same}) OR {key_col} IS NOT NULL"
+        else:
+            params['dqbe_last'] = last
+            beyond = f"{key_col} < :dqbe_last OR {key_col} IS NULL" if descending else f"{key_col} > :dqbe_last"
+            where = f"WHERE {beyond} OR ({key_col} = :dqbe_last AND {after_tie})"
+
+    params['dqbe_limit'] = limit + 1
+    result = conn.execute(text(f"SELECT * FROM {source} {where} ORDER BY {order_by} LIMIT :dqbe_limit"), params)
+    columns = list(result.keys())
+    for name in (key, *tiebreak):
+        if name is not None and name not in columns:
+            raise ValueError(f"Unknown key column: {name}")
+    rows = [tuple(row) for row in result]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_row = rows[-1]
+        next_cursor = encode_cursor(None if key is None else last_row[columns.index(key)],
+                                    [last_row[columns.index(name)] for name in tiebreak])
+    return _page(columns, rows, next_cursor)
+
+
+def _page(columns, rows, next_cursor):
+    hidden = [n for n, name in enumerate(columns) if name.startswith(HIDDEN_PREFIX)]
+    if hidden:
+        keep = [n for n in range(len(columns)) if n not in hidden]
+        columns = [columns[n] for n in keep]
+        rows = [tuple(row[n] for n in keep) for row in rows]
+    return {'columns': columns, 'rows': rows, 'next': next_cursor}
+
+
+def page_rows(columns, rows, key=None, order='asc', cursor=None, limit=PAGE_SIZE, tiebreak=()):
+    # fetch_page over a result already in memory (e.g. computed by the
+    # columnar mirror): the same order and the same cursors, so any page can
+    # come from either
+    tiebreak = tuple(name for name in tiebreak if name != key)
+    if key is None and not tiebreak:
+        offset = int(decode_cursor(cursor)[1]) if cursor else 0
+        more = len(rows) > offset + limit
+        return _page(columns, [tuple(row) for row in rows[offset:offset + limit]],
+                     encode_cursor(None, offset + limit) if more else None)
+    for name in (key, *tiebreak):
+        if name is not None and name not in columns:
+            raise ValueError(f"Unknown key column: {name}")
+    key_idx = None if key is None else columns.index(key)
+    tie_idx = [columns.index(name) for name in tiebreak]
+    descending = order == 'desc'
+
+    def sort_key(value, ties):
+        head = ()
+        if key_idx is not None:
+            head = (_Descending(_sort_value(value)) if descending else _sort_value(value),)
+        return head + tuple(_sort_value(tie) for tie in ties)
+
+    keyed = sorted(((sort_key(None if key_idx is None else row[key_idx], [row[n] for n in tie_idx]), tuple(row))
+                    for row in rows), key=lambda entry: entry[0])
+    keys = [entry[0] for entry in keyed]
+
+    start = 0
+    if cursor:
+        last, after = decode_cursor(cursor)
+        if tiebreak:
+            if not isinstance(after, list) or len(after) != len(tiebreak):
+                raise ValueError("Invalid cursor")
+            start = bisect_right(keys, sort_key(last, after))
+        else:
+            start = bisect_left(keys, sort_key(last, ())) + int(after)
+
+    end = start + limit
+    page = [row for _, row in keyed[start:end]]
+    next_cursor = None
+    if end < len(keyed):
+        last_row = page[-1]
+        last = None if key_idx is None else last_row[key_idx]
+        if tiebreak:
+            next_cursor = encode_cursor(last, [last_row[n] for n in tie_idx])
+        else:
+            next_cursor = encode_cursor(last, end - bisect_left(keys, sort_key(last, ())))
+    return _page(columns, page, next_cursor)
+
+
+def _sort_value(value):
+    # SQLite orders NULL before numbers before text before blobs
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, bytes):
+        return (3, value)
+    return (2, str(value))
+
+
+class _Descending:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _fetch_offset_page(conn, source, params, cursor, limit):
+    # The cursor holds the offset of the next page
+    offset = int(decode_cursor(cursor)[1]) if cursor else 0
+    params.update(dqbe_limit=limit + 1, dqbe_offset=offset)
+    result = conn.execute(text(f"SELECT * FROM {source} LIMIT :dqbe_limit OFFSET :dqbe_offset"), params)
+    columns = list(result.keys())
+    rows = [tuple(row) for row in result]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(None, offset + limit)
+    return _page(columns, rows, next_cursor)
+
+
+def approximate_count(conn, sql, params=None, cap=COUNT_CAP):
+    # Counts at most `cap` rows so a huge report never pays for a full count;
+    # the caller gets a lower bound when the cap is hit
+    count_sql = f"SELECT count(*) FROM (SELECT 1 FROM ({_strip(sql)}) LIMIT {int(cap) + 1})"
+    total = conn.execute(text(count_sql), dict(params or {})).scalar()
+    return {'total': min(total, cap), 'total_is_lower_bound': total > cap}
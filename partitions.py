@@ -0,0 +1,540 @@
+# Monthly partitions of sales for date-filtered aggregates. sales stays the
+# system of record (the change log, rollup and sample all follow it); its
+# rows are also laid out one month per partition, and a builder query or a
+# saved chart recompute with a date range scans only the partitions whose
+# order_date bounds overlap the range, each on its own connection in
+# parallel, merging per-group SUM/COUNT partials like incremental.py does.
+#
+# Recent months are tables in the main database (dqbe_sales_YYYY_MM) that
+# follow sales through the change log, like the columnar mirror: a sync
+# applies the inserts, updates and deletes since its last position and
+# rebuilds every partition after a bulk load or a gap in the log. Months
+# older than the newest HOT_MONTHS are compacted into their own read-only
+# SQLite file (rows clustered by date, vacuumed, opened immutable) and the
+# table is dropped; a later change to such a month thaws it back into a
+# table. A background thread syncs and compacts periodically, and sooner
+# when a read finds the partitions behind sales; until then such reads run
+# on sales.
+#
+# Enabled with DQBE_PARTITIONS=path/to/directory for the cold files;
+# DQBE_PARTITION_HOT_MONTHS (default 3), DQBE_PARTITION_WORKERS (default 4)
+# and DQBE_PARTITION_SYNC (seconds, default 60) tune it.
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import stat
+import tempfile
+import threading
+from collections import Counter
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import (MetaData, Table, Column, Index, Integer, Text, create_engine, select, func, and_,
+                        text, type_coerce)
+from sqlalchemy.dialects import sqlite
+
+import chart_series
+import incremental
+import query_builder
+
+READER_NAME = "partitions"
+FACT_TABLE = incremental.FACT_TABLE
+DATE_COLUMN = "order_date"
+PARTITION_PREFIX = "dqbe_sales_"
+HOT_MONTHS = int(os.environ.get('DQBE_PARTITION_HOT_MONTHS', 3))
+MAX_WORKERS = int(os.environ.get('DQBE_PARTITION_WORKERS', 4))
+SYNC_INTERVAL = 60
+
+_month = re.compile(r"\d{4}-\d{2}")
+
+partition_metadata = MetaData()
+
+# One row per partition. path is set while the month is compacted into a
+# cold file; version moves on every change so compaction can compare-and-set.
+partition_catalog = Table(
+    "dqbe_partitions", partition_metadata,
+    Column("month", Text, primary_key=True),
+    Column("table_name", Text, nullable=False),
+    Column("path", Text),
+    Column("row_count", Integer, nullable=False),
+    Column("min_date", Text),
+    Column("max_date", Text),
+    Column("version", Integer, nullable=False),
+)
+
+partition_state = Table(
+    "dqbe_partition_state", partition_metadata,
+    Column("name", Text, primary_key=True),
+    Column("position", Integer, nullable=False),
+    Column("columns", Text, nullable=False),
+)
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='dqbe-partition')
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _json_list(values):
+    return "[" + ",".join(str(int(value)) for value in values) + "]"
+
+
+def table_name(month):
+    # dqbe_sales_2024_07; months that are not YYYY-MM (odd or missing
+    # dates) get a stable hashed name
+    if _month.fullmatch(month):
+        return PARTITION_PREFIX + month.replace('-', '_')
+    return PARTITION_PREFIX + "x" + hashlib.sha1(month.encode()).hexdigest()[:8]
+
+
+def overlaps(partition, start_date, end_date):
+    # Whether a partition can hold rows with order_date BETWEEN start and
+    # end; a partition of NULL dates never does
+    if partition['min_date'] is None:
+        return False
+    return not (partition['max_date'] < start_date or partition['min_date'] > end_date)
+
+
+class PartitionTables(Mapping):
+    # The app's tables with sales swapped for one partition, so the builder's
+    # join and filter helpers produce the same query over the partition
+    def __init__(self, tables, partition):
+        self.tables = tables
+        self.partition = partition
+
+    def __getitem__(self, name):
+        return self.partition if name == FACT_TABLE else self.tables[name]
+
+    def __iter__(self):
+        return iter(self.tables)
+
+    def __len__(self):
+        return len(self.tables)
+
+    def __contains__(self, name):
+        return name in self.tables
+
+
+class PartitionStore:
+    def __init__(self, directory, engine, read_engine, sales, hot_months=HOT_MONTHS):
+        self.directory = directory
+        self.engine = engine
+        self.read_engine = read_engine
+        self.hot_months = hot_months
+        self.key = incremental.LOGGED_TABLES[FACT_TABLE]
+        self.columns = [column.name for column in sales.columns]
+        self.sales = sales
+        self._tables = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stats = Counter()
+        # Cold files are attached by URI when the read pool accepts them
+        self._uri = read_engine.url.query.get('uri') == 'true'
+        os.makedirs(directory, exist_ok=True)
+        partition_metadata.create_all(engine)
+
+    def _table(self, name):
+        # A Table per partition, shaped like sales, with an order_date index
+        table = self._tables.get(name)
+        if table is None:
+            metadata = MetaData()
+            table = Table(name, metadata,
+                          *[Column(column.name, column.type, primary_key=column.name == self.key)
+                            for column in self.sales.columns])
+            Index(f"{name}_{DATE_COLUMN}", table.c[DATE_COLUMN])
+            table = self._tables[name] = table
+        return table
+
+    def _month_sql(self, alias=None):
+        column = _quote(DATE_COLUMN) if alias is None else f"{alias}.{_quote(DATE_COLUMN)}"
+        return f"coalesce(substr({column}, 1, 7), '')"
+
+    # Sync
+
+    def _create(self, conn, month):
+        name = table_name(month)
+        self._table(name).create(conn, checkfirst=True)
+        conn.execute(partition_catalog.insert().values(month=month, table_name=name, path=None, row_count=0,
+                                                       min_date=None, max_date=None, version=0))
+        return name
+
+    def _copy_rows(self, conn, name, where, params):
+        names = ", ".join(_quote(column) for column in self.columns)
+        conn.execute(text(f"INSERT OR REPLACE INTO {_quote(name)} ({names}) "
+                          f"SELECT {names} FROM {FACT_TABLE} WHERE {where}"), params)
+
+    def _read_cold(self, path, where="", params=()):
+        # Rows of a cold file, read on a private connection (ATTACH is not
+        # allowed inside the sync's transaction)
+        cold = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True)
+        try:
+            name = cold.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+            return cold.execute(f"SELECT {', '.join(_quote(column) for column in self.columns)} "
+                                f"FROM {_quote(name)} {where}", params).fetchall()
+        finally:
+            cold.close()
+
+    def _thaw(self, conn, partition, retired):
+        # Brings a cold month back into a table so it can take changes
+        name = partition['table_name']
+        self._table(name).create(conn, checkfirst=True)
+        rows = self._read_cold(partition['path'])
+        if rows:
+            placeholders = ", ".join("?" for _ in self.columns)
+            names = ", ".join(_quote(column) for column in self.columns)
+            conn.exec_driver_sql(f"INSERT INTO {_quote(name)} ({names}) VALUES ({placeholders})", rows)
+        conn.execute(partition_catalog.update().where(partition_catalog.c.month == partition['month'])
+                     .values(path=None))
+        retired.append(partition['path'])
+        partition['path'] = None
+        self._stats['thawed'] += 1
+
+    def _rebuild(self, conn, retired):
+        for partition in conn.execute(select(partition_catalog)).fetchall():
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS {_quote(partition.table_name)}")
+            if partition.path:
+                retired.append(partition.path)
+        conn.execute(partition_catalog.delete())
+        months = [row[0] for row in conn.execute(text(f"SELECT DISTINCT {self._month_sql()} FROM {FACT_TABLE}"))]
+        for month in months:
+            name = self._create(conn, month)
+            self._copy_rows(conn, name, f"{self._month_sql()} = :month", {"month": month})
+        return set(months)
+
+    def _apply(self, conn, changes, retired):
+        inserted = set(changes.get((FACT_TABLE, 'I'), []))
+        updated = set(changes.get((FACT_TABLE, 'U'), []))
+        deleted = set(changes.get((FACT_TABLE, 'D'), []))
+        stale = updated | deleted
+        fresh = (inserted | updated) - deleted
+        touched = set()
+        partitions = {row.month: dict(row._mapping) for row in conn.execute(select(partition_catalog))}
+
+        if stale:
+            ids = _json_list(stale)
+            for partition in partitions.values():
+                if partition['path']:
+                    found = self._read_cold(partition['path'],
+                                            f"WHERE {_quote(self.key)} IN (SELECT value FROM json_each(?)) LIMIT 1",
+                                            (ids,))
+                    if not found:
+                        continue
+                    self._thaw(conn, partition, retired)
+                removed = conn.execute(text(
+                    f"DELETE FROM {_quote(partition['table_name'])} "
+                    f"WHERE {_quote(self.key)} IN (SELECT value FROM json_each(:ids))"), {"ids": ids}).rowcount
+                if removed:
+                    touched.add(partition['month'])
+
+        if fresh:
+            ids = _json_list(fresh)
+            months = [row[0] for row in conn.execute(text(
+                f"SELECT DISTINCT {self._month_sql()} FROM {FACT_TABLE} "
+                f"WHERE {_quote(self.key)} IN (SELECT value FROM json_each(:ids))"), {"ids": ids})]
+            for month in months:
+                partition = partitions.get(month)
+                if partition is None:
+                    self._create(conn, month)
+                elif partition['path']:
+                    self._thaw(conn, partition, retired)
+                self._copy_rows(conn, table_name(month),
+                                f"{_quote(self.key)} IN (SELECT value FROM json_each(:ids)) "
+                                f"AND {self._month_sql()} = :month", {"ids": ids, "month": month})
+                touched.add(month)
+        return touched
+
+    def _update_bounds(self, conn, months):
+        for month in months:
+            name = table_name(month)
+            count, low, high = conn.execute(text(
+                f"SELECT count(*), min({_quote(DATE_COLUMN)}), max({_quote(DATE_COLUMN)}) FROM {_quote(name)}")).first()
+            if not count:
+                conn.exec_driver_sql(f"DROP TABLE {_quote(name)}")
+                conn.execute(partition_catalog.delete().where(partition_catalog.c.month == month))
+                continue
+            conn.execute(partition_catalog.update().where(partition_catalog.c.month == month).values(
+                row_count=count, min_date=None if low is None else str(low),
+                max_date=None if high is None else str(high), version=partition_catalog.c.version + 1))
+
+    def sync(self, blocking=True):
+        # Brings the partitions up to date with sales; returns 'current',
+        # 'applied' or 'rebuilt', or None when another sync holds the lock
+        # and blocking is off
+        if not self._lock.acquire(blocking=blocking):
+            return None
+        retired = []
+        try:
+            signature = json.dumps(self.columns)
+            with self.engine.begin() as conn:
+                state = conn.execute(select(partition_state).where(partition_state.c.name == FACT_TABLE)).first()
+                until = incremental.current_position(conn)
+                if state is not None and state.position == until and state.columns == signature:
+                    return 'current'
+
+                # Compare-and-set first: it takes the write lock, so another
+                # worker's sync of the same window loses and nothing else
+                # writes to sales while the rows are copied
+                if state is None:
+                    conn.execute(partition_state.insert().values(name=FACT_TABLE, position=until, columns=signature))
+                else:
+                    claimed = conn.execute(partition_state.update().where(and_(
+                        partition_state.c.name == FACT_TABLE, partition_state.c.position == state.position))
+                        .values(position=until, columns=signature)).rowcount
+                    if not claimed:
+                        return 'current'
+
+                changes = None
+                if state is not None and state.columns == signature:
+                    changes = incremental.changes_since(conn, state.position, until)
+                if changes is None:
+                    touched = self._rebuild(conn, retired)
+                    outcome = 'rebuilt'
+                else:
+                    touched = self._apply(conn, changes, retired)
+                    outcome = 'applied'
+                self._update_bounds(conn, touched)
+
+            incremental.set_reader_position(self.engine, READER_NAME, until)
+            self._stats[outcome] += 1
+            return outcome
+        finally:
+            self._lock.release()
+            self._remove(retired)
+
+    def _remove(self, paths):
+        # Cold files are only deleted once the catalog no longer points at them
+        for path in paths:
+            try:
+                os.chmod(path, stat.S_IWUSR | stat.S_IRUSR)
+                os.remove(path)
+            except OSError:
+                pass
+
+    # Compaction
+
+    def _write_cold(self, path, name, rows):
+        # Written under a unique temporary name, then renamed into place
+        fd, tmp = tempfile.mkstemp(prefix=f"{name}.", suffix=".tmp", dir=self.directory)
+        os.close(fd)
+        cold_engine = create_engine(f"sqlite:///{tmp}")
+        try:
+            table = self._table(name)
+            with cold_engine.begin() as conn:
+                table.create(conn)
+                conn.execute(table.insert(), [dict(zip(self.columns, row)) for row in rows])
+            with cold_engine.connect() as conn:
+                conn.exec_driver_sql("VACUUM")
+        except Exception:
+            self._remove([tmp])
+            raise
+        finally:
+            cold_engine.dispose()
+        os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(tmp, path)
+
+    def compact(self):
+        # Moves every regular month older than the newest hot_months into a
+        # read-only file; returns the months compacted. Each month is moved
+        # under the sync lock, so a manual compaction and the background one
+        # (or a sync) never work on the same month at once.
+        with self.engine.connect() as conn:
+            months = sorted(month for month in conn.execute(select(partition_catalog.c.month)).scalars()
+                            if _month.fullmatch(month))
+        cold_months = months[:-self.hot_months] if self.hot_months else months
+
+        compacted = []
+        for month in cold_months:
+            with self._lock:
+                if self._compact_month(month):
+                    compacted.append(month)
+        return compacted
+
+    def _compact_month(self, month):
+        with self.engine.connect() as conn:
+            # One read transaction, so the rows match the version read
+            conn.exec_driver_sql("BEGIN")
+            partition = conn.execute(select(partition_catalog)
+                                     .where(partition_catalog.c.month == month)).first()
+            if partition is None or partition.path:
+                conn.rollback()
+                return False
+            table = self._table(partition.table_name)
+            rows = conn.execute(select(*[table.c[column] for column in self.columns])
+                                .order_by(table.c[DATE_COLUMN], table.c[self.key])).fetchall()
+            conn.rollback()
+
+        path = os.path.join(self.directory, f"{partition.table_name}.v{partition.version}.{os.getpid()}.db")
+        self._write_cold(path, partition.table_name, rows)
+        with self.engine.begin() as conn:
+            claimed = conn.execute(partition_catalog.update().where(and_(
+                partition_catalog.c.month == month, partition_catalog.c.version == partition.version,
+                partition_catalog.c.path.is_(None))).values(path=path)).rowcount
+            if claimed:
+                conn.exec_driver_sql(f"DROP TABLE {_quote(partition.table_name)}")
+        if not claimed:
+            # Changed while it was being copied (another process's sync); the
+            # next pass retries
+            self._remove([path])
+            return False
+        self._stats['compacted'] += 1
+        return True
+
+    # Scans
+
+    def _partial_query(self, shape, tables, join_index, partition):
+        # Per-group SUM and COUNT of the aggregate column over one partition
+        # (labels as stored), or None when the shape does not read sales
+        path = join_index.path(shape['table1'], shape['table2']) if shape['table2'] else [shape['table1']]
+        if not path or FACT_TABLE not in path:
+            return None
+        swapped = PartitionTables(tables, partition)
+        try:
+            resolved = query_builder.grouped_aggregate(shape, swapped)
+        except KeyError:
+            return None
+        if resolved is None:
+            return None
+
+        group_col, agg_col = resolved
+        group_expr = group_col
+        if chart_series.is_date_column(group_col) and shape['date_bucket'] not in (None, 'day'):
+            group_expr = chart_series.bucket_expression(group_col, shape['date_bucket'])
+        query = select(type_coerce(group_expr, Text()).label('label'), func.sum(agg_col), func.count(agg_col)) \
+            .select_from(join_index.from_clause(swapped, path))
+        filters = query_builder.filter_clauses(shape, swapped)
+        if filters:
+            query = query.where(and_(*filters))
+        return query.group_by(group_expr)
+
+    def _attach_target(self, path):
+        if self._uri:
+            return f"file:{path}?mode=ro&immutable=1"
+        return path
+
+    def _scan(self, partition, sql, params):
+        with self.read_engine.connect() as conn:
+            if partition['path'] is None:
+                return conn.exec_driver_sql(sql, params).fetchall()
+            if not os.path.exists(partition['path']):
+                # Thawed since the catalog was read
+                raise FileNotFoundError(partition['path'])
+            conn.exec_driver_sql("ATTACH DATABASE ? AS dqbe_cold", (self._attach_target(partition['path']),))
+            try:
+                return conn.exec_driver_sql(sql, params).fetchall()
+            finally:
+                conn.exec_driver_sql("DETACH DATABASE dqbe_cold")
+
+    def _snapshot(self):
+        with self.read_engine.connect() as conn:
+            conn.exec_driver_sql("BEGIN")
+            position = conn.execute(select(partition_state.c.position)
+                                    .where(partition_state.c.name == FACT_TABLE)).scalar()
+            partitions = [dict(row._mapping) for row in conn.execute(select(partition_catalog))]
+            current = incremental.current_position(conn)
+            conn.rollback()
+        return position, current, partitions
+
+    def partials(self, shape, params, tables, join_index):
+        # (change-log position, [[label, sum, count], ...]) for a date-filtered
+        # SUM/COUNT/AVG shape, scanning only the partitions in range, or None
+        # when the partitions cannot answer it
+        if not shape.get('dates') or not params.get('start_date') or not params.get('end_date'):
+            return None
+        position, current, partitions = self._snapshot()
+        if position is None:
+            # Not built yet; the background thread builds it
+            return None
+        if position != current:
+            # Behind sales: answer from sales and let the background thread
+            # catch up, so no read pays for (or waits on) a sync's writes
+            self._stats['behind'] += 1
+            self._wake.set()
+            return None
+
+        surviving = [partition for partition in partitions
+                     if overlaps(partition, str(params['start_date']), str(params['end_date']))]
+        self._stats['pruned'] += len(partitions) - len(surviving)
+
+        futures = []
+        for partition in surviving:
+            query = self._partial_query(shape, tables, join_index, self._table(partition['table_name']))
+            if query is None:
+                return None
+            compiled = query.compile(dialect=sqlite.dialect())
+            bound = tuple(params.get(name, compiled.params.get(name)) for name in compiled.positiontup or ())
+            futures.append(_executor.submit(self._scan, partition, str(compiled), bound))
+
+        # Labels come back as SQLite values, which hash like SQLite groups them
+        merged = {}
+        for future in futures:
+            for label, total, count in future.result():
+                entry = merged.setdefault(label, [label, None, 0])
+                if total is not None:
+                    entry[1] = total if entry[1] is None else entry[1] + total
+                entry[2] += count
+
+        # A sync that landed mid-scan may have mixed two versions of the rows
+        if self._snapshot()[0] != position:
+            return None
+        self._stats['scans'] += 1
+        self._stats['scanned'] += len(surviving)
+        return position, list(merged.values())
+
+    def execute(self, plan, shape, params, tables, join_index):
+        # (columns, rows) for a builder plan, or None when it should run on
+        # sales as usual (no date range, not an aggregate the partials cover,
+        # or the partitions are busy)
+        try:
+            result = self.partials(shape, params, tables, join_index)
+        except Exception as e:
+            print(f"[Partitions] falling back to sales: {e}")
+            return None
+        if result is None:
+            return None
+        return plan.columns, incremental.partial_rows(shape, result[1])
+
+    def start(self, interval=SYNC_INTERVAL):
+        def loop():
+            while True:
+                self._wake.clear()
+                try:
+                    self.sync()
+                    self.compact()
+                except Exception as e:
+                    print(f"[Partitions] maintenance failed: {e}")
+                # A read that found the partitions behind wakes it early
+                self._wake.wait(interval)
+
+        threading.Thread(target=loop, name='dqbe-partitions', daemon=True).start()
+
+    def stats(self):
+        with self.read_engine.connect() as conn:
+            partitions = conn.execute(select(partition_catalog.c.path, partition_catalog.c.row_count)).fetchall()
+        return dict(self._stats, partitions=len(partitions),
+                    cold=sum(1 for path, _ in partitions if path),
+                    hot_rows=sum(count for path, count in partitions if not path),
+                    hot_months=self.hot_months)
+
+
+def store(engine, read_engine, tables):
+    # The configured partition store, already syncing in the background, or None
+    directory = os.environ.get('DQBE_PARTITIONS')
+    if not directory or FACT_TABLE not in tables:
+        return None
+    sales = tables[FACT_TABLE]
+    if DATE_COLUMN not in sales.c or incremental.LOGGED_TABLES[FACT_TABLE] not in sales.c:
+        print("[Partitions] sales has no order_date or id column; not partitioning")
+        return None
+    partitions = PartitionStore(directory, engine, read_engine, sales)
+    interval = os.environ.get('DQBE_PARTITION_SYNC')
+    partitions.start(int(interval) if interval else SYNC_INTERVAL)
+    return partitions
+
+
+def eligible(shape, plan):
+    # Date-filtered aggregates over the base tables
+    return bool(shape['aggregate']) and shape['dates'] and not plan.uses_rollup
@@ -0,0 +1,310 @@
+# DQBE query builder with a plan cache. A report's "shape" (tables, fields,
+# aggregate, group-by, sort, distinct and which filters are present) decides
+# the statement; the filter values are bound parameters. Each shape is built
+# and compiled once, so repeated reports reuse the compiled SQL and SQLite's
+# prepared-statement cache.
+
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import select, and_, func, asc, desc, bindparam, literal_column, Text
+from sqlalchemy.dialects import sqlite
+
+import chart_series
+import pagination
+import rollups
+
+PLAN_CACHE_SIZE = 512
+
+SHAPE_FIELDS = ('table1', 'table2', 'fields', 'aggregate', 'aggregate_field', 'group_by',
+                'sort_field', 'sort_order', 'distinct', 'region', 'dates', 'date_bucket')
+
+
+def shape_from_form(form, date_bounds=(None, None), tables=None):
+    # Splits the builder form into the query shape and its parameter values.
+    # date_bounds is the full date range, used to size date buckets when the
+    # form has no date filter; tables (name -> Table) tells which group-by
+    # columns are dates.
+    region = form.get('region') or None
+    start_date = form.get('start_date') or None
+    end_date = form.get('end_date') or None
+    sort_field = form.get('sort_field') or None
+
+    shape = {
+        'table1': form.get('table1') or None,
+        'table2': form.get('table2') or None,
+        'fields': tuple(form.getlist('fields')),
+        'aggregate': form.get('aggregate') or None,
+        'aggregate_field': form.get('aggregate_field') or None,
+        'group_by': form.get('group_by') or None,
+        'sort_field': sort_field,
+        'sort_order': ('asc' if form.get('sort_order') == 'asc' else 'desc') if sort_field else None,
+        'distinct': form.get('distinct') == 'on',
+        'region': region is not None,
+        'dates': bool(start_date and end_date),
+        'date_bucket': None,
+    }
+
+    # Aggregates grouped by a date are bucketed by day, week or month
+    if shape['aggregate'] and _groups_by_date(shape, tables):
+        if shape['dates']:
+            shape['date_bucket'] = chart_series.date_bucket(start_date, end_date)
+        else:
+            shape['date_bucket'] = chart_series.date_bucket(*date_bounds)
+
+    params = {}
+    if shape['region']:
+        params['region'] = region
+    if shape['dates']:
+        params['start_date'] = start_date
+        params['end_date'] = end_date
+
+    return shape, params
+
+
+def _groups_by_date(shape, tables):
+    group_by = shape['group_by']
+    if not group_by:
+        return False
+    if tables is None:
+        return group_by.endswith('_date')
+    for name in (shape['table1'], shape['table2']):
+        table = tables.get(name) if name else None
+        if table is not None and group_by in table.c:
+            return chart_series.is_date_column(table.c[group_by])
+    return False
+
+
+def shape_key(shape):
+    return tuple(shape[field] for field in SHAPE_FIELDS)
+
+
+class QueryPlan:
+    def __init__(self, query, path, tiebreak=(), page_query=None):
+        self.query = query
+        self.path = path
+        self.uses_rollup = path.startswith('rollup')
+        self.columns = list(query.selected_columns.keys())
+
+        # Named-parameter SQL shown to the user and saved with charts/reports
+        self.sql = f"/* DQBE path: {path} */\n{query}"
+
+        # Columns that identify a result row for keyset paging, and the SQL
+        # the table pages over (the query plus any hidden row keys)
+        self.tiebreak = tuple(tiebreak)
+        self.page_sql = self.sql if page_query is None else f"/* DQBE path: {path} */\n{page_query}"
+
+        # Positional SQL handed straight to the driver, skipping SQLAlchemy
+        # compilation on every execution
+        compiled = query.compile(dialect=sqlite.dialect())
+        self.driver_sql = str(compiled)
+        self.positions = tuple(compiled.positiontup or ())
+        self.defaults = dict(compiled.params)
+
+    def bind(self, params):
+        return tuple(params.get(name, self.defaults.get(name)) for name in self.positions)
+
+    def execute(self, conn, params):
+        return conn.exec_driver_sql(self.driver_sql, self.bind(params))
+
+
+def row_key(table):
+    # The primary key when it is a single column, else the rowid
+    primary_key = list(table.primary_key.columns)
+    if len(primary_key) == 1:
+        return primary_key[0]
+    return literal_column('"' + table.name.replace('"', '""') + '".rowid')
+
+
+def shape_tables(shape, tables):
+    selected = []
+    if shape['table1']:
+        selected.append(tables[shape['table1']])
+    if shape['table2'] and shape['table2'] != shape['table1']:
+        selected.append(tables[shape['table2']])
+    return selected
+
+
+def aggregate_expression(aggregate, column):
+    if aggregate == 'sum':
+        return func.sum(column)
+    if aggregate == 'avg':
+        return func.avg(column)
+    if aggregate == 'count':
+        return func.count(column)
+    return None
+
+
+def filter_clauses(shape, tables):
+    # The region and date filters always apply to sales
+    sales = tables["sales"]
+    filters = []
+    if shape['region']:
+        filters.append(sales.c.region == bindparam('region', type_=Text()))
+    if shape['dates']:
+        filters.append(sales.c.order_date.between(bindparam('start_date', type_=Text()),
+                                                  bindparam('end_date', type_=Text())))
+    return filters
+
+
+def grouped_aggregate(shape, tables):
+    # (group column, aggregate column) when the shape is a plain SUM/AVG/COUNT
+    # grouped by one column of the joined tables, else None. Such results can
+    # be computed outside build_plan's single statement (merged dashboard
+    # scans, incremental refresh).
+    if not (shape['aggregate'] and shape['aggregate_field'] and shape['group_by']) or shape['distinct']:
+        return None
+    # Ordering by anything but the group column is per row and cannot be
+    # reproduced from grouped results
+    if shape['sort_field'] and shape['sort_field'] != shape['group_by']:
+        return None
+    if shape['aggregate'] not in ('sum', 'avg', 'count'):
+        return None
+
+    selected = shape_tables(shape, tables)
+    group_col = next((table.c[shape['group_by']] for table in selected if shape['group_by'] in table.c), None)
+    agg_col = aggregate_column(shape['aggregate_field'], selected)
+    if group_col is None or agg_col is None:
+        return None
+    return group_col, agg_col
+
+
+def aggregate_column(field, selected):
+    # The aggregate column comes from the first selected table that has it;
+    # only the selected tables are looked at, so no other table is reflected
+    return next((table.c[field] for table in selected if field in table.c), None)
+
+
+def build_plan(shape, tables, join_index):
+    # Returns the QueryPlan for a shape, or None when the selected tables
+    # cannot be joined
+    table1 = shape['table1']
+    table2 = shape['table2']
+
+    selected_tables = shape_tables(shape, tables)
+
+    # Answer additive aggregates over sales from the daily rollup when possible
+    rollup_query = rollups.rewrite(
+        [table.name for table in selected_tables], shape['aggregate'], shape['aggregate_field'], shape['group_by'],
+        region=bindparam('region', type_=Text()) if shape['region'] else None,
+        start_date=bindparam('start_date', type_=Text()) if shape['dates'] else None,
+        end_date=bindparam('end_date', type_=Text()) if shape['dates'] else None,
+        sort_field=shape['sort_field'], sort_order=shape['sort_order'], distinct=shape['distinct'],
+        date_bucket=shape['date_bucket'])
+    if rollup_query is not None:
+        return QueryPlan(rollup_query, f"rollup ({rollups.ROLLUP_TABLE})",
+                         tiebreak=(shape['group_by'],) if shape['group_by'] else ())
+
+    path = join_index.path(table1, table2) if table2 else [table1]
+    if not path:
+        return None
+
+    from_clause = join_index.from_clause(tables, path)
+
+    columns = []
+    group_columns = []
+    agg_column = None
+
+    # Handle group_by field
+    group_by_field = shape['group_by']
+    if group_by_field:
+        for table in selected_tables:
+            if group_by_field in table.c:
+                group_col = table.c[group_by_field]
+                if shape['aggregate'] and chart_series.is_date_column(group_col) and shape['date_bucket'] != 'day':
+                    group_col = chart_series.bucket_expression(group_col, shape['date_bucket']).label(group_by_field)
+                group_columns.append(group_col)
+                columns.append(group_col)
+                break
+
+    # Handle aggregation
+    aggregate = shape['aggregate']
+    aggregate_field = shape['aggregate_field']
+    if aggregate and aggregate_field:
+        column = aggregate_column(aggregate_field, selected_tables)
+        if column is not None:
+            agg_column = aggregate_expression(aggregate, column)
+        if agg_column is not None:
+            columns.append(agg_column.label(f"{aggregate}_{aggregate_field}"))
+    else:
+        for field in shape['fields']:
+            for table in selected_tables:
+                if field in table.c:
+                    col = table.c[field]
+                    if col not in columns:
+                        columns.append(col)
+                    break
+
+    # Build query
+    query = select(*columns).select_from(from_clause)
+    if shape['distinct']:
+        query = query.distinct()
+
+    filters = filter_clauses(shape, tables)
+    if filters:
+        query = query.where(and_(*filters))
+
+    if group_columns:
+        query = query.group_by(*group_columns)
+
+    sort_field = shape['sort_field']
+    if sort_field and sort_field == group_by_field and group_columns:
+        sort_col = group_columns[0]
+        query = query.order_by(asc(sort_col) if shape['sort_order'] == 'asc' else desc(sort_col))
+    elif sort_field:
+        for table in selected_tables:
+            if sort_field in table.c:
+                sort_col = table.c[sort_field]
+                query = query.order_by(asc(sort_col) if shape['sort_order'] == 'asc' else desc(sort_col))
+                break
+
+    # A grouped result has one row per group; other rows are told apart by
+    # the row keys of every joined table, selected only when paging
+    # (DISTINCT and ungrouped aggregates have neither and page by offset)
+    tiebreak, page_query = (), None
+    if group_columns:
+        tiebreak = (group_by_field,)
+    elif not aggregate and not shape['distinct']:
+        keys = [row_key(tables[name]).label(f"{pagination.HIDDEN_PREFIX}{n}") for n, name in enumerate(path)]
+        page_query = query.add_columns(*keys)
+        tiebreak = tuple(key.name for key in keys)
+
+    return QueryPlan(query, "base tables", tiebreak, page_query)
+
+
+class PlanCache:
+    def __init__(self, max_entries=PLAN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, shape, tables, join_index):
+        # Plans are tied to the schema the join index was built from
+        key = (join_index.version, shape_key(shape))
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self.hits += 1
+                self._plans.move_to_end(key)
+                return plan
+            self.misses += 1
+
+        plan = build_plan(shape, tables, join_index)
+        if plan is not None:
+            with self._lock:
+                self._plans[key] = plan
+                while len(self._plans) > self.max_entries:
+                    self._plans.popitem(last=False)
+        return plan
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._plans),
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
@@ -0,0 +1,79 @@
+# Server-side store for dashboard charts and reports. Definitions live in an
+# indexed SQLite table keyed by owner, so the session cookie only carries the
+# owner id instead of every chart definition and its SQL.
+
+import json
+import uuid
+from datetime import datetime, timezone
+
+from sqlalchemy import MetaData, Table, Column, Integer, Text, Index, select, and_
+
+store_metadata = MetaData()
+
+saved_items = Table(
+    "dqbe_saved_items", store_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("owner", Text, nullable=False),
+    Column("kind", Text, nullable=False),  # 'chart' or 'report'
+    Column("definition", Text, nullable=False),
+    Column("saved", Integer, nullable=False, default=0),
+    Column("created_at", Text, nullable=False),
+    Index("dqbe_saved_items_owner", "owner", "kind", "id"),
+    sqlite_autoincrement=True,
+)
+
+
+def install(engine):
+    store_metadata.create_all(engine)
+
+
+def new_owner_id():
+    return uuid.uuid4().hex
+
+
+def add_item(engine, owner, kind, definition):
+    with engine.begin() as conn:
+        result = conn.execute(saved_items.insert().values(
+            owner=owner,
+            kind=kind,
+            definition=json.dumps(definition),
+            saved=0,
+            created_at=datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        ))
+        return result.inserted_primary_key[0]
+
+
+def _to_item(row):
+    item = json.loads(row.definition)
+    item['id'] = row.id
+    item['saved'] = bool(row.saved)
+    return item
+
+
+def list_items(engine, owner, kind):
+    query = (select(saved_items.c.id, saved_items.c.definition, saved_items.c.saved)
+             .where(and_(saved_items.c.owner == owner, saved_items.c.kind == kind))
+             .order_by(saved_items.c.id))
+    with engine.connect() as conn:
+        return [_to_item(row) for row in conn.execute(query)]
+
+
+def get_item(engine, owner, kind, item_id):
+    query = (select(saved_items.c.id, saved_items.c.definition, saved_items.c.saved)
+             .where(and_(saved_items.c.owner == owner, saved_items.c.kind == kind, saved_items.c.id == item_id)))
+    with engine.connect() as conn:
+        row = conn.execute(query).first()
+    return _to_item(row) if row is not None else None
+
+
+def remove_item(engine, owner, kind, item_id):
+    with engine.begin() as conn:
+        return conn.execute(saved_items.delete().where(and_(
+            saved_items.c.owner == owner, saved_items.c.kind == kind, saved_items.c.id == item_id))).rowcount
+
+
+def mark_saved(engine, owner, kind, item_id):
+    with engine.begin() as conn:
+        return conn.execute(saved_items.update().where(and_(
+            saved_items.c.owner == owner, saved_items.c.kind == kind, saved_items.c.id == item_id))
+            .values(saved=1)).rowcount
@@ -0,0 +1,79 @@
+# Compact, compressed HTTP responses. API payloads are serialized with orjson
+# when it is installed (the json module otherwise), and every compressible
+# response above COMPRESS_MIN_BYTES is compressed with brotli or gzip,
+# whichever the client accepts; brotli needs the brotli package. Streamed
+# and file responses are sent as they are.
+
+import gzip
+import json
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COMPRESSIBLE = ('application/json', 'text/html', 'text/css', 'text/javascript', 'application/javascript')
+
+
+def dumps(payload):
+    # JSON bytes; values JSON has no type for (dates, decimals) are written as str()
+    if orjson is not None:
+        return orjson.dumps(payload, default=str,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(payload, default=str, separators=(',', ':')).encode()
+
+
+def json_response(payload, status=200):
+    # payload may already be serialized bytes, e.g. from a cache
+    body = payload if isinstance(payload, bytes) else dumps(payload)
+    return Response(body, status=status, mimetype='application/json')
+
+
+def _encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(response):
+    if (response.status_code < 200 or response.status_code in (204, 304) or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = _encoding()
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0))
+    response.headers['Content-Encoding'] = encoding
+
+    # The encoded body differs byte for byte, so a strong validator becomes weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.after_request(compress)
@@ -0,0 +1,160 @@
+# Materialized rollup of sales per day x region x product x customer.
+# The rollup is refreshed incrementally from the last sales id it has seen and
+# the query builder rewrites eligible aggregate queries to read from it.
+# Appends are folded in; an update, a delete or a bulk load of sales seen in
+# the change log (incremental.py), or a max id below the watermark, rebuilds
+# it.
+
+from sqlalchemy import (MetaData, Table, Column, Integer, Float, Text, PrimaryKeyConstraint,
+                        select, func, cast, literal_column, and_, asc, desc, text)
+
+import chart_series
+import incremental
+
+ROLLUP_TABLE = "dqbe_sales_daily"
+READER_NAME = "rollup"
+DIMENSIONS = ("order_date", "region", "product", "customer_name")
+
+rollup_metadata = MetaData()
+
+sales_daily = Table(
+    ROLLUP_TABLE, rollup_metadata,
+    Column("order_date", Text),
+    Column("region", Text),
+    Column("product", Text),
+    Column("customer_name", Text),
+    Column("total_amount", Integer),
+    Column("amount_count", Integer, nullable=False),
+    Column("row_count", Integer, nullable=False),
+    PrimaryKeyConstraint(*DIMENSIONS),
+)
+
+rollup_state = Table(
+    "dqbe_rollup_state", rollup_metadata,
+    Column("name", Text, primary_key=True),
+    Column("last_id", Integer, nullable=False),
+)
+
+_upsert_sql = text(f"""
+INSERT INTO {ROLLUP_TABLE} (order_date, region, product, customer_name, total_amount, amount_count, row_count)
+SELECT order_date, region, product, customer_name, SUM(amount), COUNT(amount), COUNT(*)
+FROM sales
+WHERE id > :last_id AND id <= :max_id
+GROUP BY order_date, region, product, customer_name
+ON CONFLICT (order_date, region, product, customer_name) DO UPDATE SET
+    total_amount = coalesce(total_amount + excluded.total_amount, total_amount, excluded.total_amount),
+    amount_count = amount_count + excluded.amount_count,
+    row_count = row_count + excluded.row_count
+""")
+
+
+def install(engine):
+    # Needs the change log, so incremental.install runs first
+    rollup_metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT OR IGNORE INTO dqbe_rollup_state (name, last_id) VALUES ('sales', 0)"))
+    refresh(engine)
+
+
+def _watermarks(conn):
+    last_id = conn.execute(select(rollup_state.c.last_id).where(rollup_state.c.name == 'sales')).scalar() or 0
+    max_id = conn.execute(text("SELECT max(id) FROM sales")).scalar() or 0
+    return last_id, max_id, incremental.reader_position(conn, READER_NAME), incremental.current_position(conn)
+
+
+def refresh(engine):
+    # Folds every sales row added since the last refresh into the rollup, or
+    # rebuilds it when sales changed in any other way. Returns the number of
+    # ids covered.
+    with engine.connect() as conn:
+        last_id, max_id, position, until = _watermarks(conn)
+    if max_id == last_id and position == until:
+        return 0
+
+    with engine.begin() as conn:
+        # Take the write lock before deciding, so no change to sales can land
+        # between the checks and the watermark update; concurrent workers
+        # queue here and find nothing left to do
+        conn.execute(rollup_state.update().where(rollup_state.c.name == 'sales')
+                     .values(last_id=rollup_state.c.last_id))
+        last_id, max_id, position, until = _watermarks(conn)
+
+        stale = position is None or max_id < last_id or not incremental.appends_only(conn, 'sales', position, until)
+        if stale:
+            conn.execute(sales_daily.delete())
+            last_id = 0
+        if max_id > last_id:
+            conn.execute(_upsert_sql, {"last_id": last_id, "max_id": max_id})
+        conn.execute(rollup_state.update().where(rollup_state.c.name == 'sales').values(last_id=max_id))
+        incremental.record_reader_position(conn, READER_NAME, until)
+        return max_id - last_id
+
+
+def refresh_if_used(engine, queries):
+    # Saved charts/reports that read the rollup need it current before they run
+    if any(ROLLUP_TABLE in sql for sql in queries):
+        refresh(engine)
+
+
+def rebuild(engine):
+    # Forgets the change-log position, so the refresh recomputes in full
+    with engine.begin() as conn:
+        conn.execute(incremental.changelog_readers.delete().where(incremental.changelog_readers.c.name == READER_NAME))
+    return refresh(engine)
+
+
+def rewrite(table_names, aggregate, aggregate_field, group_by_field,
+            region=None, start_date=None, end_date=None, sort_field=None, sort_order=None, distinct=False,
+            date_bucket=None):
+    # Returns an equivalent query over the rollup, or None when the request
+    # needs the base tables (joins, non-additive aggregates, other columns).
+    if set(table_names) != {"sales"}:
+        return None
+    if aggregate not in ("sum", "avg", "count"):
+        return None
+    if aggregate_field == "id" and aggregate != "count":
+        return None
+    if aggregate_field not in ("amount", "id"):
+        return None
+    if group_by_field and group_by_field not in DIMENSIONS:
+        return None
+    if sort_field and sort_field != group_by_field:
+        return None
+
+    r = sales_daily.c
+    columns = []
+    group_col = None
+    if group_by_field:
+        group_col = r[group_by_field]
+        if group_by_field == "order_date":
+            group_col = chart_series.bucket_expression(group_col, date_bucket)
+        columns.append(group_col.label(group_by_field))
+
+    if aggregate_field == "id":
+        agg_column = func.coalesce(func.sum(r.row_count), literal_column("0"))
+    elif aggregate == "sum":
+        agg_column = func.sum(r.total_amount)
+    elif aggregate == "avg":
+        agg_column = cast(func.sum(r.total_amount), Float) / func.sum(r.amount_count)
+    else:
+        agg_column = func.coalesce(func.sum(r.amount_count), literal_column("0"))
+    columns.append(agg_column.label(f"{aggregate}_{aggregate_field}"))
+
+    query = select(*columns).select_from(sales_daily)
+    if distinct:
+        query = query.distinct()
+
+    filters = []
+    if region is not None:
+        filters.append(r.region == region)
+    if start_date is not None and end_date is not None:
+        filters.append(r.order_date.between(start_date, end_date))
+    if filters:
+        query = query.where(and_(*filters))
+
+    if group_col is not None:
+        query = query.group_by(group_col)
+        if sort_field:
+            query = query.order_by(asc(group_col) if sort_order == 'asc' else desc(group_col))
+
+    return query
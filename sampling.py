@@ -0,0 +1,251 @@
+# Approximate "fast preview" for the query builder. A stratified sample of
+# sales is kept in dqbe_sales_sample: every (region, product) stratum is
+# sampled at SAMPLE_FRACTION, except that strata with fewer rows are sampled
+# more densely so each one keeps about MIN_STRATUM_ROWS rows. A row is in the
+# sample when a multiplicative hash of its id falls under its stratum's rate,
+# and it stores its weight (1 / rate). SUM/COUNT/AVG group-bys are estimated
+# from the weighted rows (Horvitz-Thompson, with a ratio estimate for AVG)
+# with a normal-approximation confidence interval.
+#
+# The sample follows sales like the rollup does: rows inserted since the last
+# refresh are sampled as they arrive, and an update, delete or bulk load seen
+# in the change log (incremental.py) rebuilds it.
+#
+# DQBE_SAMPLE_FRACTION sets the fraction (default 0.01).
+
+import math
+import os
+import threading
+from collections import Counter
+from collections.abc import Mapping
+
+from sqlalchemy import MetaData, Table, Column, Integer, Float, Text, select, func, case, and_, asc, desc, text
+
+import chart_series
+import incremental
+import query_builder
+
+SAMPLE_TABLE = "dqbe_sales_sample"
+WEIGHT = "dqbe_weight"
+READER_NAME = "sample"
+FACT_TABLE = incremental.FACT_TABLE
+STRATA = ("region", "product")
+SAMPLE_FRACTION = float(os.environ.get('DQBE_SAMPLE_FRACTION', 0.01))
+MIN_STRATUM_ROWS = 50
+Z = 1.96  # 95% confidence
+CONFIDENCE = 95
+
+state_metadata = MetaData()
+
+sample_state = Table(
+    "dqbe_sample_state", state_metadata,
+    Column("name", Text, primary_key=True),
+    Column("last_id", Integer, nullable=False),
+    Column("position", Integer, nullable=False),
+)
+
+# Rows per stratum, which decide the sampling rate of new rows
+sample_strata = Table(
+    "dqbe_sample_strata", state_metadata,
+    Column("stratum", Text, primary_key=True),
+    Column("population", Integer, nullable=False),
+)
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SampledTables(Mapping):
+    # The app's tables with sales swapped for the sample, so the builder's
+    # join and filter helpers produce the same query over the sample
+    def __init__(self, tables, sample):
+        self.tables = tables
+        self.sample = sample
+
+    def __getitem__(self, name):
+        return self.sample if name == FACT_TABLE else self.tables[name]
+
+    def __iter__(self):
+        return iter(self.tables)
+
+    def __len__(self):
+        return len(self.tables)
+
+    def __contains__(self, name):
+        return name in self.tables
+
+
+def estimate(aggregate, n, sw, a, swy, b, c):
+    # (estimate, half-width of the interval) from the per-group sums of
+    # weights w and values y: sw = Σw, a = Σw(w-1), swy = Σwy, b = Σw(w-1)y,
+    # c = Σw(w-1)y², all over rows where y is not NULL
+    if not n:
+        return (0, 0.0) if aggregate == 'count' else (None, None)
+    if aggregate == 'count':
+        value, variance = sw, a
+    elif aggregate == 'sum':
+        value, variance = swy, c
+    else:
+        value = swy / sw
+        variance = (c - 2 * value * b + value * value * a) / (sw * sw)
+    return value, Z * math.sqrt(max(variance or 0.0, 0.0))
+
+
+class SalesSample:
+    def __init__(self, engine, sales, fraction=SAMPLE_FRACTION, min_rows=MIN_STRATUM_ROWS):
+        self.engine = engine
+        self.fraction = fraction
+        self.min_rows = min_rows
+        self.key = incremental.LOGGED_TABLES[FACT_TABLE]
+        self.columns = [column.name for column in sales.columns]
+        self.table = Table(
+            SAMPLE_TABLE, MetaData(),
+            *[Column(column.name, column.type, primary_key=column.name == self.key) for column in sales.columns],
+            Column(WEIGHT, Float, nullable=False))
+        self._installed = False
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def _install(self):
+        # Created on first use, so only databases that get previews carry a sample
+        with self.engine.begin() as conn:
+            existing = [row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({SAMPLE_TABLE})")]
+            stale = bool(existing) and existing != self.columns + [WEIGHT]
+            if stale:
+                # sales changed shape since the sample was built
+                conn.exec_driver_sql(f"DROP TABLE {SAMPLE_TABLE}")
+        state_metadata.create_all(self.engine)
+        self.table.create(self.engine, checkfirst=True)
+        if stale:
+            with self.engine.begin() as conn:
+                conn.execute(sample_state.delete())
+        self._installed = True
+
+    def _stratum_sql(self, alias):
+        parts = [f"coalesce({alias}.{_quote(name)}, '')" for name in STRATA if name in self.columns]
+        return " || char(31) || ".join(parts) if parts else "''"
+
+    def _count_strata(self, conn, last_id, max_id):
+        # Adds the sales rows in the (last_id, max_id] id range to the stratum populations
+        conn.execute(text(
+            f"INSERT INTO dqbe_sample_strata (stratum, population) "
+            f"SELECT {self._stratum_sql('s')}, count(*) FROM {FACT_TABLE} AS s "
+            f"WHERE s.{_quote(self.key)} > :last_id AND s.{_quote(self.key)} <= :max_id GROUP BY 1 "
+            f"ON CONFLICT (stratum) DO UPDATE SET population = population + excluded.population"),
+            {"last_id": last_id, "max_id": max_id})
+
+    def _sample_range(self, conn, last_id, max_id):
+        # Samples the (last_id, max_id] id range at each stratum's current rate
+        key = _quote(self.key)
+        names = ", ".join(_quote(name) for name in self.columns)
+        conn.execute(text(
+            f"INSERT INTO {SAMPLE_TABLE} ({names}, {WEIGHT}) "
+            f"SELECT {names}, 1.0 / dqbe_rate FROM ("
+            f"SELECT s.*, CASE WHEN st.population IS NULL OR st.population <= :min_rows THEN 1.0 "
+            f"ELSE max(:fraction, :min_rows * 1.0 / st.population) END AS dqbe_rate "
+            f"FROM {FACT_TABLE} AS s LEFT JOIN dqbe_sample_strata AS st ON st.stratum = {self._stratum_sql('s')} "
+            f"WHERE s.{key} > :last_id AND s.{key} <= :max_id) "
+            f"WHERE (({key} * 2654435761) % 4294967296) / 4294967296.0 < dqbe_rate"),
+            {"min_rows": self.min_rows, "fraction": self.fraction, "last_id": last_id, "max_id": max_id})
+
+    def _needs_rebuild(self, conn, since, until):
+        # Inserts into sales are sampled as they come; anything else the
+        # change log shows for sales (or cannot account for) needs a rebuild
+        changed = incremental.changed_tables(conn, since, until)
+        if changed is None:
+            return True
+        if FACT_TABLE not in changed:
+            return False
+        changelog = incremental.changelog
+        ops = {row[0] for row in conn.execute(
+            select(changelog.c.op).distinct().where(
+                changelog.c.seq > since, changelog.c.seq <= until, changelog.c.table_name == FACT_TABLE))}
+        return bool(ops - {'I'})
+
+    def refresh(self):
+        # Brings the sample up to date with sales; returns 'current',
+        # 'appended' or 'rebuilt'
+        with self._lock:
+            if not self._installed:
+                self._install()
+            with self.engine.begin() as conn:
+                state = conn.execute(select(sample_state).where(sample_state.c.name == FACT_TABLE)).first()
+                until = incremental.current_position(conn)
+                max_id = conn.execute(text(f"SELECT max({_quote(self.key)}) FROM {FACT_TABLE}")).scalar() or 0
+
+                if state is None or self._needs_rebuild(conn, state.position, until):
+                    # Rates come from each stratum's full population
+                    conn.execute(self.table.delete())
+                    conn.execute(sample_strata.delete())
+                    self._count_strata(conn, 0, max_id)
+                    self._sample_range(conn, 0, max_id)
+                    outcome = 'rebuilt'
+                elif max_id > state.last_id:
+                    # New rows are sampled at the rates before they arrived
+                    self._sample_range(conn, state.last_id, max_id)
+                    self._count_strata(conn, state.last_id, max_id)
+                    outcome = 'appended'
+                else:
+                    outcome = 'current'
+
+                conn.execute(sample_state.delete().where(sample_state.c.name == FACT_TABLE))
+                conn.execute(sample_state.insert().values(name=FACT_TABLE, last_id=max_id, position=until))
+
+            incremental.set_reader_position(self.engine, READER_NAME, until)
+            self._stats[outcome] += 1
+            return outcome
+
+    def estimate(self, read_engine, shape, params, tables, join_index):
+        # [(label, estimate, interval half-width, sampled rows)] per group,
+        # or None when the shape cannot be previewed from the sample
+        path = join_index.path(shape['table1'], shape['table2']) if shape['table2'] else [shape['table1']]
+        if not path or FACT_TABLE not in path:
+            return None
+        sampled = SampledTables(tables, self.table)
+        try:
+            resolved = query_builder.grouped_aggregate(shape, sampled)
+        except KeyError:
+            return None
+        if resolved is None:
+            return None
+
+        group_col, value_col = resolved
+        group_expr = group_col
+        if chart_series.is_date_column(group_col) and shape['date_bucket'] not in (None, 'day'):
+            group_expr = chart_series.bucket_expression(group_col, shape['date_bucket'])
+
+        weight = self.table.c[WEIGHT]
+        present = value_col.is_not(None)
+        excess = weight * (weight - 1)
+        query = select(group_expr.label(shape['group_by']),
+                       func.count(value_col),
+                       func.sum(case((present, weight))),
+                       func.sum(case((present, excess))),
+                       func.sum(weight * value_col),
+                       func.sum(excess * value_col),
+                       func.sum(excess * value_col * value_col)) \
+            .select_from(join_index.from_clause(sampled, path))
+        filters = query_builder.filter_clauses(shape, sampled)
+        if filters:
+            query = query.where(and_(*filters))
+        query = query.group_by(group_expr) \
+            .order_by(desc(group_expr) if shape['sort_order'] == 'desc' else asc(group_expr))
+
+        self.refresh()
+        with read_engine.connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        results = []
+        for label, *sums in rows:
+            value, half = estimate(shape['aggregate'], *sums)
+            if value is not None:
+                value = round(value) if shape['aggregate'] == 'count' else round(value, 2)
+                half = round(half, 2)
+            results.append((label, value, half, sums[0]))
+        self._stats['previews'] += 1
+        return results
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, fraction=self.fraction, min_stratum_rows=self.min_rows)
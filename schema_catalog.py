@@ -0,0 +1,221 @@
+# Schema catalog. Table names, columns and foreign keys are read with
+# lightweight PRAGMAs and kept in a snapshot on disk keyed by the database's
+# PRAGMA schema_version, so a worker booting against an unchanged schema
+# reads one small file instead of introspecting every table. SQLAlchemy Table
+# objects are only reflected when a query first needs them. The attribute
+# lists and date bounds the builder form shows are served from memory.
+#
+# The schema version is rechecked at most every SCHEMA_CHECK_INTERVAL seconds;
+# any change drops the reflected tables and reloads the snapshot.
+# DQBE_SCHEMA_CACHE sets the snapshot path (default: one per database in the
+# temp directory).
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Mapping
+
+from sqlalchemy import MetaData, Table, select, func
+
+import db
+
+SNAPSHOT_FORMAT = 1
+SCHEMA_CHECK_INTERVAL = 2  # seconds
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def snapshot_path(engine):
+    path = os.environ.get('DQBE_SCHEMA_CACHE')
+    if path:
+        return path
+    database = os.path.abspath(db.database_path(engine) or '')
+    return os.path.join(tempfile.gettempdir(), f"dqbe-schema-{hashlib.sha1(database.encode()).hexdigest()[:12]}.json")
+
+
+def _file_identity(engine):
+    # Guards against a different database file that happens to share the
+    # schema version (e.g. replaced by a fresh copy)
+    path = db.database_path(engine)
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return [os.path.abspath(path), st.st_dev, st.st_ino]
+
+
+def describe(conn):
+    # {name: {'columns': [...], 'foreign_keys': [(column, ref_table, ref_column)]}}
+    # for the user tables (dqbe_* tables are the app's own bookkeeping), in
+    # dependency order
+    names = [row[0] for row in conn.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'table' "
+        "AND substr(name, 1, 7) != 'sqlite_' AND substr(name, 1, 5) != 'dqbe_' ORDER BY name")]
+
+    columns = {}
+    primary_keys = {}
+    for name in names:
+        info = conn.exec_driver_sql(f"PRAGMA table_info({_quote(name)})").fetchall()
+        columns[name] = [row[1] for row in info]
+        primary_keys[name] = [row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]]
+
+    foreign_keys = {}
+    for name in names:
+        foreign_keys[name] = []
+        for row in conn.exec_driver_sql(f"PRAGMA foreign_key_list({_quote(name)})"):
+            ref_table, column, ref_column = row[2], row[3], row[4]
+            if ref_column is None:
+                # A bare REFERENCES points at the primary key
+                keys = primary_keys.get(ref_table) or []
+                ref_column = keys[0] if keys else None
+            if ref_column is not None:
+                foreign_keys[name].append((column, ref_table, ref_column))
+
+    ordered = []
+
+    def visit(name, seen):
+        if name in ordered or name in seen:
+            return
+        seen.add(name)
+        for _, ref_table, _ in foreign_keys[name]:
+            if ref_table in columns:
+                visit(ref_table, seen)
+        ordered.append(name)
+
+    for name in names:
+        visit(name, set())
+
+    return {name: {'columns': columns[name], 'foreign_keys': foreign_keys[name]} for name in ordered}
+
+
+class CatalogTables(Mapping):
+    # all_tables as the rest of the app sees it: the catalog's table names,
+    # reflecting each Table on first access
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __getitem__(self, name):
+        return self.catalog.table(name)
+
+    def __iter__(self):
+        return iter(self.catalog.names())
+
+    def __len__(self):
+        return len(self.catalog.names())
+
+    def __contains__(self, name):
+        return name in self.catalog.schema
+
+
+class SchemaCatalog:
+    def __init__(self, engine, path=None, check_interval=SCHEMA_CHECK_INTERVAL):
+        self.engine = engine
+        self.path = path or snapshot_path(engine)
+        self.check_interval = check_interval
+        self.version = None
+        self.schema = {}
+        self.tables = CatalogTables(self)
+        self._metadata = MetaData()
+        self._attributes = None
+        self._bounds = {}
+        self._checked_at = 0.0
+        self._lock = threading.RLock()
+        self._stats = {'loads': 0, 'snapshot_hits': 0, 'reflected': 0}
+
+    def _load_snapshot(self, version, identity):
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (snapshot.get('format') != SNAPSHOT_FORMAT or snapshot.get('schema_version') != version
+                or snapshot.get('database') != identity):
+            return None
+        return {name: {'columns': entry['columns'], 'foreign_keys': [tuple(fk) for fk in entry['foreign_keys']]}
+                for name, entry in snapshot['tables'].items()}
+
+    def _save_snapshot(self, version, identity, schema):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'format': SNAPSHOT_FORMAT, 'schema_version': version, 'database': identity,
+                           'tables': schema}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[Schema catalog] could not write snapshot {self.path}: {e}")
+
+    def refresh(self, force=False):
+        # Returns True when the schema was (re)loaded
+        now = time.monotonic()
+        if not force and self.version is not None and now - self._checked_at < self.check_interval:
+            return False
+        with self._lock:
+            self._checked_at = now
+            with self.engine.connect() as conn:
+                version = conn.exec_driver_sql("PRAGMA schema_version").scalar()
+                if version == self.version and not force:
+                    return False
+                identity = _file_identity(self.engine)
+                schema = self._load_snapshot(version, identity)
+                if schema is None:
+                    schema = describe(conn)
+                    self._save_snapshot(version, identity, schema)
+                else:
+                    self._stats['snapshot_hits'] += 1
+
+            self.schema = schema
+            self.version = version
+            self._metadata = MetaData()
+            self._attributes = None
+            self._bounds = {}
+            self._stats['loads'] += 1
+            return True
+
+    def names(self):
+        return list(self.schema)
+
+    def describe(self):
+        # (columns, foreign_keys) in the form JoinIndex.build takes
+        return ({name: list(entry['columns']) for name, entry in self.schema.items()},
+                {name: list(entry['foreign_keys']) for name, entry in self.schema.items()})
+
+    def attributes(self):
+        attributes = self._attributes
+        if attributes is None:
+            attributes = self._attributes = {name: list(entry['columns']) for name, entry in self.schema.items()}
+        return attributes
+
+    def table(self, name):
+        if name not in self.schema:
+            raise KeyError(name)
+        with self._lock:
+            table = self._metadata.tables.get(name)
+            if table is None:
+                table = Table(name, self._metadata, autoload_with=self.engine)
+                self._stats['reflected'] += 1
+            return table
+
+    def date_bounds(self, engine, table_name, column_name, data_version):
+        # (min, max) of a date column, recomputed only when the caller's data
+        # version for the table moves
+        key = (table_name, column_name)
+        cached = self._bounds.get(key)
+        if cached is not None and cached[0] == data_version:
+            return cached[1]
+        column = self.table(table_name).c[column_name]
+        with engine.connect() as conn:
+            # Separate statements, so each can be answered from an index
+            bounds = (conn.execute(select(func.min(column))).scalar(),
+                      conn.execute(select(func.max(column))).scalar())
+        self._bounds[key] = (data_version, bounds)
+        return bounds
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, schema_version=self.version, tables=len(self.schema),
+                        snapshot=self.path)
@@ -0,0 +1,82 @@
+// Polls a background report job, shows its progress, fills the results table
+// page by page and draws the chart once the job has finished.
+document.addEventListener("DOMContentLoaded", function () {
+  const section = document.getElementById("job-section");
+  if (!section) {
+    return;
+  }
+
+  const statusLine = section.querySelector(".job-status");
+  const cancelButton = section.querySelector(".cancel-job");
+  const moreButton = section.querySelector(".load-more-job");
+  const head = document.getElementById("job-columns");
+  const tbody = document.getElementById("job-rows");
+  const finished = ["done", "failed", "cancelled", "timeout"];
+  let offset = 0;
+
+  function loadRows() {
+    const url = new URL(section.dataset.rows, window.location.origin);
+    url.searchParams.set("offset", offset);
+    moreButton.disabled = true;
+    return fetch(url)
+      .then(response => response.json())
+      .then(page => {
+        if (!head.children.length) {
+          page.columns.forEach(name => {
+            const th = document.createElement("th");
+            th.textContent = name;
+            head.appendChild(th);
+          });
+        }
+        page.rows.forEach(row => {
+          const tr = document.createElement("tr");
+          row.forEach(value => {
+            const td = document.createElement("td");
+            td.textContent = value === null ? "None" : value;
+            tr.appendChild(td);
+          });
+          tbody.appendChild(tr);
+        });
+        offset += page.rows.length;
+        moreButton.hidden = page.next === null;
+        moreButton.disabled = false;
+      });
+  }
+
+  function poll() {
+    fetch(section.dataset.job)
+      .then(response => response.json())
+      .then(job => {
+        if (!finished.includes(job.status)) {
+          statusLine.textContent = `Running: ${job.rows_fetched} rows fetched in ${job.elapsed}s`;
+          setTimeout(poll, 1000);
+          return;
+        }
+
+        cancelButton.remove();
+        if (job.status !== "done") {
+          statusLine.textContent = job.error ? `Job ${job.status}: ${job.error}` : `Job ${job.status}`;
+          return;
+        }
+
+        statusLine.textContent = `Finished: ${job.rows_fetched} rows in ${job.elapsed}s` +
+          (job.truncated ? " (truncated)" : "") + (job.chart && job.chart.note ? ` ${job.chart.note}` : "");
+        loadRows();
+        if (job.chart && job.chart.labels.length && window.renderReportChart) {
+          const chartData = JSON.parse(document.getElementById("job-chart").textContent);
+          chartData.labels = job.chart.labels;
+          chartData.values = job.chart.values;
+          window.renderReportChart(chartData);
+        }
+      })
+      .catch(() => setTimeout(poll, 3000));
+  }
+
+  cancelButton.addEventListener("click", function () {
+    cancelButton.disabled = true;
+    fetch(section.dataset.cancel, { method: "POST" });
+  });
+  moreButton.addEventListener("click", loadRows);
+
+  poll();
+});
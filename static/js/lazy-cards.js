@@ -0,0 +1,42 @@
+// Lazy loading for dashboard and report cards. Each card is rendered as a
+// skeleton and, once it scrolls into view, filled in by the page's
+// window.loadCard(card), which fetches the card's data from the JSON API.
+// Cards in view load in parallel. loadCard may resolve to a message to show
+// in place of the chart.
+document.addEventListener("DOMContentLoaded", function () {
+  const cards = document.querySelectorAll(".loading[data-chart]");
+
+  function showMessage(card, text) {
+    const message = card.querySelector(".chart-message");
+    card.querySelector(".chart-body").hidden = true;
+    message.textContent = text;
+    message.hidden = false;
+  }
+
+  function load(card) {
+    window.loadCard(card)
+      .then(text => {
+        if (text) {
+          showMessage(card, text);
+        }
+      })
+      .catch(() => showMessage(card, "Could not load this chart."))
+      .finally(() => card.classList.remove("loading"));
+  }
+
+  if (!("IntersectionObserver" in window)) {
+    cards.forEach(load);
+    return;
+  }
+
+  // Starts a little before a card reaches the viewport
+  const observer = new IntersectionObserver(entries => {
+    entries.forEach(entry => {
+      if (entry.isIntersecting) {
+        observer.unobserve(entry.target);
+        load(entry.target);
+      }
+    });
+  }, { rootMargin: "200px" });
+  cards.forEach(card => observer.observe(card));
+});
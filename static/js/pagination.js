@@ -0,0 +1,49 @@
+// Fetches further pages of a report table from the keyset pagination API.
+// Buttons carry the endpoint, the next cursor and, for builder results, the
+// submitted query form to replay. Buttons added after the page has loaded
+// are wired up with window.bindLoadMore.
+window.bindLoadMore = function (button) {
+  button.addEventListener("click", function () {
+    const url = new URL(button.dataset.endpoint, window.location.origin);
+    const options = {};
+
+    if (button.dataset.query) {
+      const body = new FormData();
+      const query = JSON.parse(button.dataset.query);
+      Object.keys(query).forEach(name => query[name].forEach(value => body.append(name, value)));
+      body.append("cursor", button.dataset.cursor);
+      options.method = "POST";
+      options.body = body;
+    } else {
+      url.searchParams.set("cursor", button.dataset.cursor);
+    }
+
+    button.disabled = true;
+    fetch(url, options)
+      .then(response => response.json())
+      .then(page => {
+        const tbody = document.getElementById(button.dataset.target);
+        page.rows.forEach(row => {
+          const tr = document.createElement("tr");
+          row.forEach(value => {
+            const td = document.createElement("td");
+            td.textContent = value === null ? "None" : value;
+            tr.appendChild(td);
+          });
+          tbody.appendChild(tr);
+        });
+
+        if (page.next) {
+          button.dataset.cursor = page.next;
+          button.disabled = false;
+        } else {
+          button.remove();
+        }
+      })
+      .catch(() => { button.disabled = false; });
+  });
+};
+
+document.addEventListener("DOMContentLoaded", function () {
+  document.querySelectorAll(".load-more").forEach(window.bindLoadMore);
+});